@@ -1,13 +1,82 @@
+import os
+import sys
 import streamlit as st
-import pandas as pd
 
-# Cargar catálogo desde CSV del proyecto
-catalogo_df = pd.read_csv("base_autopartes_dummy.csv")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+from model import LocalCSVSearcher
+from chat_jobs import ChatJob, DEFAULT_RUNNER
+from chat_window import visible_start
 
 # Configuración inicial (debe ser la primera instrucción de Streamlit)
 st.set_page_config(page_title="AutoPartes AI", layout="wide")
 
 
+ARCHIVO_CATALOGO = "base_autopartes_dummy.csv"
+
+
+@st.cache_resource
+def cargar_buscador(ruta: str) -> LocalCSVSearcher:
+    """Buscador compartido por todas las sesiones: carga y compacta el catálogo una sola vez"""
+    buscador = LocalCSVSearcher(ruta)
+    buscador.load_csv_from_local(ARCHIVO_CATALOGO)
+    return buscador
+
+
+# Cargar catálogo desde CSV del proyecto (los filtros repetidos salen de la caché de consultas)
+buscador = cargar_buscador(os.path.dirname(os.path.abspath(__file__)))
+catalogo_df = buscador.load_csv_from_local(ARCHIVO_CATALOGO)
+reporte_compactacion = buscador.compaction_reports[ARCHIVO_CATALOGO]
+
+
+
+def responder(mensaje: str, job: ChatJob) -> str:
+    """Genera la respuesta del asistente en segundo plano (job.append publica texto parcial)"""
+    return "Gracias por la descripción. Parece que necesitas un *alternador* compatible con Nissan Altima 2015. Buscando..."
+
+
+@st.fragment(run_every=0.3)
+def mostrar_respuesta_en_curso():
+    """Muestra el turno en curso; solo este fragmento se redibuja mientras se genera la respuesta"""
+    job_id = st.session_state.get("job_asistente")
+    if job_id is None:
+        return
+    job = DEFAULT_RUNNER.get(job_id)
+    
+    if job is None or job.done:
+        del st.session_state.job_asistente
+        if job is not None:
+            DEFAULT_RUNNER.pop(job_id)
+            respuesta = job.result if job.status == "done" else "Lo siento, hubo un error. Intenta de nuevo."
+            st.session_state.chat_historial.append({"role": "assistant", "content": respuesta})
+        st.rerun()
+    
+    st.chat_message("assistant").write(job.partial_text or "🤔 Pensando...")
+
+
+def mostrar_asistente():
+    """Chat del asistente; la respuesta se genera en segundo plano y el resto de la página sigue disponible"""
+    st.title("🤖 Asistente de AutoPartes")
+    
+    if "chat_historial" not in st.session_state:
+        st.session_state.chat_historial = []
+    
+    # Solo los últimos turnos (usuario y asistente por separado), con botón para cargar los anteriores
+    historial = st.session_state.chat_historial
+    inicio = visible_start("ventana_asistente", len(historial), items_per_turn=2)
+    for msg in historial[inicio:]:
+        st.chat_message(msg["role"]).markdown(msg["content"])
+    
+    # Con un job en curso no se aceptan mensajes nuevos: un rerun nunca repite la respuesta
+    en_curso = st.session_state.get("job_asistente") is not None
+    user_input = st.chat_input("Describe tu problema aquí...", disabled=en_curso)
+    if user_input and not en_curso:
+        st.session_state.chat_historial.append({"role": "user", "content": user_input})
+        st.chat_message("user").markdown(user_input)
+        st.session_state.job_asistente = DEFAULT_RUNNER.submit(lambda job: responder(user_input, job))
+    
+    if st.session_state.get("job_asistente") is not None:
+        mostrar_respuesta_en_curso()
+
 
 # Variable para controlar la pestaña activa
 if "show_assistant" not in st.session_state:
@@ -51,42 +120,12 @@ with tabs[0]:
     
     # Mostrar asistente si se presionó el botón
     if st.session_state.show_assistant:
-        st.title("🤖 Asistente de AutoPartes")
-        
-        if "chat_historial" not in st.session_state:
-            st.session_state.chat_historial = []
-        
-        for msg in st.session_state.chat_historial:
-            st.chat_message(msg["role"]).write(msg["content"])
-        
-        user_input = st.chat_input("Describe tu problema aquí...")
-        if user_input:
-            st.session_state.chat_historial.append({"role": "user", "content": user_input})
-            st.chat_message("user").write(user_input)
-            
-            respuesta = "Gracias por la descripción. Parece que necesitas un *alternador* compatible con Nissan Altima 2015. Buscando..."
-            st.session_state.chat_historial.append({"role": "assistant", "content": respuesta})
-            st.chat_message("assistant").write(respuesta)
+        mostrar_asistente()
 
 # ---------------- ASISTENTE AI ----------------
 with tabs[1]:
     if not st.session_state.show_assistant:
-        st.title("🤖 Asistente de AutoPartes")
-        
-        if "chat_historial" not in st.session_state:
-            st.session_state.chat_historial = []
-        
-        for msg in st.session_state.chat_historial:
-            st.chat_message(msg["role"]).write(msg["content"])
-        
-        user_input = st.chat_input("Describe tu problema aquí...")
-        if user_input:
-            st.session_state.chat_historial.append({"role": "user", "content": user_input})
-            st.chat_message("user").write(user_input)
-            
-            respuesta = "Gracias por la descripción. Parece que necesitas un *alternador* compatible con Nissan Altima 2015. Buscando..."
-            st.session_state.chat_historial.append({"role": "assistant", "content": respuesta})
-            st.chat_message("assistant").write(respuesta)
+        mostrar_asistente()
     else:
         st.info("El asistente ya está activo en la pestaña de Inicio. Haz clic allí para continuar.")
 
@@ -95,17 +134,21 @@ with tabs[2]:
     st.title("📋 Resultados del Análisis")
     st.markdown("Aquí mostraremos las piezas compatibles que encontró el agente.")
 
-    filtro = catalogo_df[
-        (catalogo_df["Marca de Auto"] == "Nissan") &
-        (catalogo_df["Modelo"] == "Altima") &
-        (catalogo_df["Nombre de Pieza"] == "Alternador")
-    ]
+    filtro = buscador.filter_catalog(ARCHIVO_CATALOGO, {
+        "Marca de Auto": ["Nissan"],
+        "Modelo": ["Altima"],
+        "Nombre de Pieza": ["Alternador"]
+    })
 
     st.dataframe(filtro, use_container_width=True)
 
 # ---------------- CATÁLOGO COMPLETO ----------------
 with tabs[3]:
     st.title("📦 Catálogo Completo de Autopartes")
+    st.caption(
+        f"Catálogo en memoria: {reporte_compactacion['after_mb'] * 1024:.0f} KB "
+        f"(sin compactar: {reporte_compactacion['before_mb'] * 1024:.0f} KB)"
+    )
     
     # Filtros
     col1, col2, col3, col4 = st.columns(4)
@@ -119,14 +162,13 @@ with tabs[3]:
     with col4:
         precios = st.selectbox("Filtrar por precio", ["Todos", "Menor a $100", "$100-$200", "Mayor a $200"])
     
-    # Aplicar filtros
-    df_filtrado = catalogo_df.copy()
-    
-    if marcas:
-        df_filtrado = df_filtrado[df_filtrado["Marca de Auto"].isin(marcas)]
-    if modelos:
-        df_filtrado = df_filtrado[df_filtrado["Modelo"].isin(modelos)]
-    if piezas:
-        df_filtrado = df_filtrado[df_filtrado["Nombre de Pieza"].isin(piezas)]
+    # Aplicar filtros (la misma combinación de otra sesión o de un rerun sale de la caché)
+    df_filtrado = buscador.filter_catalog(ARCHIVO_CATALOGO, {
+        "Marca de Auto": marcas,
+        "Modelo": modelos,
+        "Nombre de Pieza": piezas
+    })
     
     st.dataframe(df_filtrado, use_container_width=True)
+    cache = buscador.query_cache.stats()
+    st.caption(f"Caché de consultas: {cache['hit_rate']:.0%} de aciertos ({cache['hits']}/{cache['hits'] + cache['misses']})")
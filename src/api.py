@@ -0,0 +1,291 @@
+"""
+Servicio HTTP (ASGI) de AutoPartes AI
+
+Ejecutar desde la carpeta src, con varios workers:
+    uvicorn api:app --host 0.0.0.0 --port 8000 --workers 4
+
+El historial de cada sesión vive en Redis (REDIS_URL), fuera del worker, por lo que
+cualquier worker o instancia puede atender cualquier turno.
+"""
+import os
+import json
+import base64
+import math
+import uuid
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager
+from datetime import date, timedelta
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+from fastapi import FastAPI, Header, HTTPException, Query
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from starlette.concurrency import iterate_in_threadpool
+
+from model import LocalCSVSearcher, NovaProChatbot, create_nova_pro_llm, SEARCH_TOP_K
+from sharded_search import ShardedCatalogSearcher
+from resilience import create_resilient_llm
+from single_flight import CoalescingLLM
+from session_store import create_session_store
+from conversation_archive import get_default_archive
+from profiling import profile_request, header_requests_profile
+from warmup import WarmUp, WarmUpStep
+from image_preprocessing import verify_image
+
+logger = logging.getLogger(__name__)
+
+CSV_FILE_NAME = os.getenv("AUTOPARTES_CSV", "base_autopartes_dummy.csv")
+# Catálogos de varios proveedores separados por coma (opcional): se busca en todos en paralelo
+CATALOG_FILES = [name.strip() for name in os.getenv("AUTOPARTES_CATALOGOS", "").split(",") if name.strip()]
+# Un proceso por catálogo en lugar de hilos (solo conviene con al menos un núcleo por catálogo)
+SHARD_PROCESSES = os.getenv("AUTOPARTES_SHARDS_EN_PROCESOS", "0") == "1"
+ASSETS_PATH = os.getenv("AUTOPARTES_ASSETS", "..")
+AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
+# Enviar una solicitud mínima al modelo durante el calentamiento (abre la conexión TLS y escribe
+# el prefijo del prompt en la caché de Bedrock, a cambio de unos pocos tokens por arranque)
+WARMUP_PRIMING = os.getenv("AUTOPARTES_WARMUP_PRIMING", "0") == "1"
+
+FACET_COLUMNS = ["Marca de Auto", "Modelo", "Nombre de Pieza"]
+
+# Recursos compartidos por todas las solicitudes del worker
+csv_searcher = LocalCSVSearcher(ASSETS_PATH)
+catalog_searcher = (ShardedCatalogSearcher(csv_searcher, CATALOG_FILES, processes=SHARD_PROCESSES)
+                    if CATALOG_FILES else None)
+session_store = create_session_store()
+archive = get_default_archive()
+_llm = None
+_llm_lock = threading.Lock()
+
+
+class ChatRequest(BaseModel):
+    message: str
+    session_id: Optional[str] = None
+    # Foto adjunta codificada en base64 (opcional)
+    imagen: Optional[str] = None
+
+
+class FacetRequest(BaseModel):
+    marcas: List[str] = Field(default_factory=list)
+    modelos: List[str] = Field(default_factory=list)
+    piezas: List[str] = Field(default_factory=list)
+    limit: int = 100
+
+
+def get_llm():
+    """Cliente del modelo compartido por el worker (modelo simulado si AUTOPARTES_OFFLINE=1)"""
+    global _llm
+    # El calentamiento y la primera solicitud pueden llegar a la vez
+    with _llm_lock:
+        if _llm is None:
+            if os.getenv("AUTOPARTES_OFFLINE"):
+                from stub_llm import StubBedrockLLM
+                _llm = StubBedrockLLM(model_id="amazon.nova-pro-v1:0")
+            else:
+                _llm = CoalescingLLM(create_resilient_llm(create_nova_pro_llm, AWS_REGION),
+                                     namespace="amazon.nova-pro-v1:0")
+    return _llm
+
+
+def _local_catalogs() -> List[str]:
+    """Catálogos que se cargan en este proceso (con SHARD_PROCESSES los de proveedores viven en sus procesos)"""
+    return list(dict.fromkeys([CSV_FILE_NAME, *([] if SHARD_PROCESSES else CATALOG_FILES)]))
+
+
+def _warm_catalog():
+    for file_name in _local_catalogs():
+        csv_searcher.load_csv_from_local(file_name)
+
+
+def _warm_indexes():
+    """Índices BM25 y una búsqueda de prueba por catálogo (recorre también el código de pandas)"""
+    for file_name in _local_catalogs():
+        csv_searcher.get_index(file_name)
+        csv_searcher.search_piece(file_name, "PZ0001", top_k=SEARCH_TOP_K)
+    if catalog_searcher is not None and SHARD_PROCESSES:
+        # Arranca el proceso de cada shard, que carga su catálogo y construye su índice
+        catalog_searcher.warm()
+
+
+def _warm_clients():
+    llm = get_llm()
+    if hasattr(llm, "create_clients"):
+        llm.create_clients()
+
+
+def _prime_model():
+    """Solicitud mínima con el prefijo estático del prompt"""
+    chatbot = NovaProChatbot(CSV_FILE_NAME, llm=get_llm(), csv_searcher=csv_searcher)
+    get_llm().invoke(chatbot._build_messages("Hola"))
+
+
+warmup = WarmUp([
+    WarmUpStep("catalogo", _warm_catalog),
+    WarmUpStep("indices", _warm_indexes),
+    WarmUpStep("clientes", _warm_clients),
+    *([WarmUpStep("modelo", _prime_model, required=False)] if WARMUP_PRIMING else [])
+])
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # El worker acepta conexiones de inmediato; /salud responde 503 hasta que termine
+    warmup.start()
+    yield
+    if catalog_searcher is not None:
+        catalog_searcher.close()
+
+
+app = FastAPI(title="AutoPartes AI", version="1.0.0", lifespan=lifespan)
+
+
+def _to_jsonable(value: Any) -> Any:
+    """Convierte tipos de numpy/pandas y NaN a valores serializables en JSON"""
+    if isinstance(value, dict):
+        return {str(key): _to_jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_jsonable(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+async def _load_chatbot(session_id: str) -> NovaProChatbot:
+    """Crea un chatbot ligero para el turno, con el historial de la sesión"""
+    chatbot = NovaProChatbot(CSV_FILE_NAME, llm=get_llm(), csv_searcher=csv_searcher,
+                             session_id=session_id, archive=archive, catalog_searcher=catalog_searcher)
+    chatbot.memory.messages = await session_store.load(session_id)
+    return chatbot
+
+
+def _decode_image(request: ChatRequest) -> Optional[bytes]:
+    """Bytes de la foto adjunta, si la hay"""
+    if not request.imagen:
+        return None
+    try:
+        raw = base64.b64decode(request.imagen, validate=True)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="La imagen debe estar codificada en base64")
+    # Se valida antes de responder: en /chat/stream los encabezados 200 ya se habrían enviado
+    try:
+        verify_image(raw)
+    except (ValueError, RuntimeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return raw
+
+
+@app.get("/salud")
+async def health() -> JSONResponse:
+    """Estado del servicio: 503 mientras el worker se calienta, para que el balanceador no le envíe tráfico"""
+    if not warmup.ready:
+        return JSONResponse(status_code=503, content={"status": "calentando", "warmup": warmup.status()})
+    return JSONResponse(content={
+        "status": "ok",
+        "warmup": warmup.status(),
+        "query_cache": csv_searcher.query_cache.stats()
+    })
+
+
+@app.get("/catalogo/buscar")
+async def search_catalog(q: str, columnas: Optional[str] = None,
+                         top_k: Optional[int] = Query(None, ge=1, le=100)) -> Dict[str, Any]:
+    """
+    Busca una pieza en el catálogo (columnas separadas por coma, opcional)
+
+    Con top_k retorna solo los resultados más relevantes (BM25 con bonos de marca, modelo y año).
+    """
+    search_columns = [column.strip() for column in columnas.split(",")] if columnas else None
+    if catalog_searcher is not None:
+        results = await asyncio.to_thread(catalog_searcher.search_piece, q, search_columns, top_k)
+    else:
+        results = await asyncio.to_thread(csv_searcher.search_piece, CSV_FILE_NAME, q, search_columns, top_k)
+    if results.get('error'):
+        raise HTTPException(status_code=500, detail=results['error'])
+    # Los textos por fila son para el contexto del modelo; row_data ya trae los mismos datos
+    return _to_jsonable({**results, 'results': [
+        {key: value for key, value in result.items() if key not in ('snippet', 'snippet_tokens')}
+        for result in results['results']
+    ]})
+
+
+@app.post("/catalogo/facetas")
+async def filter_catalog(request: FacetRequest) -> Dict[str, Any]:
+    """Filtra el catálogo por marca, modelo y pieza, y retorna los conteos por faceta"""
+    filters = {
+        "Marca de Auto": request.marcas,
+        "Modelo": request.modelos,
+        "Nombre de Pieza": request.piezas
+    }
+    df = await asyncio.to_thread(csv_searcher.filter_catalog, CSV_FILE_NAME, filters)
+
+    return _to_jsonable({
+        "total": len(df),
+        "results": df.head(request.limit).to_dict(orient="records"),
+        # En columnas categóricas value_counts incluye categorías sin filas: se omiten
+        "facets": {column: df[column].value_counts().loc[lambda counts: counts > 0].to_dict()
+                   for column in FACET_COLUMNS}
+    })
+
+
+@app.post("/chat")
+async def chat(request: ChatRequest, x_autopartes_profile: Optional[str] = Header(None)) -> Dict[str, Any]:
+    """Procesa un turno de conversación (con el header X-Autopartes-Profile: 1 se perfila el turno)"""
+    session_id = request.session_id or str(uuid.uuid4())
+    image_bytes = _decode_image(request)
+    chatbot = await _load_chatbot(session_id)
+    mark = chatbot.memory.total_added
+    force_profile = header_requests_profile(x_autopartes_profile)
+
+    def run_turn() -> Dict[str, Any]:
+        # El perfil se abre en el hilo que ejecuta el turno
+        with profile_request(session_id, uuid.uuid4().hex[:8], force=force_profile, label="api"):
+            return chatbot.chat(request.message, image_bytes)
+
+    result = await asyncio.to_thread(run_turn)
+    # Solo se agregan los mensajes de este turno: otro turno concurrente de la sesión no se pierde
+    await session_store.append(session_id, chatbot.memory.added_since(mark))
+
+    return _to_jsonable({"session_id": session_id, **result})
+
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest) -> StreamingResponse:
+    """Procesa un turno de conversación en streaming (NDJSON: un objeto por fragmento)"""
+    session_id = request.session_id or str(uuid.uuid4())
+    image_bytes = _decode_image(request)
+    chatbot = await _load_chatbot(session_id)
+    mark = chatbot.memory.total_added
+
+    async def events():
+        yield json.dumps({"session_id": session_id}) + "\n"
+        async for text in iterate_in_threadpool(chatbot.chat_stream(request.message, image_bytes)):
+            yield json.dumps({"delta": text}, ensure_ascii=False) + "\n"
+        await session_store.append(session_id, chatbot.memory.added_since(mark))
+        yield json.dumps({"done": True, "usage": chatbot.last_usage, "image": chatbot.last_image}) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
+@app.delete("/sesiones/{session_id}")
+async def delete_session(session_id: str) -> Dict[str, Any]:
+    """Elimina el historial de una sesión"""
+    await session_store.delete(session_id)
+    return {"session_id": session_id, "deleted": True}
+
+
+@app.get("/sesiones/{session_id}/exportar")
+async def export_session(session_id: str, desde: Optional[date] = None,
+                         hasta: Optional[date] = None) -> StreamingResponse:
+    """Exporta la transcripción archivada de una sesión en NDJSON (por defecto, los últimos 30 días)"""
+    hasta = hasta or date.today()
+    desde = desde or hasta - timedelta(days=30)
+    chunks = archive.export_chunks(desde, hasta, session_id=session_id)
+    return StreamingResponse(
+        iterate_in_threadpool(chunks),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="conversacion_{session_id}.ndjson"'}
+    )
@@ -0,0 +1,149 @@
+"""
+Compactación del catálogo en memoria al cargarlo
+
+pd.read_csv deja cada texto como un objeto str independiente por fila, aunque marcas, modelos,
+fabricantes y descripciones se repitan en todo el catálogo. Aquí se convierten las columnas de
+pocos valores distintos a categóricas (un código entero por fila y una sola copia de cada valor),
+se reducen los tipos numéricos, se internan los textos repetidos restantes y se agregan junto a
+las Dimensiones ("26x17x17 cm") tres columnas enteras para filtrar por medida. La columna original
+se conserva: es la que ven el modelo y la API, y con la que coinciden las búsquedas por texto.
+"""
+import sys
+import logging
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Una columna de texto es categórica si tiene a lo más esta proporción de valores distintos
+MAX_CATEGORY_RATIO = 0.5
+
+DIMENSIONS_COLUMN = "Dimensiones"
+DIMENSION_COLUMNS = ["Largo (cm)", "Ancho (cm)", "Alto (cm)"]
+DIMENSIONS_PATTERN = r"^\s*(\d+)\s*x\s*(\d+)\s*x\s*(\d+)\s*cm\s*$"
+
+
+def _is_text(series: pd.Series) -> bool:
+    return pd.api.types.is_object_dtype(series.dtype) or pd.api.types.is_string_dtype(series.dtype)
+
+
+def column_bytes(series: pd.Series) -> int:
+    """
+    Memoria de una columna en bytes
+
+    memory_usage(deep=True) suma el tamaño de cada str aunque varias filas compartan el mismo
+    objeto; aquí cada objeto distinto se cuenta una vez, más el arreglo de referencias.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype) or not _is_text(series):
+        return int(series.memory_usage(deep=True, index=False))
+    unique_objects = {id(value): value for value in series.to_numpy(dtype=object)}
+    return series.size * np.dtype(object).itemsize + sum(sys.getsizeof(value) for value in unique_objects.values())
+
+
+def memory_usage_mb(df: pd.DataFrame) -> float:
+    """Memoria del DataFrame (contando una vez cada objeto compartido) en MB"""
+    return sum(column_bytes(df[column]) for column in df.columns) / (1024 * 1024)
+
+
+def _add_dimension_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Agrega después de Dimensiones tres columnas enteras, solo si todas las filas tienen el formato esperado"""
+    if DIMENSIONS_COLUMN not in df.columns:
+        return df
+
+    parts = df[DIMENSIONS_COLUMN].astype(str).str.extract(DIMENSIONS_PATTERN)
+    if parts.isna().any().any():
+        logger.info("Dimensiones con formato inesperado: no se agregan las columnas numéricas")
+        return df
+
+    position = df.columns.get_loc(DIMENSIONS_COLUMN) + 1
+    for offset, (column, values) in enumerate(zip(DIMENSION_COLUMNS, parts.columns)):
+        df.insert(position + offset, column, pd.to_numeric(parts[values], downcast="unsigned"))
+    return df
+
+
+def _downcast_numeric(series: pd.Series) -> pd.Series:
+    """Usa el tipo numérico más pequeño que conserva los valores exactos"""
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return pd.to_numeric(series, downcast="integer")
+    if pd.api.types.is_float_dtype(series.dtype):
+        # Los precios con centavos no caben exactos en float32: solo se reduce si no se pierde nada
+        downcast = series.astype(np.float32)
+        if np.array_equal(downcast.astype(np.float64).to_numpy(), series.to_numpy(), equal_nan=True):
+            return downcast
+    return series
+
+
+def _intern_strings(series: pd.Series) -> pd.Series:
+    """Hace que los textos iguales compartan un solo objeto str"""
+    interned: Dict[str, str] = {}
+    return series.map(lambda value: interned.setdefault(value, sys.intern(value)) if isinstance(value, str) else value)
+
+
+def compact_catalog(df: pd.DataFrame, max_category_ratio: float = MAX_CATEGORY_RATIO,
+                    keep_text: Optional[List[str]] = None) -> Tuple[pd.DataFrame, Dict[str, Any]]:
+    """
+    Compacta el catálogo y reporta la memoria antes y después
+
+    Args:
+        df: Catálogo tal como lo entrega pd.read_csv
+        max_category_ratio: Proporción máxima de valores distintos para usar categóricas
+        keep_text: Columnas que no se convierten a categóricas (por defecto, la columna ID)
+
+    Returns:
+        (catálogo compacto, reporte con la memoria total y por columna en MB)
+    """
+    keep_text = keep_text if keep_text is not None else ["ID"]
+    before = {column: column_bytes(df[column]) for column in df.columns}
+
+    compact = _add_dimension_columns(df.copy())
+    for column in compact.columns:
+        series = compact[column]
+        if pd.api.types.is_numeric_dtype(series.dtype):
+            compact[column] = _downcast_numeric(series)
+        elif _is_text(series) and not isinstance(series.dtype, pd.CategoricalDtype):
+            distinct = series.nunique(dropna=True)
+            if column not in keep_text and distinct <= max_category_ratio * max(len(series), 1):
+                compact[column] = series.astype("category")
+            else:
+                compact[column] = _intern_strings(series)
+
+    after = {column: column_bytes(compact[column]) for column in compact.columns}
+    report = {
+        "rows": len(df),
+        "before_mb": sum(before.values()) / (1024 * 1024),
+        "after_mb": sum(after.values()) / (1024 * 1024),
+        "columns": {
+            column: {
+                "dtype": str(compact[column].dtype),
+                "before_mb": before.get(column, 0) / (1024 * 1024),
+                "after_mb": after.get(column, 0) / (1024 * 1024)
+            }
+            for column in dict.fromkeys([*df.columns, *compact.columns])
+        }
+    }
+    report["ratio"] = report["before_mb"] / max(report["after_mb"], 1e-9)
+    logger.info(
+        f"Catálogo compactado: {report['before_mb']:.2f} MB -> {report['after_mb']:.2f} MB "
+        f"({report['ratio']:.1f}x, {len(df)} filas)"
+    )
+    return compact, report
+
+
+def main(argv: List[str]):
+    """Muestra la memoria por columna antes y después de compactar un CSV"""
+    if len(argv) != 1:
+        print("Uso: python catalog_compaction.py <archivo.csv>")
+        sys.exit(1)
+
+    _, report = compact_catalog(pd.read_csv(argv[0]))
+    print(f"{'Columna':28} {'Tipo':12} {'Antes (KB)':>11} {'Después (KB)':>13}")
+    for column, stats in report["columns"].items():
+        print(f"{column:28} {stats['dtype']:12} {stats['before_mb'] * 1024:11.1f} {stats['after_mb'] * 1024:13.1f}")
+    print(f"Total: {report['before_mb']:.3f} MB -> {report['after_mb']:.3f} MB ({report['ratio']:.1f}x)")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
@@ -1,6 +1,6 @@
 # requirements.txt
 """
-streamlit>=1.28.0
+streamlit>=1.37.0
 langchain>=0.1.0
 langchain-aws>=0.1.0
 langchain-community>=0.0.20
@@ -12,18 +12,30 @@ python-dotenv>=1.0.0
 import streamlit as st
 import boto3
 import os
+import uuid
+import hashlib
+import zlib
+import threading
 from dotenv import load_dotenv
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterator
 from datetime import datetime
 import json
 
 # LangChain imports
 from langchain_aws import ChatBedrockConverse
 from langchain.memory import ConversationBufferWindowMemory
-from langchain.schema import BaseMessage, HumanMessage, AIMessage, SystemMessage
-from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain.schema import BaseMessage
 from langchain.callbacks.base import BaseCallbackHandler
-from langchain.schema.output import LLMResult
+
+from prompt_cache import construir_mensajes, extraer_uso_tokens
+from resilience import BEDROCK_CLIENT_CONFIG, REGIONES_BEDROCK, create_resilient_llm, model_for_region
+from model_router import ModelRouter, ROUTER_MODEL_ID
+from single_flight import CoalescingLLM
+from conversation_archive import ConversationArchive, get_default_archive
+from profiling import profile_request, header_requests_profile, PROFILE_HEADER
+from chat_jobs import ChatJob, JobCallbackHandler, DEFAULT_RUNNER
+from chat_window import visible_start
+from image_preprocessing import ImagePreprocessor, DEFAULT_PREPROCESSOR, PIL_AVAILABLE, to_content_block, image_metrics
 
 # Cargar variables de entorno
 load_dotenv()
@@ -36,21 +48,6 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Callback para mostrar streaming en tiempo real
-class StreamlitCallbackHandler(BaseCallbackHandler):
-    """Callback handler para mostrar respuestas en streaming"""
-    
-    def __init__(self, container):
-        self.container = container
-        self.text = ""
-    
-    def on_llm_new_token(self, token: str, **kwargs) -> None:
-        self.text += token
-        self.container.markdown(self.text + "▌")
-    
-    def on_llm_end(self, response: LLMResult, **kwargs) -> None:
-        self.container.markdown(self.text)
-
 def create_bedrock_llm(region_name="us-east-2", model_id="us.amazon.nova-lite-v1:0"):
     """Crear instancia de Nova Lite a través de Bedrock"""
     return ChatBedrockConverse(
@@ -59,11 +56,7 @@ def create_bedrock_llm(region_name="us-east-2", model_id="us.amazon.nova-lite-v1
             region_name=region_name,
             aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
             aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-            config=boto3.session.Config(
-                read_timeout=300,  # 5 minutos
-                connect_timeout=60,  # 1 minuto
-                retries={'max_attempts': 2}
-            )
+            config=BEDROCK_CLIENT_CONFIG
         ),
         model=model_id,
         max_tokens=7000,
@@ -76,7 +69,9 @@ class NovaLiteChatbot:
     """Clase principal del chatbot usando AWS Nova Lite"""
     
     def __init__(self, region_name: str = "us-east-2", model_id: str = "us.amazon.nova-lite-v1:0", 
-                 memory_size: int = 10, system_prompt: str = None):
+                 memory_size: int = 10, system_prompt: str = None, llm: Optional[Any] = None,
+                 archive: Optional[ConversationArchive] = None,
+                 image_preprocessor: Optional[ImagePreprocessor] = None):
         """
         Inicializar el chatbot
         
@@ -85,13 +80,21 @@ class NovaLiteChatbot:
             model_id: ID del modelo Nova Lite
             memory_size: Cantidad de mensajes a recordar
             system_prompt: Prompt del sistema personalizado
+            llm: Modelo ya construido (por ejemplo StubBedrockLLM para pruebas sin AWS)
+            archive: Archivo comprimido donde se registra cada turno (opcional)
+            image_preprocessor: Preprocesador de fotos (por defecto, el compartido del proceso)
         """
         self.region_name = region_name
+        self.archive = archive
+        self.image_preprocessor = image_preprocessor or DEFAULT_PREPROCESSOR
+        self.session_id = str(uuid.uuid4())
         self.model_id = model_id
         self.memory_size = memory_size
+        # Protege la memoria entre el hilo del turno en segundo plano y "Limpiar conversación"
+        self._memory_lock = threading.Lock()
         
-        # Crear instancia del modelo
-        self.llm = create_bedrock_llm(region_name, model_id)
+        # Crear instancia del modelo (con plazo, reintentos y hedging entre regiones)
+        self.llm = llm or self._create_llm()
         
         # Configurar memoria conversacional
         self.memory = ConversationBufferWindowMemory(
@@ -99,18 +102,39 @@ class NovaLiteChatbot:
             return_messages=True
         )
         
-        # Sistema de prompts
+        # Sistema de prompts (prefijo estático, se cachea en Bedrock)
         self.system_prompt = system_prompt or self._default_system_prompt()
-        self.prompt_template = self._create_prompt_template()
         
         # Estadísticas
         self.stats = {
             "total_messages": 0,
             "total_tokens_estimated": 0,
+            "total_input_tokens": 0,
+            "total_cached_input_tokens": 0,
+            "total_cache_write_tokens": 0,
+            "total_images": 0,
+            "total_image_bytes": 0,
             "session_start": datetime.now(),
             "last_interaction": None
         }
     
+    def _create_llm(self):
+        """Crear el cliente resiliente, o el enrutador de modelos si model_id es "auto" """
+        def resilient_factory(model_id: str):
+            # El limitador de concurrencia es del proceso, no de la sesión
+            return create_resilient_llm(
+                lambda region: create_bedrock_llm(region, model_for_region(model_id, region)),
+                self.region_name,
+                shared_key=model_id
+            )
+        
+        if self.model_id == ROUTER_MODEL_ID:
+            llm = ModelRouter(resilient_factory)
+        else:
+            llm = resilient_factory(self.model_id)
+        # Preguntas idénticas concurrentes de distintas sesiones comparten una sola llamada
+        return CoalescingLLM(llm, namespace=self.model_id)
+    
     def _default_system_prompt(self) -> str:
         """Prompt del sistema por defecto"""
         return """
@@ -220,25 +244,30 @@ Estado: Nuevo
 
 """
     
-    def _create_prompt_template(self) -> ChatPromptTemplate:
-        """Crear template de prompt con memoria"""
-        return ChatPromptTemplate.from_messages([
-            ("system", self.system_prompt),
-            MessagesPlaceholder(variable_name="history"),
-            ("human", "{input}")
-        ])
-    
-    def chat(self, user_input: str, callback_handler: Optional[BaseCallbackHandler] = None) -> Dict[str, Any]:
+    def chat(self, user_input: str, callback_handler: Optional[BaseCallbackHandler] = None,
+             imagen: Optional[bytes] = None, force_profile: bool = False) -> Dict[str, Any]:
         """
         Procesar un mensaje del usuario
         
         Args:
             user_input: Mensaje del usuario
             callback_handler: Handler para streaming (opcional)
+            imagen: Foto adjunta en bytes, por ejemplo del testigo del tablero (opcional)
+            force_profile: Perfilar el turno aunque el muestreo no lo elija (?perfil=1 o header)
             
         Returns:
             Diccionario con la respuesta y metadata
         """
+        with profile_request(self.session_id, self.stats["total_messages"] + 1,
+                             force=force_profile, label="nova_lite"):
+            return self._chat(user_input, callback_handler, imagen)
+    
+    def _chat(self, user_input: str, callback_handler: Optional[BaseCallbackHandler],
+              imagen: Optional[bytes]) -> Dict[str, Any]:
+        """Turno de chat (ver chat)"""
+        # Si la conversación se limpia mientras el modelo responde, el session_id cambia
+        # y el turno se descarta en lugar de escribirse en la conversación nueva
+        session_id = self.session_id
         try:
             start_time = datetime.now()
             
@@ -248,18 +277,38 @@ Estado: Nuevo
             # Obtener historial de mensajes
             history = self.memory.chat_memory.messages
             
-            # Crear el prompt completo
-            formatted_prompt = self.prompt_template.format_messages(
-                input=user_input,
-                history=history
+            # Preprocesar la foto adjunta (orientación, tamaño y recodificación, con caché por hash)
+            image = self.image_preprocessor.process(imagen) if imagen else None
+            user_content = user_input
+            if image:
+                user_content = [{"type": "text", "text": user_input}, to_content_block(image)]
+            
+            # Crear el prompt completo: prefijo estático cacheable + historial + mensaje nuevo
+            formatted_prompt = construir_mensajes(
+                self.system_prompt,
+                user_content,
+                self.model_id,
+                historial=history
             )
             
             # Llamar al LLM directamente
             response = self.llm.invoke(formatted_prompt, config={"callbacks": callbacks})
+            usage = extraer_uso_tokens(response)
             
-            # Guardar en memoria
-            self.memory.chat_memory.add_user_message(user_input)
-            self.memory.chat_memory.add_ai_message(response.content)
+            with self._memory_lock:
+                if self.session_id != session_id:
+                    raise RuntimeError("la conversación se limpió mientras el modelo respondía")
+                
+                # Guardar en memoria (solo el texto: la imagen no se reenvía en los turnos siguientes)
+                self.memory.chat_memory.add_user_message(user_input)
+                self.memory.chat_memory.add_ai_message(response.content)
+            
+            # Registrar el turno en el archivo de conversaciones (asíncrono)
+            if self.archive is not None:
+                self.archive.record(session_id, "user", user_input, app="nova_lite",
+                                    image=image_metrics(image) if image else None)
+                self.archive.record(session_id, "assistant", response.content, app="nova_lite",
+                                    model_id=self.model_id, usage=usage)
             
             end_time = datetime.now()
             processing_time = (end_time - start_time).total_seconds()
@@ -267,11 +316,19 @@ Estado: Nuevo
             # Actualizar estadísticas
             self.stats["total_messages"] += 1
             self.stats["total_tokens_estimated"] += len(user_input.split()) + len(response.content.split())
+            self.stats["total_input_tokens"] += usage["input_tokens"]
+            self.stats["total_cached_input_tokens"] += usage["cached_input_tokens"]
+            self.stats["total_cache_write_tokens"] += usage["cache_write_tokens"]
             self.stats["last_interaction"] = end_time
+            if image:
+                self.stats["total_images"] += 1
+                self.stats["total_image_bytes"] += image["payload_bytes"]
             
             return {
                 "response": response.content,
                 "processing_time": processing_time,
+                "usage": usage,
+                "image": image_metrics(image) if image else None,
                 "timestamp": end_time.isoformat(),
                 "user_input": user_input,
                 "success": True,
@@ -284,6 +341,8 @@ Estado: Nuevo
             return {
                 "response": "Lo siento, hubo un error al procesar tu mensaje. Por favor, intenta de nuevo.",
                 "processing_time": 0,
+                "usage": None,
+                "image": None,
                 "timestamp": datetime.now().isoformat(),
                 "user_input": user_input,
                 "success": False,
@@ -295,10 +354,17 @@ Estado: Nuevo
         return self.memory.chat_memory.messages
     
     def clear_memory(self):
-        """Limpiar memoria conversacional"""
-        self.memory.clear()
+        """Limpiar memoria conversacional (un turno en curso se descarta al terminar)"""
+        with self._memory_lock:
+            self.memory.clear()
+            self.session_id = str(uuid.uuid4())
         self.stats["total_messages"] = 0
         self.stats["total_tokens_estimated"] = 0
+        self.stats["total_input_tokens"] = 0
+        self.stats["total_cached_input_tokens"] = 0
+        self.stats["total_cache_write_tokens"] = 0
+        self.stats["total_images"] = 0
+        self.stats["total_image_bytes"] = 0
         self.stats["session_start"] = datetime.now()
     
     def get_stats(self) -> Dict[str, Any]:
@@ -312,11 +378,16 @@ Estado: Nuevo
             "avg_tokens_per_message": (
                 self.stats["total_tokens_estimated"] / max(self.stats["total_messages"], 1)
             ),
+            "cache_hit_ratio": (
+                self.stats["total_cached_input_tokens"] / max(self.stats["total_input_tokens"], 1)
+            ),
             "model_info": {
                 "model_id": self.model_id,
                 "region": self.region_name,
                 "memory_size": self.memory_size
-            }
+            },
+            "invocation": self.llm.get_stats() if hasattr(self.llm, "get_stats") else None,
+            "routing": self.llm.get_routing_stats() if hasattr(self.llm, "get_routing_stats") else None
         }
     
     def export_conversation(self) -> str:
@@ -336,6 +407,38 @@ Estado: Nuevo
         }
         
         return json.dumps(export_data, indent=2, ensure_ascii=False)
+    
+    def export_conversation_chunks(self) -> Iterator[bytes]:
+        """
+        Exportar la sesión como NDJSON en fragmentos
+        
+        Lee del archivo de conversaciones, así la exportación no depende del tamaño de la
+        memoria del chatbot; sin archivo, exporta el historial en memoria.
+        """
+        if self.archive is not None:
+            yield from self.archive.export_chunks(
+                self.stats["session_start"].date(), datetime.now().date(), session_id=self.session_id
+            )
+            return
+        
+        for message in self.get_conversation_history():
+            yield (json.dumps({
+                "session_id": self.session_id,
+                "role": "user" if message.type == "human" else "assistant",
+                "content": message.content
+            }, ensure_ascii=False) + "\n").encode("utf-8")
+    
+    def export_conversation_gzip(self) -> bytes:
+        """
+        Exportar la sesión como NDJSON comprimido con gzip
+        
+        Los fragmentos se comprimen conforme llegan: en memoria solo queda el resultado
+        comprimido (el botón de descarga de Streamlit siempre guarda el archivo completo).
+        """
+        compressor = zlib.compressobj(wbits=31)
+        parts = [compressor.compress(chunk) for chunk in self.export_conversation_chunks()]
+        parts.append(compressor.flush())
+        return b"".join(parts)
 
 # Funciones de la interfaz Streamlit
 def initialize_chatbot() -> NovaLiteChatbot:
@@ -347,20 +450,22 @@ def initialize_chatbot() -> NovaLiteChatbot:
         
         region = st.selectbox(
             "Región AWS",
-            ["us-east-2", "us-east-1", "us-west-2", "eu-west-1"],
+            REGIONES_BEDROCK,
             index=0
         )
         
         model_options = [
             "us.amazon.nova-lite-v1:0",
             "us.amazon.nova-micro-v1:0",
-            "us.amazon.nova-pro-v1:0"
+            "us.amazon.nova-pro-v1:0",
+            ROUTER_MODEL_ID
         ]
         
         model_id = st.selectbox(
             "Modelo Nova",
             model_options,
-            index=0
+            index=0,
+            format_func=lambda option: "Automático (según la consulta)" if option == ROUTER_MODEL_ID else option
         )
         
         memory_size = st.slider(
@@ -383,10 +488,43 @@ def initialize_chatbot() -> NovaLiteChatbot:
         region_name=region,
         model_id=model_id,
         memory_size=memory_size,
-        system_prompt=custom_prompt if custom_prompt else None
+        system_prompt=custom_prompt if custom_prompt else None,
+        archive=get_default_archive()
     )
 
-def display_chat_interface(chatbot: NovaLiteChatbot):
+def render_turn_details(metadata: Dict[str, Any]) -> str:
+    """Markdown de los detalles de un turno (un solo elemento en lugar de columnas y captions)"""
+    lines = [
+        f"**Tiempo:** {metadata.get('processing_time', 0):.2f}s · "
+        f"**Estado:** {'✅' if metadata.get('success') else '❌'} · "
+        f"**Timestamp:** {metadata.get('timestamp', '')[:19]}"
+    ]
+    
+    if metadata.get('redraws') is not None:
+        lines.append(f"Redibujados: {metadata['redraws']} para {metadata['streamed_tokens']} tokens")
+    
+    image = metadata.get('image')
+    if image:
+        lines.append(
+            f"📷 Imagen: {image['original_bytes'] / 1024:.0f} KB → {image['payload_bytes'] / 1024:.0f} KB "
+            f"({image['width']}x{image['height']}) en {image['preprocess_seconds'] * 1000:.0f} ms"
+            f"{' (caché)' if image['cached'] else ''}"
+        )
+    
+    usage = metadata.get('usage')
+    if usage:
+        lines.append(
+            f"Tokens de entrada: {usage['input_tokens']} "
+            f"(caché: {usage['cached_input_tokens']}, sin caché: {usage['uncached_input_tokens']}) · "
+            f"salida: {usage['output_tokens']}"
+        )
+    
+    if not metadata.get('success') and metadata.get('error'):
+        lines.append(f"❌ **Error:** {metadata['error']}")
+    
+    return "\n\n".join(lines)
+
+def display_chat_interface(chatbot: NovaLiteChatbot, force_profile: bool = False):
     """Mostrar interfaz principal del chat"""
     
     # Título y descripción
@@ -415,6 +553,21 @@ def display_chat_interface(chatbot: NovaLiteChatbot):
         with col2:
             st.metric("Tokens aprox.", stats["total_tokens_estimated"])
             st.metric("Promedio tokens", round(stats["avg_tokens_per_message"]))
+        st.metric("Tokens en caché", stats["total_cached_input_tokens"],
+                  help=f"{stats['cache_hit_ratio']:.0%} de los tokens de entrada")
+        if stats["invocation"]:
+            st.caption(
+                f"Reintentos: {stats['invocation']['retries']} · "
+                f"Solicitudes duplicadas: {stats['invocation']['hedges']} "
+                f"({stats['invocation']['hedge_wins']} ganadas)"
+            )
+        if stats["routing"]:
+            st.subheader("🔀 Enrutamiento")
+            for routed_model, routed_stats in stats["routing"].items():
+                st.caption(
+                    f"**{routed_model}**: {routed_stats['calls']} turnos ({routed_stats['share']:.0%}) · "
+                    f"p50 {routed_stats['p50_latency']:.2f}s · {routed_stats['output_tokens']} tokens de salida"
+                )
         
         # Botones de control
         st.header("🛠️ Controles")
@@ -422,16 +575,21 @@ def display_chat_interface(chatbot: NovaLiteChatbot):
         if st.button("🗑️ Limpiar conversación"):
             chatbot.clear_memory()
             st.session_state.chat_history = []
+            st.session_state.pop("ventana_chat", None)
+            pending = st.session_state.pop("pending_job", None)
+            if pending is not None:
+                DEFAULT_RUNNER.cancel(pending["id"])
             st.rerun()
         
-        if st.button("💾 Exportar conversación"):
-            export_data = chatbot.export_conversation()
-            st.download_button(
-                label="📥 Descargar JSON",
-                data=export_data,
-                file_name=f"conversacion_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
-                mime="application/json"
-            )
+        # La exportación se genera solo al hacer clic (data es una función), ya comprimida;
+        # para transcripciones muy largas la API la entrega en streaming en /sesiones/{id}/exportar
+        st.download_button(
+            label="💾 Exportar conversación",
+            data=chatbot.export_conversation_gzip,
+            file_name=f"conversacion_{chatbot.session_id}.ndjson.gz",
+            mime="application/gzip",
+            on_click="ignore"
+        )
     
     # Área principal del chat
     st.header("💬 Conversación")
@@ -439,62 +597,109 @@ def display_chat_interface(chatbot: NovaLiteChatbot):
     # Container para el historial
     chat_container = st.container()
     
-    # Mostrar historial
+    # Mostrar solo los últimos turnos: el costo de cada rerun no crece con la conversación
     with chat_container:
-        for i, (user_msg, bot_response, metadata) in enumerate(st.session_state.chat_history):
+        history = st.session_state.chat_history
+        start = visible_start("ventana_chat", len(history))
+        for user_msg, bot_response, metadata in history[start:]:
             # Mensaje del usuario
             with st.chat_message("user"):
-                st.write(user_msg)
+                st.markdown(user_msg)
             
-            # Respuesta del bot
+            # Respuesta del bot, con los detalles en un solo bloque de markdown
             with st.chat_message("assistant"):
-                st.write(bot_response)
-                
-                # Mostrar metadata en expander
+                st.markdown(bot_response)
                 with st.expander("ℹ️ Detalles"):
-                    col1, col2, col3 = st.columns(3)
-                    with col1:
-                        st.write(f"**Tiempo:** {metadata.get('processing_time', 0):.2f}s")
-                    with col2:
-                        st.write(f"**Estado:** {'✅' if metadata.get('success') else '❌'}")
-                    with col3:
-                        st.write(f"**Timestamp:** {metadata.get('timestamp', '')[:19]}")
-                    
-                    if not metadata.get('success') and metadata.get('error'):
-                        st.error(f"Error: {metadata['error']}")
-    
-    # Input para nuevo mensaje
-    user_input = st.chat_input("Escribe tu mensaje aquí...")
-    
-    if user_input:
-        # Crear container para respuesta en streaming
-        response_container = st.empty()
+                    st.markdown(render_turn_details(metadata))
+    
+    # Foto opcional (por ejemplo, del testigo encendido en el tablero)
+    uploaded_image = None
+    if PIL_AVAILABLE:
+        uploaded_image = st.file_uploader(
+            "📷 Adjuntar foto del tablero (opcional)",
+            type=["jpg", "jpeg", "png", "webp"]
+        )
+    
+    # Input para nuevo mensaje (deshabilitado mientras hay un turno en curso)
+    pending = st.session_state.get("pending_job")
+    user_input = st.chat_input("Escribe tu mensaje aquí...", disabled=pending is not None)
+    
+    if user_input and pending is None:
+        # La foto sigue en el uploader entre reruns: solo se adjunta si es distinta a la última enviada
+        image_bytes = uploaded_image.getvalue() if uploaded_image else None
+        if image_bytes:
+            image_hash = hashlib.sha256(image_bytes).hexdigest()
+            if st.session_state.get("last_image_hash") == image_hash:
+                image_bytes = None
+            else:
+                st.session_state.last_image_hash = image_hash
         
-        # Mostrar mensaje del usuario inmediatamente
-        with st.chat_message("user"):
-            st.write(user_input)
+        # El turno corre en segundo plano: el resto de la página sigue respondiendo y un rerun
+        # no repite la llamada, porque la sesión solo guarda el job id
+        def run_turn(job: ChatJob) -> Dict[str, Any]:
+            return chatbot.chat(user_input, JobCallbackHandler(job), imagen=image_bytes,
+                                force_profile=force_profile)
         
-        # Procesar respuesta con streaming
-        with st.chat_message("assistant"):
-            # Container para el streaming
-            streaming_container = st.empty()
-            
-            # Crear callback handler para streaming
-            callback_handler = StreamlitCallbackHandler(streaming_container)
-            
-            # Procesar mensaje
-            with st.spinner("🤔 Pensando..."):
-                result = chatbot.chat(user_input, callback_handler)
-            
-            # Agregar al historial
-            st.session_state.chat_history.append((
-                user_input,
-                result["response"],
-                result
-            ))
+        st.session_state.pending_job = {
+            "id": DEFAULT_RUNNER.submit(run_turn),
+            "user_input": user_input,
+            "image": image_bytes
+        }
+    
+    if st.session_state.get("pending_job") is not None:
+        display_pending_turn()
+
+@st.fragment(run_every=0.3)
+def display_pending_turn():
+    """Mostrar el turno en curso; solo este fragmento se redibuja mientras el modelo responde"""
+    pending = st.session_state.get("pending_job")
+    if pending is None:
+        return
+    job = DEFAULT_RUNNER.get(pending["id"])
+    
+    with st.chat_message("user"):
+        st.write(pending["user_input"])
+        if pending["image"]:
+            st.image(pending["image"], width=240)
+    
+    with st.chat_message("assistant"):
+        if job is None:
+            # El proceso se reinició y el job ya no existe
+            st.warning("La respuesta en curso se perdió. Por favor, envía tu mensaje de nuevo.")
+            del st.session_state.pending_job
+            return
         
-        # Rerun para mostrar la conversación actualizada
-        st.rerun()
+        job.polls += 1
+        if not job.done:
+            text = job.partial_text
+            st.markdown(text + "▌" if text else "🤔 Pensando...")
+            return
+    
+    DEFAULT_RUNNER.pop(job.id)
+    del st.session_state.pending_job
+    
+    result = job.result
+    if job.status == "error":
+        result = {
+            "response": "Lo siento, hubo un error al procesar tu mensaje. Por favor, intenta de nuevo.",
+            "processing_time": 0,
+            "usage": None,
+            "image": None,
+            "timestamp": datetime.now().isoformat(),
+            "user_input": pending["user_input"],
+            "success": False,
+            "error": job.error
+        }
+    result["redraws"] = job.polls
+    result["streamed_tokens"] = job.tokens
+    
+    # Agregar al historial y volver a dibujar la conversación completa
+    st.session_state.chat_history.append((
+        pending["user_input"],
+        result["response"],
+        result
+    ))
+    st.rerun()
 
 def display_examples():
     """Mostrar ejemplos de uso"""
@@ -521,40 +726,48 @@ def main():
         if 'chatbot' not in st.session_state:
             st.session_state.chatbot = initialize_chatbot()
         
-        # Tabs principales
-        tab1, tab2, tab3 = st.tabs(["💬 Chat", "💡 Ejemplos", "📖 Ayuda"])
+        # Perfilado opcional del rerun completo (header X-Autopartes-Profile o ?perfil=1)
+        chatbot = st.session_state.chatbot
+        headers = getattr(getattr(st, "context", None), "headers", None) or {}
+        force_profile = (header_requests_profile(headers.get(PROFILE_HEADER))
+                         or header_requests_profile(st.query_params.get("perfil")))
         
-        with tab1:
-            display_chat_interface(st.session_state.chatbot)
-        
-        with tab2:
-            display_examples()
+        with profile_request(chatbot.session_id, chatbot.stats["total_messages"] + 1,
+                             force=force_profile, label="rerun"):
+            # Tabs principales
+            tab1, tab2, tab3 = st.tabs(["💬 Chat", "💡 Ejemplos", "📖 Ayuda"])
+            
+            with tab1:
+                display_chat_interface(chatbot, force_profile)
+            
+            with tab2:
+                display_examples()
         
-        with tab3:
-            st.header("📖 Guía de uso")
-            st.markdown("""
-            ### 🚀 Cómo usar el chatbot:
+            with tab3:
+                st.header("📖 Guía de uso")
+                st.markdown("""
+                ### 🚀 Cómo usar el chatbot:
             
-            1. **Configuración**: Ajusta el modelo y parámetros en la barra lateral
-            2. **Credenciales**: Asegúrate de tener configuradas las variables de entorno AWS
-            3. **Conversación**: Escribe tu mensaje en el campo de texto inferior
-            4. **Memoria**: El bot recuerda conversaciones anteriores según la configuración
-            5. **Exportar**: Puedes descargar el historial de conversación
+                1. **Configuración**: Ajusta el modelo y parámetros en la barra lateral
+                2. **Credenciales**: Asegúrate de tener configuradas las variables de entorno AWS
+                3. **Conversación**: Escribe tu mensaje en el campo de texto inferior
+                4. **Memoria**: El bot recuerda conversaciones anteriores según la configuración
+                5. **Exportar**: Puedes descargar el historial de conversación
             
-            ### 🔧 Variables de entorno requeridas:
-            ```
-            AWS_ACCESS_KEY_ID=tu_access_key
-            AWS_SECRET_ACCESS_KEY=tu_secret_key
-            ```
+                ### 🔧 Variables de entorno requeridas:
+                ```
+                AWS_ACCESS_KEY_ID=tu_access_key
+                AWS_SECRET_ACCESS_KEY=tu_secret_key
+                ```
             
-            ### 📊 Características:
-            - ✅ Memoria conversacional configurable
-            - ✅ Streaming de respuestas en tiempo real
-            - ✅ Estadísticas de uso detalladas
-            - ✅ Exportación de conversaciones
-            - ✅ Múltiples modelos Nova disponibles
-            - ✅ Configuración flexible de prompts
-            """)
+                ### 📊 Características:
+                - ✅ Memoria conversacional configurable
+                - ✅ Streaming de respuestas en tiempo real
+                - ✅ Estadísticas de uso detalladas
+                - ✅ Exportación de conversaciones
+                - ✅ Múltiples modelos Nova disponibles
+                - ✅ Configuración flexible de prompts
+                """)
     
     except Exception as e:
         st.error(f"❌ Error al inicializar la aplicación: {str(e)}")
@@ -0,0 +1,134 @@
+"""
+Ejecución de turnos de chat en segundo plano
+
+El turno corre en un pool de hilos compartido por el proceso y se identifica con un job id que
+la sesión de Streamlit guarda en session_state. La interfaz solo vuelve a dibujar el fragmento
+del chat mientras el job avanza; si el script se vuelve a ejecutar (por ejemplo al usar los
+filtros del catálogo) el job sigue en curso y no se repite la llamada al modelo.
+"""
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Callable
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+logger = logging.getLogger(__name__)
+
+# Tiempo que se conservan los jobs terminados que nadie recogió
+FINISHED_JOB_TTL = 600
+
+
+class ChatJob:
+    """Estado de un turno en segundo plano: texto parcial, resultado o error"""
+
+    def __init__(self, job_id: str):
+        self.id = job_id
+        self.status = "pending"
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.created_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+        self.polls = 0
+        self.cancelled = False
+
+        self._parts: List[str] = []
+        self._lock = threading.Lock()
+
+    def append(self, text: str):
+        """Agrega texto parcial (llamado desde el hilo del job); se ignora si el job se canceló"""
+        with self._lock:
+            if not self.cancelled:
+                self._parts.append(text)
+
+    @property
+    def partial_text(self) -> str:
+        with self._lock:
+            return "".join(self._parts)
+
+    @property
+    def tokens(self) -> int:
+        with self._lock:
+            return len(self._parts)
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("done", "error")
+
+
+class JobCallbackHandler(BaseCallbackHandler):
+    """Envía los tokens del modelo al texto parcial del job"""
+
+    def __init__(self, job: ChatJob):
+        self.job = job
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        self.job.append(token)
+
+
+class ChatJobRunner:
+    """Pool de hilos con registro de jobs por id"""
+
+    def __init__(self, max_workers: int = 8):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chat-job")
+        self._jobs: Dict[str, ChatJob] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, fn: Callable[[ChatJob], Any]) -> str:
+        """
+        Ejecuta fn(job) en segundo plano y retorna el job id
+
+        fn recibe el job para publicar texto parcial (por ejemplo con JobCallbackHandler).
+        """
+        job = ChatJob(uuid.uuid4().hex)
+        with self._lock:
+            self._evict_finished()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn)
+        return job.id
+
+    def _run(self, job: ChatJob, fn: Callable[[ChatJob], Any]):
+        job.status = "running"
+        try:
+            job.result = fn(job)
+            job.status = "done"
+        except Exception as e:
+            logger.error(f"Error en el job {job.id}: {str(e)}")
+            job.error = str(e)
+            job.status = "error"
+        job.finished_at = time.monotonic()
+
+    def get(self, job_id: str) -> Optional[ChatJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def pop(self, job_id: str) -> Optional[ChatJob]:
+        """Retira un job terminado del registro"""
+        with self._lock:
+            return self._jobs.pop(job_id, None)
+
+    def cancel(self, job_id: str) -> Optional[ChatJob]:
+        """
+        Marca el job como cancelado y lo retira del registro
+
+        La llamada al modelo no se interrumpe: el hilo termina el turno y su resultado se
+        descarta (fn debe comprobar que su sesión sigue vigente antes de escribir en ella).
+        """
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+        if job is not None:
+            job.cancelled = True
+        return job
+
+    def _evict_finished(self):
+        now = time.monotonic()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and now - job.finished_at > FINISHED_JOB_TTL]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+# Compartido por todas las sesiones del proceso
+DEFAULT_RUNNER = ChatJobRunner()
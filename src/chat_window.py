@@ -0,0 +1,45 @@
+"""
+Dibujo por ventana del historial de chat en Streamlit
+
+Cada rerun vuelve a ejecutar el script completo, así que dibujar todo el historial hace que cada
+interacción sea más lenta conforme crece la conversación. Aquí solo se dibujan los últimos turnos,
+con un botón para cargar los anteriores; cuando llega un turno nuevo la ventana vuelve a su tamaño
+inicial, así un historial abierto una vez no se sigue dibujando completo el resto de la sesión.
+"""
+import streamlit as st
+
+# Turnos visibles al inicio y turnos que agrega cada clic en "Cargar mensajes anteriores"
+VISIBLE_TURNS = 20
+LOAD_MORE_TURNS = 20
+
+
+def _load_more(state_key: str, items: int):
+    st.session_state[state_key] += items
+
+
+def visible_start(state_key: str, total: int, items_per_turn: int = 1) -> int:
+    """
+    Índice del primer elemento visible del historial
+
+    Dibuja el botón para cargar mensajes anteriores si hay elementos ocultos. El botón usa
+    on_click, así el tamaño de la ventana ya está actualizado cuando se ejecuta el script.
+
+    Args:
+        state_key: Clave de session_state con el tamaño de la ventana
+        total: Elementos en el historial
+        items_per_turn: Elementos por turno (2 si el historial guarda usuario y asistente por separado)
+    """
+    total_key = f"{state_key}_total"
+    if state_key not in st.session_state or total > st.session_state.get(total_key, total):
+        st.session_state[state_key] = VISIBLE_TURNS * items_per_turn
+    st.session_state[total_key] = total
+
+    start = max(total - st.session_state[state_key], 0)
+    if start > 0:
+        st.button(
+            f"⬆️ Cargar mensajes anteriores ({start // items_per_turn} turnos ocultos)",
+            key=f"{state_key}_anteriores",
+            on_click=_load_more,
+            args=(state_key, LOAD_MORE_TURNS * items_per_turn)
+        )
+    return start
@@ -0,0 +1,202 @@
+"""
+Archivo de conversaciones: NDJSON comprimido con gzip, solo de anexado
+
+Cada proceso escribe sus propios archivos diarios (conversaciones-AAAAMMDD-<pid>.ndjson.gz) desde
+un hilo en segundo plano, así el turno de chat nunca espera al disco. Cada lote se agrega como
+un miembro gzip nuevo, lo que mantiene el archivo válido aunque el proceso termine a mitad.
+
+Exportar todas las sesiones de un rango de fechas desde la carpeta src:
+    python conversation_archive.py 2026-10-01 2026-10-19 export.ndjson.gz
+"""
+import os
+import sys
+import glob
+import gzip
+import json
+import time
+import heapq
+import queue
+import atexit
+import logging
+import threading
+from datetime import date, datetime, timedelta
+from typing import List, Dict, Any, Optional, Iterator
+
+logger = logging.getLogger(__name__)
+
+# Tamaño de cada fragmento al exportar
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+# Espera máxima a que se escriba lo pendiente antes de exportar (segundos)
+EXPORT_FLUSH_TIMEOUT = 5.0
+
+
+class ConversationArchive:
+    """Registro de conversaciones comprimido, escrito de forma asíncrona"""
+
+    def __init__(self, directory: str = "conversaciones", flush_interval: float = 1.0, max_batch: int = 500):
+        """
+        Args:
+            directory: Carpeta donde se guardan los archivos diarios
+            flush_interval: Espera máxima antes de escribir un lote (segundos)
+            max_batch: Registros máximos por lote
+        """
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        os.makedirs(directory, exist_ok=True)
+
+        self._queue: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        self._stop = threading.Event()
+        self._writer = threading.Thread(target=self._run, daemon=True, name="conversation-archive")
+        self._writer.start()
+        atexit.register(self.close)
+
+    def record(self, session_id: str, role: str, content: str, **extra: Any):
+        """Agrega un mensaje al archivo sin bloquear al llamador"""
+        self._queue.put({
+            "timestamp": datetime.now().isoformat(),
+            "session_id": session_id,
+            "role": role,
+            "content": content,
+            **extra
+        })
+
+    def _path(self, day: str, pid: Optional[int] = None) -> str:
+        return os.path.join(self.directory, f"conversaciones-{day}-{pid or os.getpid()}.ndjson.gz")
+
+    def _run(self):
+        """Hilo escritor: agrupa registros en lotes y los agrega al archivo del día"""
+        while not (self._stop.is_set() and self._queue.empty()):
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._write(batch)
+            except Exception as e:
+                logger.error(f"Error al escribir el archivo de conversaciones: {str(e)}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch: List[Dict[str, Any]]):
+        by_day: Dict[str, List[str]] = {}
+        for record in batch:
+            day = record["timestamp"][:10].replace("-", "")
+            by_day.setdefault(day, []).append(json.dumps(record, ensure_ascii=False) + "\n")
+        for day, lines in by_day.items():
+            with gzip.open(self._path(day), "at", encoding="utf-8") as f:
+                f.writelines(lines)
+
+    def flush(self, timeout: float = EXPORT_FLUSH_TIMEOUT) -> bool:
+        """
+        Espera a que los registros pendientes se escriban
+
+        Returns:
+            False si no terminaron dentro de timeout o si el hilo escritor ya no está corriendo
+            (tras close(), o si murió): queue.join() esperaría para siempre
+        """
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._writer.is_alive():
+                    return False
+                # Espera en tramos cortos para notar si el escritor se detiene mientras tanto
+                self._queue.all_tasks_done.wait(min(remaining, 0.1))
+        return True
+
+    def close(self):
+        """Escribe lo pendiente y detiene el hilo escritor"""
+        self._stop.set()
+        if self._writer.is_alive():
+            self._writer.join(timeout=10)
+
+    @staticmethod
+    def _read_file(path: str) -> Iterator[Dict[str, Any]]:
+        """Lee un archivo diario; tolera un último lote incompleto si se está escribiendo"""
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+        except (EOFError, gzip.BadGzipFile) as e:
+            logger.warning(f"Lectura parcial de {path}: {str(e)}")
+
+    def iter_records(self, start: date, end: date, session_id: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Recorre los registros de un rango de fechas (inclusive) en orden cronológico
+
+        Los archivos de cada día (uno por proceso) se mezclan con heapq.merge, sin cargarlos en memoria.
+        """
+        day = start
+        while day <= end:
+            paths = sorted(glob.glob(self._path(day.strftime("%Y%m%d"), pid="*")))
+            streams = [self._read_file(path) for path in paths]
+            for record in heapq.merge(*streams, key=lambda record: record["timestamp"]):
+                if session_id is None or record["session_id"] == session_id:
+                    yield record
+            day += timedelta(days=1)
+
+    def export_chunks(self, start: date, end: date, session_id: Optional[str] = None,
+                      chunk_bytes: int = EXPORT_CHUNK_BYTES) -> Iterator[bytes]:
+        """Exporta registros como NDJSON en fragmentos de tamaño acotado"""
+        if not self.flush():
+            logger.warning("Hay registros sin escribir: se exporta lo que ya está en disco")
+        buffer: List[bytes] = []
+        size = 0
+        for record in self.iter_records(start, end, session_id):
+            line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+            buffer.append(line)
+            size += len(line)
+            if size >= chunk_bytes:
+                yield b"".join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield b"".join(buffer)
+
+    def export_range(self, start: date, end: date, destination: str) -> int:
+        """Exporta todas las sesiones de un rango de fechas a un archivo .ndjson.gz; retorna los bytes escritos"""
+        written = 0
+        with gzip.open(destination, "wb") as f:
+            for chunk in self.export_chunks(start, end):
+                f.write(chunk)
+                written += len(chunk)
+        logger.info(f"Exportados {written} bytes de conversaciones a {destination}")
+        return written
+
+
+_default_archive: Optional[ConversationArchive] = None
+_default_archive_lock = threading.Lock()
+
+
+def get_default_archive() -> ConversationArchive:
+    """Archivo compartido por el proceso, en AUTOPARTES_ARCHIVO_DIR (por defecto ./conversaciones)"""
+    global _default_archive
+    with _default_archive_lock:
+        if _default_archive is None:
+            _default_archive = ConversationArchive(os.getenv("AUTOPARTES_ARCHIVO_DIR", "conversaciones"))
+        return _default_archive
+
+
+def main(argv: List[str]):
+    """Exporta todas las sesiones de un rango de fechas"""
+    if len(argv) != 3:
+        print("Uso: python conversation_archive.py <desde AAAA-MM-DD> <hasta AAAA-MM-DD> <destino.ndjson.gz>")
+        sys.exit(1)
+
+    start, end = (date.fromisoformat(value) for value in argv[:2])
+    written = get_default_archive().export_range(start, end, argv[2])
+    print(f"{written} bytes exportados a {argv[2]}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
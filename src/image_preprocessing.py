@@ -0,0 +1,152 @@
+"""
+Preprocesamiento de fotos (por ejemplo, del tablero) antes de enviarlas al modelo
+
+Las fotos de celular pesan varios megabytes y tienen mucha más resolución de la que el modelo
+aprovecha. Cada imagen se decodifica (a escala reducida cuando es JPEG), se orienta según EXIF,
+se reduce al lado máximo útil y se vuelve a codificar como JPEG. El resultado se guarda en una
+caché LRU por hash del contenido original, así la misma foto subida varias veces se procesa una vez.
+"""
+import io
+import time
+import base64
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow es opcional: sin él el chat funciona solo con texto
+    Image = None
+    ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+# Lado máximo útil: suficiente para leer los testigos del tablero sin pagar tokens de más
+MAX_SIDE_PX = 1280
+JPEG_QUALITY = 85
+CACHE_SIZE = 64
+
+PIL_AVAILABLE = Image is not None
+
+
+class ImagePreprocessor:
+    """Normaliza imágenes para la API Converse y las guarda en caché por hash"""
+
+    def __init__(self, max_side: int = MAX_SIDE_PX, quality: int = JPEG_QUALITY, cache_size: int = CACHE_SIZE):
+        """
+        Args:
+            max_side: Lado máximo de la imagen resultante (px)
+            quality: Calidad JPEG de la recodificación
+            cache_size: Imágenes procesadas que se conservan
+        """
+        self.max_side = max_side
+        self.quality = quality
+        self.cache_size = cache_size
+
+        self._cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"processed": 0, "cache_hits": 0}
+
+    def _encode(self, raw: bytes) -> Dict[str, Any]:
+        """Decodifica, orienta, reduce y recodifica la imagen"""
+        image = Image.open(io.BytesIO(raw))
+        # En JPEG, draft decodifica directamente a 1/2, 1/4 o 1/8 de escala: mucho más rápido
+        image.draft("RGB", (self.max_side, self.max_side))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+
+        if image.mode in ("RGBA", "LA", "P"):
+            # JPEG no tiene transparencia: se aplana sobre fondo blanco
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[-1])
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=self.quality)
+        payload = output.getvalue()
+
+        return {
+            "media_type": "image/jpeg",
+            "data": base64.b64encode(payload).decode("ascii"),
+            "width": image.width,
+            "height": image.height,
+            "original_bytes": len(raw),
+            "payload_bytes": len(payload)
+        }
+
+    def process(self, raw: bytes) -> Dict[str, Any]:
+        """
+        Procesa la imagen (o la toma de la caché)
+
+        Returns:
+            Diccionario con sha256, media_type, data (base64), dimensiones, tamaños en bytes,
+            preprocess_seconds y cached
+        """
+        if not PIL_AVAILABLE:
+            raise RuntimeError("Para adjuntar imágenes se necesita el paquete Pillow")
+
+        start = time.perf_counter()
+        digest = hashlib.sha256(raw).hexdigest()
+
+        with self._lock:
+            image = self._cache.get(digest)
+            if image is not None:
+                self._cache.move_to_end(digest)
+                self.stats["cache_hits"] += 1
+
+        cached = image is not None
+        if not cached:
+            image = {"sha256": digest, **self._encode(raw)}
+            with self._lock:
+                self._cache[digest] = image
+                self._cache.move_to_end(digest)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+                self.stats["processed"] += 1
+
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"Imagen {digest[:12]}: {image['original_bytes']} -> {image['payload_bytes']} bytes "
+            f"({image['width']}x{image['height']}) en {elapsed * 1000:.1f} ms{' (caché)' if cached else ''}"
+        )
+        return {**image, "preprocess_seconds": elapsed, "cached": cached}
+
+
+def verify_image(raw: bytes):
+    """
+    Comprueba que los bytes sean una imagen que Pillow puede decodificar
+
+    Raises:
+        RuntimeError: Si Pillow no está instalado
+        ValueError: Si los bytes no son una imagen válida
+    """
+    if not PIL_AVAILABLE:
+        raise RuntimeError("Para adjuntar imágenes se necesita el paquete Pillow")
+    try:
+        with Image.open(io.BytesIO(raw)) as image:
+            image.verify()
+    except Exception as e:
+        logger.warning(f"Imagen rechazada: {str(e)}")
+        raise ValueError("El archivo adjunto no es una imagen válida")
+
+
+def to_content_block(image: Dict[str, Any]) -> Dict[str, Any]:
+    """Bloque de imagen para el contenido de un HumanMessage (langchain_aws lo traduce a Converse)"""
+    return {
+        "type": "image",
+        "source": {"type": "base64", "media_type": image["media_type"], "data": image["data"]}
+    }
+
+
+def image_metrics(image: Dict[str, Any]) -> Dict[str, Any]:
+    """Métricas del turno (sin los datos de la imagen)"""
+    return {key: value for key, value in image.items() if key != "data"}
+
+
+# Compartido por todas las sesiones del proceso
+DEFAULT_PREPROCESSOR = ImagePreprocessor()
@@ -0,0 +1,302 @@
+"""
+Prueba de carga: N sesiones concurrentes contra NovaProChatbot y NovaLiteChatbot con el modelo simulado
+
+Cada sesión repite guiones de conversación de varios turnos. Al final se reporta el throughput,
+los percentiles de latencia por turno, el tiempo al primer token y la memoria máxima; el proceso
+termina con código 1 si se incumple algún SLO.
+
+Todas las sesiones usan los mismos guiones, así que con la agrupación de solicitudes idénticas
+(CoalescingLLM) la mayoría de los turnos no llegarían al modelo. Por eso está desactivada por
+defecto; con --agrupar se activa y el reporte muestra cuántas llamadas se agruparon.
+
+Ejemplo desde la carpeta src:
+    python load_test.py --sesiones 50 --chatbot ambos --slo-p95 2.0 --slo-ttft-p95 0.8
+"""
+import sys
+import time
+import random
+import logging
+import argparse
+import tracemalloc
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional
+
+try:
+    import resource
+except ImportError:  # resource solo existe en sistemas Unix
+    resource = None
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from model import LocalCSVSearcher, NovaProChatbot
+from stub_llm import StubBedrockLLM
+from resilience import create_resilient_llm
+from single_flight import CoalescingLLM, SingleFlight
+
+# Guiones de conversación (como el ejemplo de model.main)
+SCRIPTS = [
+    [
+        "Hola, necesito ayuda con unas piezas",
+        "Busca la pieza ABC-123",
+        "¿Qué características tiene esa pieza?",
+        "Busca ahora la pieza XYZ-456"
+    ],
+    [
+        "Buenas tardes",
+        "Mi auto Chevrolet Aveo 2022 está sobrecalentando, ¿qué pieza puede ser?",
+        "Busca la pieza PZ0003",
+        "¿Es compatible con un Aveo 2019?",
+        "Gracias"
+    ],
+    [
+        "Se prendió una luz amarilla en el tablero con forma de motor",
+        "¿Es grave si sigo manejando?",
+        "Busca el código PZ0010"
+    ]
+]
+
+CHATBOTS = ("pro", "lite")
+
+
+class _FirstTokenTimer(BaseCallbackHandler):
+    """Registra el instante del primer token recibido"""
+
+    def __init__(self):
+        self.first_token_at: Optional[float] = None
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Percentil por rango más cercano"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+
+class LoadTest:
+    """Ejecuta las sesiones concurrentes y acumula las mediciones por turno"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.csv_searcher = LocalCSVSearcher(args.assets)
+        self.llms = {chatbot: self._create_llm(chatbot) for chatbot in self._chatbots()}
+        if "lite" in self.llms:
+            # Importación diferida: chat_don_chui configura Streamlit al importarse
+            from chat_don_chui import NovaLiteChatbot
+            self.lite_class = NovaLiteChatbot
+
+        self.turns: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def _chatbots(self) -> List[str]:
+        return list(CHATBOTS) if self.args.chatbot == "ambos" else [self.args.chatbot]
+
+    def _create_llm(self, chatbot: str) -> Any:
+        """Modelo simulado compartido por las sesiones, con las mismas capas que en producción"""
+        model_id = "amazon.nova-pro-v1:0" if chatbot == "pro" else "us.amazon.nova-lite-v1:0"
+        stub = StubBedrockLLM(
+            model_id=model_id,
+            latencia_base=self.args.latencia_base,
+            segundos_por_token_salida=self.args.segundos_por_token,
+            probabilidad_lentitud=self.args.probabilidad_lentitud,
+            probabilidad_throttling=self.args.probabilidad_throttling
+        )
+        if self.args.directo:
+            return stub
+        llm = create_resilient_llm(lambda region: stub, "us-east-2")
+        if not self.args.agrupar:
+            return llm
+        return CoalescingLLM(llm, namespace=model_id, flight=SingleFlight())
+
+    def _record(self, chatbot: str, session: int, start: float, first_token_at: Optional[float], ok: bool):
+        end = time.perf_counter()
+        with self._lock:
+            self.turns.append({
+                "chatbot": chatbot,
+                "session": session,
+                "latency": end - start,
+                "ttft": (first_token_at - start) if first_token_at else None,
+                "ok": ok
+            })
+
+    def _run_pro(self, session: int, script: List[str]):
+        chatbot = NovaProChatbot(self.args.csv, llm=self.llms["pro"], csv_searcher=self.csv_searcher)
+        for message in script:
+            start = time.perf_counter()
+            first_token_at = None
+            ok = True
+            for text in chatbot.chat_stream(message):
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                ok = ok and not text.startswith("Error al procesar la consulta")
+            self._record("pro", session, start, first_token_at, ok)
+            self._think()
+
+    def _run_lite(self, session: int, script: List[str]):
+        chatbot = self.lite_class(model_id="us.amazon.nova-lite-v1:0", llm=self.llms["lite"])
+        for message in script:
+            timer = _FirstTokenTimer()
+            start = time.perf_counter()
+            result = chatbot.chat(message, timer)
+            self._record("lite", session, start, timer.first_token_at, result["success"])
+            self._think()
+
+    def _think(self):
+        """Pausa entre turnos, como un usuario leyendo la respuesta"""
+        if self.args.pausa:
+            time.sleep(random.uniform(0.5, 1.5) * self.args.pausa)
+
+    def _session(self, session: int):
+        time.sleep(self.args.rampa * session / max(self.args.sesiones, 1))
+        chatbots = self._chatbots()
+        for repetition in range(self.args.repeticiones):
+            script = SCRIPTS[(session + repetition) % len(SCRIPTS)]
+            chatbot = chatbots[(session + repetition) % len(chatbots)]
+            if chatbot == "pro":
+                self._run_pro(session, script)
+            else:
+                self._run_lite(session, script)
+
+    def run(self) -> Dict[str, Any]:
+        """Ejecuta la prueba y retorna el reporte"""
+        if self.args.tracemalloc:
+            tracemalloc.start()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.sesiones, thread_name_prefix="sesion") as executor:
+            for future in [executor.submit(self._session, session) for session in range(self.args.sesiones)]:
+                future.result()
+        elapsed = time.perf_counter() - start
+
+        report = {
+            "sessions": self.args.sesiones,
+            "turns": len(self.turns),
+            "elapsed_seconds": elapsed,
+            "throughput_turns_per_second": len(self.turns) / elapsed,
+            "error_rate": sum(1 for turn in self.turns if not turn["ok"]) / max(len(self.turns), 1),
+            "peak_rss_mb": (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024) if resource else None,
+            "peak_traced_mb": None,
+            "coalescing": {
+                chatbot: llm.get_coalescing_stats()
+                for chatbot, llm in self.llms.items() if isinstance(llm, CoalescingLLM)
+            },
+            "by_chatbot": {}
+        }
+        if self.args.tracemalloc:
+            report["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            tracemalloc.stop()
+
+        for chatbot in ["todos", *self._chatbots()]:
+            turns = [turn for turn in self.turns if chatbot == "todos" or turn["chatbot"] == chatbot]
+            latencies = [turn["latency"] for turn in turns]
+            ttfts = [turn["ttft"] for turn in turns if turn["ttft"] is not None]
+            report["by_chatbot"][chatbot] = {
+                "turns": len(turns),
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "ttft_p50": percentile(ttfts, 50),
+                "ttft_p95": percentile(ttfts, 95)
+            }
+        return report
+
+
+def check_slos(report: Dict[str, Any], args: argparse.Namespace) -> List[str]:
+    """Retorna la lista de SLOs incumplidos"""
+    overall = report["by_chatbot"]["todos"]
+    checks = [
+        ("p95 de latencia", overall["p95"], args.slo_p95, "max"),
+        ("p99 de latencia", overall["p99"], args.slo_p99, "max"),
+        ("p95 de tiempo al primer token", overall["ttft_p95"], args.slo_ttft_p95, "max"),
+        ("throughput (turnos/s)", report["throughput_turns_per_second"], args.slo_throughput, "min"),
+        ("tasa de errores", report["error_rate"], args.slo_errores, "max"),
+        ("memoria máxima (MB)", report["peak_rss_mb"], args.slo_memoria_mb, "max")
+    ]
+
+    breaches = []
+    for name, value, limit, kind in checks:
+        if limit is None or value is None:
+            continue
+        if (kind == "max" and value > limit) or (kind == "min" and value < limit):
+            breaches.append(f"{name}: {value:.3f} ({'máximo' if kind == 'max' else 'mínimo'} {limit})")
+    return breaches
+
+
+def print_report(report: Dict[str, Any]):
+    """Imprime el reporte en texto"""
+    print(f"Sesiones: {report['sessions']} · Turnos: {report['turns']} · "
+          f"Duración: {report['elapsed_seconds']:.2f}s · "
+          f"Throughput: {report['throughput_turns_per_second']:.2f} turnos/s · "
+          f"Errores: {report['error_rate']:.1%}")
+    if report["peak_rss_mb"] is not None:
+        print(f"Memoria máxima (RSS): {report['peak_rss_mb']:.1f} MB")
+    if report["peak_traced_mb"] is not None:
+        print(f"Memoria máxima (tracemalloc): {report['peak_traced_mb']:.1f} MB")
+
+    for chatbot, stats in report["coalescing"].items():
+        print(f"Agrupación [{chatbot}]: {stats['requests']} solicitudes -> {stats['upstream_calls']} llamadas "
+              f"al modelo ({stats['coalesced'] / max(stats['requests'], 1):.1%} agrupadas)")
+
+    def fmt(value: Optional[float]) -> str:
+        return f"{value:.3f}s" if value is not None else "-"
+
+    for chatbot, stats in report["by_chatbot"].items():
+        print(f"[{chatbot:5}] turnos={stats['turns']} p50={fmt(stats['p50'])} p95={fmt(stats['p95'])} "
+              f"p99={fmt(stats['p99'])} ttft_p50={fmt(stats['ttft_p50'])} ttft_p95={fmt(stats['ttft_p95'])}")
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Prueba de carga de los chatbots con el modelo simulado")
+    parser.add_argument("--sesiones", type=int, default=20, help="Sesiones concurrentes")
+    parser.add_argument("--repeticiones", type=int, default=2, help="Guiones que repite cada sesión")
+    parser.add_argument("--chatbot", choices=[*CHATBOTS, "ambos"], default="ambos")
+    parser.add_argument("--rampa", type=float, default=1.0, help="Segundos para arrancar todas las sesiones")
+    parser.add_argument("--pausa", type=float, default=0.0, help="Pausa media entre turnos (segundos)")
+    parser.add_argument("--csv", default="base_autopartes_dummy.csv")
+    parser.add_argument("--assets", default="..")
+
+    # Modelo simulado
+    parser.add_argument("--latencia-base", type=float, default=0.2)
+    parser.add_argument("--segundos-por-token", type=float, default=0.002)
+    parser.add_argument("--probabilidad-lentitud", type=float, default=0.0)
+    parser.add_argument("--probabilidad-throttling", type=float, default=0.0)
+    parser.add_argument("--directo", action="store_true",
+                        help="Usar el modelo simulado sin las capas de resiliencia y agrupación")
+    parser.add_argument("--agrupar", action="store_true",
+                        help="Agrupar solicitudes idénticas con CoalescingLLM (las sesiones repiten los mismos "
+                             "guiones: los SLOs medirían la deduplicación, no el modelo)")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="Medir también la memoria de Python con tracemalloc (más lento)")
+
+    # SLOs (se omiten los que no se indican)
+    parser.add_argument("--slo-p95", type=float, help="p95 máximo de latencia por turno (s)")
+    parser.add_argument("--slo-p99", type=float, help="p99 máximo de latencia por turno (s)")
+    parser.add_argument("--slo-ttft-p95", type=float, help="p95 máximo del tiempo al primer token (s)")
+    parser.add_argument("--slo-throughput", type=float, help="Throughput mínimo (turnos/s)")
+    parser.add_argument("--slo-errores", type=float, default=0.0, help="Tasa máxima de errores")
+    parser.add_argument("--slo-memoria-mb", type=float, help="Memoria RSS máxima (MB)")
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str]) -> int:
+    args = parse_args(argv)
+    # Los logs por turno distorsionan la medición
+    logging.getLogger().setLevel(logging.WARNING)
+    report = LoadTest(args).run()
+    print_report(report)
+
+    breaches = check_slos(report, args)
+    for breach in breaches:
+        print(f"SLO incumplido: {breach}")
+    if not breaches:
+        print("Todos los SLOs se cumplen")
+    return 1 if breaches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,15 +1,29 @@
 import os
 import json
+import uuid
 import boto3
 import logging
+import numpy as np
 import pandas as pd
 from datetime import datetime
 from dotenv import load_dotenv
-from prompt_awss_hack import prompt_pieza
-from typing import List, Dict, Any, Optional
+from prompt_awss_hack import prompt_pieza_prefijo, prompt_pieza_sufijo
+from prompt_cache import construir_mensajes, extraer_uso_tokens, estimar_tokens, texto_de_contenido
+from typing import List, Dict, Any, Optional, Tuple, Iterator
 from langchain_aws import ChatBedrockConverse
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
+from shared_catalog import SharedCatalogReader, SharedSnippets
+from catalog_compaction import compact_catalog, DIMENSIONS_COLUMN, DIMENSION_COLUMNS
+from sharded_search import ShardedCatalogSearcher
+from relevance import BM25Index, top_k_positions, EXACT_MATCH_SCORE, PARTIAL_MATCH_SCORE
+from query_cache import QueryResultCache, DEFAULT_QUERY_CACHE, canonical_filters, frozen_positions
+from resilience import BEDROCK_CLIENT_CONFIG, create_resilient_llm, model_for_region
+from model_router import ModelRouter, ROUTER_MODEL_ID
+from single_flight import SingleFlight, CoalescingLLM, normalize_key
+from conversation_archive import ConversationArchive
+from profiling import profile_request
+from image_preprocessing import ImagePreprocessor, DEFAULT_PREPROCESSOR, to_content_block, image_metrics
 
 load_dotenv()
 
@@ -17,12 +31,17 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Resultados del catálogo que se pasan al modelo en cada búsqueda (los más relevantes)
+SEARCH_TOP_K = 10
+
 class ConversationMemory:
     """Maneja la memoria de conversación"""
     
     def __init__(self, max_messages: int = 10):
         self.messages: List[Dict[str, Any]] = []
         self.max_messages = max_messages
+        # Mensajes agregados en total (no se reduce al recortar), para saber cuáles son nuevos
+        self.total_added = 0
     
     def add_message(self, role: str, content: str, timestamp: Optional[str] = None):
         """Añade un mensaje a la memoria"""
@@ -36,6 +55,7 @@ class ConversationMemory:
         }
         
         self.messages.append(message)
+        self.total_added += 1
         
         # Mantener solo los últimos max_messages
         if len(self.messages) > self.max_messages:
@@ -45,6 +65,11 @@ class ConversationMemory:
         """Retorna el historial de conversación"""
         return self.messages.copy()
     
+    def added_since(self, total_added: int) -> List[Dict[str, Any]]:
+        """Mensajes agregados desde que total_added tenía ese valor"""
+        count = self.total_added - total_added
+        return self.messages[-count:] if count > 0 else []
+    
     def clear_memory(self):
         """Limpia la memoria de conversación"""
         self.messages = []
@@ -52,13 +77,32 @@ class ConversationMemory:
 class LocalCSVSearcher:
     """Maneja la búsqueda en archivos CSV almacenados localmente en la carpeta assets"""
     
-    def __init__(self, assets_path: str = 'assets'):
+    def __init__(self, assets_path: str = 'assets', shared_catalog_dir: Optional[str] = None,
+                 query_cache: Optional[QueryResultCache] = None):
         self.assets_path = assets_path
         self.cached_dataframes = {}
+        self.cached_snippets = {}
+        self.cached_indexes = {}
+        self.catalog_versions = {}
+        self.compaction_reports = {}
+        
+        # Resultados de filtros y búsquedas compartidos con los demás buscadores del proceso
+        self.query_cache = query_cache or DEFAULT_QUERY_CACHE
+        
+        # Búsquedas idénticas concurrentes comparten una sola ejecución
+        self.search_flight = SingleFlight()
+        
+        # Catálogo publicado en memoria compartida por un proceso cargador (ver shared_catalog.py)
+        shared_catalog_dir = shared_catalog_dir or os.getenv("AUTOPARTES_CATALOGO_COMPARTIDO")
+        self.shared_catalog = SharedCatalogReader(shared_catalog_dir) if shared_catalog_dir else None
     
     def load_csv_from_local(self, file_name: str) -> pd.DataFrame:
         """Carga un archivo CSV desde la carpeta local assets"""
         try:
+            # Usar el catálogo compartido entre workers si fue publicado para este archivo
+            if self.shared_catalog is not None and self.shared_catalog.serves(file_name):
+                return self.shared_catalog.current().df
+            
             # Crear la ruta completa al archivo
             file_path = os.path.join(self.assets_path, file_name)
             
@@ -73,11 +117,14 @@ class LocalCSVSearcher:
             if not os.path.exists(file_path):
                 raise FileNotFoundError(f"El archivo {file_path} no se encuentra en la carpeta {self.assets_path}")
             
-            # Leer el CSV
-            df = pd.read_csv(file_path)
+            # Leer el CSV y compactarlo (categóricas, tipos numéricos reducidos, textos internados)
+            df, self.compaction_reports[file_name] = compact_catalog(pd.read_csv(file_path))
             
-            # Guardar en caché
+            # Guardar en caché (la versión identifica el contenido en la caché de consultas)
+            stat = os.stat(file_path)
+            self.catalog_versions[file_name] = f"{os.path.abspath(file_path)}:{stat.st_mtime_ns}:{stat.st_size}"
             self.cached_dataframes[file_name] = df
+            self.cached_snippets[file_name] = self._render_snippets(df)
             
             logger.info(f"CSV cargado exitosamente. Filas: {len(df)}, Columnas: {len(df.columns)}")
             return df
@@ -86,7 +133,155 @@ class LocalCSVSearcher:
             logger.error(f"Error al cargar CSV desde local: {str(e)}")
             raise
     
-    def search_piece(self, file_name: str, piece_identifier: str, search_columns: List[str] = None) -> Dict[str, Any]:
+    @staticmethod
+    def _render_snippets(df: pd.DataFrame) -> pd.DataFrame:
+        """Renderiza una sola vez el texto de cada fila para el contexto del modelo, con su conteo de tokens"""
+        texts = pd.Series("", index=df.index, dtype=object)
+        # Las medidas por separado repiten lo que ya dice Dimensiones: no se gastan tokens en ellas
+        derived = DIMENSION_COLUMNS if DIMENSIONS_COLUMN in df.columns else []
+        for column in df.columns:
+            if column in derived:
+                continue
+            texts = texts + f"  {column}: " + df[column].astype(str) + "\n"
+        
+        return pd.DataFrame({
+            'text': texts,
+            'tokens': texts.map(estimar_tokens)
+        })
+    
+    def get_row_snippet(self, file_name: str, row_index: Any) -> Tuple[str, int]:
+        """
+        Retorna el texto precalculado de una fila de la versión actual y su conteo de tokens
+        
+        Los resultados de search_piece ya traen el texto de la versión en la que se buscaron
+        ('snippet' y 'snippet_tokens'); este método es para filas obtenidas de otra forma.
+        """
+        return self._snippet(self._catalog(file_name)[3], row_index)
+    
+    @staticmethod
+    def _snippet(snippets: Any, position: int) -> Tuple[str, int]:
+        """Texto y tokens de la fila en la posición indicada (catálogo compartido o local)"""
+        if isinstance(snippets, SharedSnippets):
+            return snippets.get(position)
+        return snippets['text'].iat[position], int(snippets['tokens'].iat[position])
+    
+    def _catalog(self, file_name: str) -> Tuple[pd.DataFrame, str, Optional[BM25Index], Any]:
+        """
+        Catálogo, versión, índice publicado (si lo hay) y textos por fila, tomados de una misma versión
+        
+        Con el catálogo compartido, dos llamadas a current() pueden ver versiones distintas si se
+        publica una nueva entre ellas: las claves de caché, las posiciones y los textos de las filas
+        deben salir de la misma.
+        """
+        if self.shared_catalog is not None and self.shared_catalog.serves(file_name):
+            snapshot = self.shared_catalog.current()
+            return snapshot.df, f"compartido:{snapshot.version}", snapshot.index, snapshot.snippets
+        df = self.load_csv_from_local(file_name)
+        return df, self.catalog_versions[file_name], None, self.cached_snippets[file_name]
+    
+    def get_index(self, file_name: str) -> BM25Index:
+        """Índice BM25 del catálogo, construido en la primera búsqueda por relevancia"""
+        df, _, published_index, _ = self._catalog(file_name)
+        return self._index_for(file_name, df, published_index)
+    
+    def _index_for(self, file_name: str, df: pd.DataFrame, published_index: Optional[BM25Index]) -> BM25Index:
+        """Índice de df: el publicado con el catálogo compartido (mapeado) o uno construido aquí"""
+        if published_index is not None:
+            return published_index
+        # Con el catálogo compartido el índice se reconstruye cuando se publica una versión nueva
+        key = (file_name, id(df))
+        index = self.cached_indexes.get(key)
+        if index is None:
+            index = BM25Index(df)
+            self.cached_indexes = {k: v for k, v in self.cached_indexes.items() if k[0] != file_name}
+            self.cached_indexes[key] = index
+            logger.info(f"Índice BM25 construido para {file_name}: {len(index.postings)} términos")
+        return index
+    
+    def catalog_version(self, file_name: str) -> str:
+        """Versión del catálogo cargado (cambia al publicar uno nuevo en memoria compartida)"""
+        return self._catalog(file_name)[1]
+    
+    def filter_positions(self, file_name: str, filters: Dict[str, List[str]]) -> np.ndarray:
+        """
+        Posiciones de las filas que cumplen los filtros (en caché por combinación canónica de filtros)
+        
+        Args:
+            file_name: Nombre del archivo en la carpeta assets
+            filters: Por ejemplo {"Marca de Auto": ["Nissan"], "Modelo": ["Altima"]}; listas vacías no filtran
+        """
+        df, version, _, _ = self._catalog(file_name)
+        return self._filter_positions(df, version, filters)
+    
+    def _filter_positions(self, df: pd.DataFrame, version: str, filters: Dict[str, List[str]]) -> np.ndarray:
+        key = (version, "filtros", canonical_filters(filters))
+        
+        def compute() -> np.ndarray:
+            mask = np.ones(len(df), dtype=bool)
+            for column, values in filters.items():
+                if values:
+                    mask &= df[column].isin(values).to_numpy()
+            return frozen_positions(np.flatnonzero(mask))
+        
+        return self.query_cache.get_or_compute(key, compute)
+    
+    def filter_catalog(self, file_name: str, filters: Dict[str, List[str]]) -> pd.DataFrame:
+        """
+        Filtra el catálogo por facetas (columna -> valores aceptados)
+        
+        Args:
+            file_name: Nombre del archivo en la carpeta assets
+            filters: Por ejemplo {"Marca de Auto": ["Nissan"], "Modelo": ["Altima"]}; listas vacías no filtran
+        
+        Returns:
+            DataFrame con las filas que cumplen todos los filtros
+        """
+        df, version, _, _ = self._catalog(file_name)
+        return df.take(self._filter_positions(df, version, filters))
+    
+    def search_piece(self, file_name: str, piece_identifier: str, search_columns: List[str] = None,
+                     top_k: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Busca una pieza específica en el CSV (las búsquedas idénticas concurrentes se agrupan)
+        
+        Args:
+            file_name: Nombre del archivo en la carpeta assets
+            piece_identifier: Identificador de la pieza a buscar
+            search_columns: Columnas donde buscar (si es None, busca en todas)
+            top_k: Si se indica, retorna solo los top_k resultados más relevantes (con 'score');
+                si es None, todas las coincidencias en el orden de las columnas
+        
+        Returns:
+            Diccionario con los resultados de la búsqueda
+        """
+        key = normalize_key(file_name, piece_identifier, search_columns, top_k)
+        if top_k is not None:
+            search = lambda: self._rank_piece(file_name, piece_identifier, search_columns, top_k)
+        else:
+            search = lambda: self._search_piece(file_name, piece_identifier, search_columns)
+        results, _ = self.search_flight.do(key, search)
+        return results
+    
+    @staticmethod
+    def _match_masks(series: pd.Series, piece_identifier: str) -> Tuple[pd.Series, pd.Series]:
+        """
+        Máscaras de coincidencia exacta y parcial de una columna
+        
+        En columnas categóricas se compara cada categoría una sola vez y después se seleccionan
+        las filas por código, en lugar de convertir y comparar el texto de todas las filas.
+        """
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            categories = series.cat.categories.astype(str)
+            exact_codes = np.flatnonzero(categories.str.upper() == piece_identifier.upper())
+            partial_codes = np.flatnonzero(categories.str.contains(piece_identifier, case=False, na=False))
+            codes = series.cat.codes.to_numpy()
+            return (pd.Series(np.isin(codes, exact_codes), index=series.index),
+                    pd.Series(np.isin(codes, partial_codes), index=series.index))
+        
+        values = series.astype(str)
+        return values.str.upper() == piece_identifier.upper(), values.str.contains(piece_identifier, case=False, na=False)
+    
+    def _search_piece(self, file_name: str, piece_identifier: str, search_columns: List[str] = None) -> Dict[str, Any]:
         """
         Busca una pieza específica en el CSV
         
@@ -99,7 +294,7 @@ class LocalCSVSearcher:
             Diccionario con los resultados de la búsqueda
         """
         try:
-            df = self.load_csv_from_local(file_name)
+            df, _, _, snippets = self._catalog(file_name)
             
             if search_columns is None:
                 search_columns = df.columns.tolist()
@@ -108,27 +303,33 @@ class LocalCSVSearcher:
             results = []
             for column in search_columns:
                 if column in df.columns:
+                    exact_mask, partial_mask = self._match_masks(df[column], piece_identifier)
+                    
                     # Búsqueda exacta
-                    exact_matches = df[df[column].astype(str).str.upper() == piece_identifier.upper()]
+                    exact_matches = df[exact_mask]
                     
                     # Búsqueda parcial (contiene)
-                    partial_matches = df[df[column].astype(str).str.contains(piece_identifier, case=False, na=False)]
+                    partial_matches = df[partial_mask]
                     
-                    for _, row in exact_matches.iterrows():
+                    for row_index, row in exact_matches.iterrows():
                         results.append({
                             'match_type': 'exact',
                             'matched_column': column,
                             'matched_value': str(row[column]),
+                            'row_index': row_index,
+                            'file_name': file_name,
                             'row_data': row.to_dict()
                         })
                     
                     # Solo agregar coincidencias parciales si no hay exactas
                     if exact_matches.empty:
-                        for _, row in partial_matches.iterrows():
+                        for row_index, row in partial_matches.iterrows():
                             results.append({
                                 'match_type': 'partial',
                                 'matched_column': column,
                                 'matched_value': str(row[column]),
+                                'row_index': row_index,
+                                'file_name': file_name,
                                 'row_data': row.to_dict()
                             })
             
@@ -142,6 +343,12 @@ class LocalCSVSearcher:
                     seen.add(row_id)
                     unique_results.append(result)
             
+            # Textos de la misma versión del catálogo en la que se buscó
+            for result in unique_results:
+                result['snippet'], result['snippet_tokens'] = self._snippet(
+                    snippets, df.index.get_loc(result['row_index'])
+                )
+            
             return {
                 'piece_identifier': piece_identifier,
                 'total_matches': len(unique_results),
@@ -158,95 +365,254 @@ class LocalCSVSearcher:
                 'error': str(e),
                 'search_timestamp': datetime.now().isoformat()
             }
+    
+    def _rank_piece(self, file_name: str, piece_identifier: str, search_columns: Optional[List[str]],
+                    top_k: int) -> Dict[str, Any]:
+        """
+        Busca la pieza y retorna los top_k resultados por relevancia
+        
+        El puntaje suma las coincidencias exactas o parciales del identificador completo en las
+        columnas de búsqueda y, cuando se busca en todas las columnas, BM25 sobre los campos de
+        texto con bonos por marca, modelo y año. Solo se arman los diccionarios del top-k; las
+        posiciones del top-k quedan en la caché de consultas para las demás sesiones.
+        """
+        try:
+            df, version, published_index, snippets = self._catalog(file_name)
+            key = (version, "relevancia", piece_identifier.upper(),
+                   tuple(search_columns) if search_columns is not None else None, top_k)
+            total_matches, ranked = self.query_cache.get_or_compute(
+                key, lambda: self._rank_positions(df, file_name, piece_identifier, search_columns, top_k,
+                                                  published_index)
+            )
+            
+            results = []
+            for score, position, match_type, matched_column in ranked:
+                row = df.iloc[position]
+                snippet, snippet_tokens = self._snippet(snippets, position)
+                results.append({
+                    'match_type': match_type,
+                    'matched_column': matched_column,
+                    'matched_value': str(row[matched_column]) if matched_column else "",
+                    'score': score,
+                    'row_index': df.index[position],
+                    'file_name': file_name,
+                    'row_data': row.to_dict(),
+                    'snippet': snippet,
+                    'snippet_tokens': snippet_tokens
+                })
+            
+            return {
+                'piece_identifier': piece_identifier,
+                'total_matches': total_matches,
+                'results': results,
+                'search_timestamp': datetime.now().isoformat()
+            }
+            
+        except Exception as e:
+            logger.error(f"Error en búsqueda de pieza: {str(e)}")
+            return {
+                'piece_identifier': piece_identifier,
+                'total_matches': 0,
+                'results': [],
+                'error': str(e),
+                'search_timestamp': datetime.now().isoformat()
+            }
+    
+    def _rank_positions(self, df: pd.DataFrame, file_name: str, piece_identifier: str,
+                        search_columns: Optional[List[str]], top_k: int,
+                        published_index: Optional[BM25Index] = None) -> Tuple[int, Tuple[Tuple[Any, ...], ...]]:
+        """Total de coincidencias y top_k como (puntaje, posición, tipo de coincidencia, columna)"""
+        columns = [column for column in (search_columns or df.columns) if column in df.columns]
+        
+        scores = np.zeros(len(df), dtype=np.float64)
+        exact_column = np.full(len(df), -1)
+        partial_column = np.full(len(df), -1)
+        for position, column in enumerate(columns):
+            exact_mask, partial_mask = self._match_masks(df[column], piece_identifier)
+            exact, partial = exact_mask.to_numpy(), partial_mask.to_numpy()
+            exact_column[exact & (exact_column < 0)] = position
+            partial_column[partial & (partial_column < 0)] = position
+        scores[exact_column >= 0] += EXACT_MATCH_SCORE
+        scores[(exact_column < 0) & (partial_column >= 0)] += PARTIAL_MATCH_SCORE
+        
+        index = None
+        if search_columns is None:
+            index = self._index_for(file_name, df, published_index)
+            scores += index.score(piece_identifier)
+        
+        ranked = []
+        for score, position in top_k_positions(scores, top_k):
+            if exact_column[position] >= 0:
+                match_type, matched_column = 'exact', columns[exact_column[position]]
+            elif partial_column[position] >= 0:
+                match_type, matched_column = 'partial', columns[partial_column[position]]
+            else:
+                match_type, matched_column = 'relevance', index.matched_field(df, position, piece_identifier)
+            ranked.append((round(score, 4), position, match_type, matched_column))
+        
+        return int(np.count_nonzero(scores > 0)), tuple(ranked)
+
+def create_nova_pro_llm(aws_region: str = 'us-east-1', model_id: str = "amazon.nova-pro-v1:0") -> ChatBedrockConverse:
+    """Crea el cliente de Nova Pro (u otro modelo Nova) a través de Bedrock"""
+    return ChatBedrockConverse(
+        client=boto3.client(
+            service_name='bedrock-runtime',
+            region_name=aws_region,
+            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+            config=BEDROCK_CLIENT_CONFIG
+        ),
+        model=model_id,
+        max_tokens=7000,
+        temperature=0.15,
+        top_p=0.9,
+        region_name=aws_region
+    )
 
 class NovaProChatbot:
     """Chatbot principal usando AWS Nova Pro con memoria y búsqueda CSV"""
     
-    def __init__(self, csv_file_name: str, aws_region: str = 'us-east-1', assets_path: str = '../'):
-        self.bedrock_client = ChatBedrockConverse(
-            client=boto3.client(
-                service_name='bedrock-runtime',
-                region_name=aws_region,
-                aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-                aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-                config=boto3.session.Config(
-                    read_timeout=300,  # 5 minutos
-                    connect_timeout=60,  # 1 minuto
-                    retries={'max_attempts': 2})
-            ),
-            model="amazon.nova-pro-v1:0",
-            max_tokens=7000,
-            temperature=0.15,
-            top_p=0.9,
-            region_name=aws_region
-        )
+    def __init__(self, csv_file_name: str, aws_region: str = 'us-east-1', assets_path: str = '../',
+                 llm: Optional[Any] = None, max_context_tokens: int = 1500,
+                 csv_searcher: Optional[LocalCSVSearcher] = None, model_id: str = "amazon.nova-pro-v1:0",
+                 session_id: Optional[str] = None, archive: Optional[ConversationArchive] = None,
+                 image_preprocessor: Optional[ImagePreprocessor] = None,
+                 catalog_searcher: Optional[ShardedCatalogSearcher] = None):
+        # llm y csv_searcher permiten reutilizar instancias compartidas (o el modelo simulado sin AWS)
+        # model_id="auto" enruta cada turno a Nova Micro, Lite o Pro según la complejidad de la consulta
+        # archive guarda cada turno en el archivo comprimido de conversaciones, sin bloquear el chat
+        # catalog_searcher busca en los catálogos de varios proveedores en lugar de solo csv_file_name
+        self.model_id = model_id
+        self.session_id = session_id or str(uuid.uuid4())
+        self.archive = archive
+        self.image_preprocessor = image_preprocessor or DEFAULT_PREPROCESSOR
+        self.bedrock_client = llm or self._create_llm(aws_region)
         self.memory = ConversationMemory()
-        self.csv_searcher = LocalCSVSearcher(assets_path)
+        self.csv_searcher = csv_searcher or LocalCSVSearcher(assets_path)
         self.csv_file_name = "base_autopartes_dummy.csv"
-        self.model_id = "amazon.nova-pro-v1:0"
+        self.max_context_tokens = max_context_tokens
+        self.catalog_searcher = catalog_searcher
+        self.last_usage: Optional[Dict[str, int]] = None
+        self.last_image: Optional[Dict[str, Any]] = None
+        self.turn_count = 0
+        self.usage_totals = {
+            "input_tokens": 0,
+            "cached_input_tokens": 0,
+            "cache_write_tokens": 0,
+            "output_tokens": 0
+        }
+    
+    def _create_llm(self, aws_region: str) -> Any:
+        """Crea el cliente resiliente del modelo, o el enrutador de modelos si model_id es "auto" """
+        def resilient_factory(model_id: str) -> Any:
+            return create_resilient_llm(
+                lambda region: create_nova_pro_llm(region, model_for_region(model_id, region)),
+                aws_region,
+                shared_key=model_id
+            )
+        
+        if self.model_id == ROUTER_MODEL_ID:
+            llm = ModelRouter(resilient_factory)
+        else:
+            llm = resilient_factory(self.model_id)
+        # Preguntas idénticas concurrentes de distintas sesiones comparten una sola llamada
+        return CoalescingLLM(llm, namespace=self.model_id)
     
     def format_search_results(self, search_results: Dict[str, Any]) -> str:
         """Formatea los resultados de búsqueda para el contexto del modelo"""
         if search_results['total_matches'] == 0:
             return f"No se encontraron resultados para la pieza: {search_results['piece_identifier']}"
         
-        formatted_text = f"Resultados de búsqueda para '{search_results['piece_identifier']}' ({search_results['total_matches']} coincidencias):\n\n"
+        header = f"Resultados de búsqueda para '{search_results['piece_identifier']}' ({search_results['total_matches']} coincidencias):\n\n"
+        parts = [header]
+        budget = self.max_context_tokens - estimar_tokens(header)
+        included = 0
         
-        for i, result in enumerate(search_results['results'][:5], 1):  # Limitar a 5 resultados
-            formatted_text += f"Resultado {i} ({result['match_type']} match en {result['matched_column']}):\n"
-            for key, value in result['row_data'].items():
-                formatted_text += f"  {key}: {value}\n"
-            formatted_text += "\n"
+        # Llenar el presupuesto de tokens de forma voraz con los textos precalculados
+        for result in search_results['results']:
+            if budget <= 0:
+                break
+            
+            if 'snippet' in result:
+                snippet, snippet_tokens = result['snippet'], result['snippet_tokens']
+            elif 'row_index' in result:
+                snippet, snippet_tokens = self.csv_searcher.get_row_snippet(
+                    result.get('file_name', self.csv_file_name), result['row_index']
+                )
+            else:
+                snippet = "".join(f"  {key}: {value}\n" for key, value in result['row_data'].items())
+                snippet_tokens = estimar_tokens(snippet)
+            
+            title = f"Resultado {included + 1} ({result['match_type']} match en {result['matched_column']}):\n"
+            cost = estimar_tokens(title) + snippet_tokens + 1
+            if cost > budget:
+                continue
+            
+            parts.extend((title, snippet, "\n"))
+            budget -= cost
+            included += 1
+        
+        omitted = search_results['total_matches'] - included
+        if omitted > 0:
+            parts.append(f"({omitted} resultados omitidos por límite de contexto)\n")
+        
+        return "".join(parts)
+    
+    def _build_messages(self, user_message: str, search_context: str = "",
+                        image: Optional[Dict[str, Any]] = None) -> List[BaseMessage]:
+        """Construye los mensajes: prefijo estático (cacheable) + sufijo con la búsqueda, la pregunta y la foto"""
+        variable_prompt = prompt_pieza_sufijo.format_map({
+            "search_context": search_context,
+            "user_message": user_message
+        })
+        if image:
+            variable_prompt = [{"type": "text", "text": variable_prompt}, to_content_block(image)]
+        return construir_mensajes(prompt_pieza_prefijo, variable_prompt, self.model_id,
+                                  historial=self._history_messages())
+    
+    def _history_messages(self) -> List[BaseMessage]:
+        """
+        Turnos anteriores de la memoria como mensajes del modelo (sin el mensaje actual, que ya se agregó)
         
-        return formatted_text
+        Converse exige que los roles alternen empezando por el usuario: si un turno falló y quedaron
+        dos mensajes seguidos del mismo rol, se conserva el más reciente.
+        """
+        history: List[BaseMessage] = []
+        for message in self.memory.get_conversation_history()[:-1]:
+            message_class = HumanMessage if message["role"] == "user" else AIMessage
+            if history and isinstance(history[-1], message_class):
+                history[-1] = message_class(content=message["content"])
+            elif history or message_class is HumanMessage:
+                history.append(message_class(content=message["content"]))
+        # El mensaje actual es del usuario: el historial debe terminar en una respuesta
+        if history and isinstance(history[-1], HumanMessage):
+            history.pop()
+        return history
+    
+    def _prepare_image(self, imagen: Optional[bytes]) -> Optional[Dict[str, Any]]:
+        """Preprocesa la foto adjunta del turno y guarda sus métricas en last_image"""
+        image = self.image_preprocessor.process(imagen) if imagen else None
+        self.last_image = image_metrics(image) if image else None
+        return image
     
-    def call_nova_pro(self, user_message: str, search_context: str = "") -> str:
+    def _record_usage(self, response: Any):
+        """Registra el uso de tokens (con y sin caché) del turno"""
+        self.last_usage = extraer_uso_tokens(response)
+        for key in self.usage_totals:
+            self.usage_totals[key] += self.last_usage[key]
+    
+    def call_nova_pro(self, user_message: str, search_context: str = "",
+                      image: Optional[Dict[str, Any]] = None) -> str:
         """Llama al modelo Nova Pro con el contexto completo"""
         try:
-            # Construir el contexto de la conversación
-            conversation_context = ""
-            for msg in self.memory.get_conversation_history():
-                conversation_context += f"{msg['role']}: {msg['content']}\n"
-            
-            # Construir el prompt completo
-            system_prompt = """Eres un asistente especializado en ayudar con consultas sobre piezas y componentes. 
-            Tienes acceso a una base de datos de piezas y puedes recordar conversaciones anteriores.
-            
-            Cuando el usuario mencione una pieza específica, búscala automáticamente y proporciona información relevante.
-            Sé conciso pero informativo en tus respuestas."""
-            prompt_pieza
-            full_prompt = prompt_pieza.format_map({"user_message": user_message})
-
-            # Preparar el cuerpo de la solicitud
-            request_body = {
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "text": full_prompt
-                            }
-                        ]
-                    }
-                ],
-                "inferenceConfig": {
-                    "max_new_tokens": 1000,
-                    "temperature": 0.7,
-                    "top_p": 0.9
-                }
-            }
+            messages = self._build_messages(user_message, search_context, image)
             
             # Llamar al modelo
-            response = self.bedrock_client.invoke([HumanMessage(content=full_prompt)])
-            
-            # self.bedrock_client.converse(
-            #     modelId=self.model_id,
-            #     messages=request_body["messages"],
-            #     inferenceConfig=request_body["inferenceConfig"]
-            # )
+            response = self.bedrock_client.invoke(messages, config={"metadata": {"user_message": user_message}})
+            self._record_usage(response)
             
             # Extraer la respuesta
-            assistant_response = response['output']['message']['content'][0]['text']
+            assistant_response = response.content
             
             return assistant_response
             
@@ -281,33 +647,51 @@ class NovaProChatbot:
         
         return None
     
-    def chat(self, user_message: str) -> Dict[str, Any]:
-        """Función principal de chat"""
+    def _search_for_message(self, user_message: str) -> Tuple[Optional[str], Optional[Dict[str, Any]], str]:
+        """Busca en el catálogo si el mensaje menciona una pieza; retorna (pieza, resultados, contexto)"""
+        piece_id = self.detect_piece_query(user_message)
+        if not piece_id:
+            return None, None, ""
+        
+        logger.info(f"Detectada consulta de pieza: {piece_id}")
+        if self.catalog_searcher is not None:
+            search_results = self.catalog_searcher.search_piece(piece_id, top_k=SEARCH_TOP_K)
+        else:
+            search_results = self.csv_searcher.search_piece(self.csv_file_name, piece_id, top_k=SEARCH_TOP_K)
+        search_context = f"\nInformación de la base de datos:\n{self.format_search_results(search_results)}"
+        return piece_id, search_results, search_context
+    
+    def chat(self, user_message: str, imagen: Optional[bytes] = None) -> Dict[str, Any]:
+        """Función principal de chat (imagen: foto adjunta en bytes, opcional)"""
+        self.turn_count += 1
+        with profile_request(self.session_id, self.turn_count, label="nova_pro"):
+            return self._chat(user_message, imagen)
+    
+    def _chat(self, user_message: str, imagen: Optional[bytes]) -> Dict[str, Any]:
+        """Turno de chat (ver chat)"""
         try:
             # Añadir mensaje del usuario a la memoria
             self.memory.add_message("user", user_message)
             
             # Detectar si es una consulta de pieza
-            piece_id = self.detect_piece_query(user_message)
-            search_context = ""
-            search_results = None
-            
-            if piece_id:
-                logger.info(f"Detectada consulta de pieza: {piece_id}")
-                search_results = self.csv_searcher.search_piece(self.csv_file_name, piece_id)
-                search_context = f"\nInformación de la base de datos:\n{self.format_search_results(search_results)}"
+            self.last_usage = None
+            piece_id, search_results, search_context = self._search_for_message(user_message)
+            image = self._prepare_image(imagen)
             
             # Generar respuesta usando Nova Pro
-            assistant_response = self.call_nova_pro(user_message, search_context)
+            assistant_response = self.call_nova_pro(user_message, search_context, image)
             
             # Añadir respuesta a la memoria
             self.memory.add_message("assistant", assistant_response)
+            self._archive_turn(user_message, assistant_response, piece_id)
             
             return {
                 "response": assistant_response,
                 "search_performed": piece_id is not None,
                 "piece_searched": piece_id,
                 "search_results": search_results,
+                "usage": self.last_usage,
+                "image": self.last_image,
                 "timestamp": datetime.now().isoformat()
             }
             
@@ -318,9 +702,44 @@ class NovaProChatbot:
                 "search_performed": False,
                 "piece_searched": None,
                 "search_results": None,
+                "usage": None,
+                "image": None,
                 "timestamp": datetime.now().isoformat()
             }
 
+    def chat_stream(self, user_message: str, imagen: Optional[bytes] = None) -> Iterator[str]:
+        """Versión en streaming de chat: produce fragmentos de texto conforme los genera el modelo"""
+        self.memory.add_message("user", user_message)
+        self.last_usage = None
+        
+        parts = []
+        try:
+            _, _, search_context = self._search_for_message(user_message)
+            messages = self._build_messages(user_message, search_context, self._prepare_image(imagen))
+            for chunk in self.bedrock_client.stream(messages, config={"metadata": {"user_message": user_message}}):
+                if chunk.usage_metadata:
+                    self._record_usage(chunk)
+                text = texto_de_contenido(chunk.content)
+                if text:
+                    parts.append(text)
+                    yield text
+        except Exception as e:
+            logger.error(f"Error en streaming de Nova Pro: {str(e)}")
+            error_text = f"Error al procesar la consulta: {str(e)}"
+            parts.append(error_text)
+            yield error_text
+        
+        self.memory.add_message("assistant", "".join(parts))
+        self._archive_turn(user_message, "".join(parts), None)
+
+    def _archive_turn(self, user_message: str, assistant_response: str, piece_id: Optional[str]):
+        """Agrega el turno al archivo de conversaciones (asíncrono)"""
+        if self.archive is None:
+            return
+        self.archive.record(self.session_id, "user", user_message, app="nova_pro", image=self.last_image)
+        self.archive.record(self.session_id, "assistant", assistant_response, app="nova_pro",
+                            piece_searched=piece_id, usage=self.last_usage)
+
 # Función de ejemplo de uso
 def main():
     """Ejemplo de uso del sistema"""
@@ -329,8 +748,12 @@ def main():
     CSV_FILE_NAME = "pieces.csv"  # Nombre del archivo en la carpeta assets
     ASSETS_PATH = "assets"  # Ruta a la carpeta assets
     
-    # Crear instancia del chatbot
-    chatbot = NovaProChatbot(CSV_FILE_NAME, assets_path=ASSETS_PATH)
+    # Crear instancia del chatbot (AUTOPARTES_OFFLINE=1 usa el modelo local simulado)
+    llm = None
+    if os.getenv("AUTOPARTES_OFFLINE"):
+        from stub_llm import StubBedrockLLM
+        llm = StubBedrockLLM(model_id="amazon.nova-pro-v1:0")
+    chatbot = NovaProChatbot(CSV_FILE_NAME, assets_path=ASSETS_PATH, llm=llm)
     
     # Ejemplo de conversación
     messages = [
@@ -354,6 +777,10 @@ def main():
             if result['search_results'] and result['search_results']['total_matches'] > 0:
                 print(f"[{result['search_results']['total_matches']} coincidencias encontradas]")
         
+        if result['usage']:
+            print(f"[Tokens de entrada: {result['usage']['input_tokens']} "
+                  f"(caché: {result['usage']['cached_input_tokens']})]")
+        
         print("-" * 50)
 
 if __name__ == "__main__":
@@ -0,0 +1,289 @@
+import re
+import time
+import logging
+import threading
+import unicodedata
+from collections import deque
+from typing import List, Dict, Any, Optional, Callable, Iterator, Tuple
+
+from prompt_cache import estimar_tokens, modelo_soporta_cache, extraer_uso_tokens, texto_de_contenido, MODELO_ENRUTADO
+
+logger = logging.getLogger(__name__)
+
+# Valor de model_id que activa el enrutador en lugar de un modelo fijo
+ROUTER_MODEL_ID = MODELO_ENRUTADO
+
+# Política por defecto: cada nivel usa el modelo más barato capaz de resolverlo
+DEFAULT_ROUTING_POLICY = {
+    "models": {
+        "micro": "us.amazon.nova-micro-v1:0",
+        "lite": "us.amazon.nova-lite-v1:0",
+        "pro": "us.amazon.nova-pro-v1:0"
+    },
+    # Puntaje mínimo para subir de nivel; un solo síntoma (2 puntos) ya va a Pro,
+    # así los diagnósticos no pierden calidad
+    "lite_min_score": 1,
+    "pro_min_score": 2,
+    # Mensajes largos suelen describir síntomas: suman puntaje
+    "long_message_tokens": 60,
+    # Las fotos son casi siempre del tablero o de una pieza dañada: siempre van a Pro
+    "image_min_tier": "pro"
+}
+
+TIERS = ("micro", "lite", "pro")
+
+SMALL_TALK = {
+    "hola", "buenas", "buenos", "dias", "tardes", "noches", "gracias", "adios", "ok", "vale",
+    "perfecto", "genial", "saludos", "hasta", "luego", "si", "no", "claro"
+}
+
+DIAGNOSTIC_PATTERNS = [
+    r"\bruid", r"\bvibra", r"sobrecali", r"\bcalient", r"\bhumo\b", r"\bfuga", r"\btira\w* aceite",
+    r"\bno arranca", r"\bpierde potencia", r"\btablero\b", r"\bluz\b", r"\bfoco", r"\btestigo",
+    r"\bfalla", r"\bcheck engine", r"\bobd", r"\bp[0-3]\d{3}\b", r"\bse apaga", r"\bjaloneo",
+    r"\bdiagnostic", r"\bpor que\b", r"\bque tiene\b"
+]
+
+LOOKUP_PATTERNS = [
+    r"\bpz\d{3,}\b", r"\b[a-z0-9]+-[a-z0-9]+\b", r"\bprecio", r"\bcuanto cuesta", r"\bbusca",
+    r"\bnecesito (un|una)\b", r"\bcompatible", r"\bdisponible"
+]
+
+
+def _normalize(text: str) -> str:
+    """Minúsculas sin acentos"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+class QueryClassifier:
+    """Clasificador local por reglas que asigna cada consulta al nivel de modelo más barato suficiente"""
+
+    def __init__(self, policy: Optional[Dict[str, Any]] = None):
+        self.policy = {**DEFAULT_ROUTING_POLICY, **(policy or {})}
+        self._diagnostic = [re.compile(pattern) for pattern in DIAGNOSTIC_PATTERNS]
+        self._lookup = [re.compile(pattern) for pattern in LOOKUP_PATTERNS]
+
+    def features(self, text: str, has_image: bool = False) -> Dict[str, Any]:
+        """Extrae las características de la consulta"""
+        normalized = _normalize(text)
+        words = re.findall(r"\w+", normalized)
+        return {
+            "tokens": estimar_tokens(text),
+            "small_talk_only": bool(words) and all(word in SMALL_TALK for word in words),
+            "diagnostic_hits": sum(1 for pattern in self._diagnostic if pattern.search(normalized)),
+            "lookup_hits": sum(1 for pattern in self._lookup if pattern.search(normalized)),
+            "questions": text.count("?"),
+            "has_image": has_image
+        }
+
+    def classify(self, text: str, has_image: bool = False) -> Tuple[str, Dict[str, Any]]:
+        """Retorna (nivel, características) para la consulta"""
+        features = self.features(text, has_image)
+
+        score = 2 * features["diagnostic_hits"]
+        score += 1 if features["lookup_hits"] else 0
+        score += 1 if features["questions"] >= 2 else 0
+        score += 1 if features["tokens"] >= self.policy["long_message_tokens"] else 0
+        score += 2 if has_image else 0
+        features["score"] = score
+
+        if features["small_talk_only"] and not has_image:
+            tier = "micro"
+        elif score >= self.policy["pro_min_score"]:
+            tier = "pro"
+        elif score >= self.policy["lite_min_score"]:
+            tier = "lite"
+        else:
+            tier = "micro"
+
+        if has_image and TIERS.index(tier) < TIERS.index(self.policy["image_min_tier"]):
+            tier = self.policy["image_min_tier"]
+
+        return tier, features
+
+
+class ModelRouter:
+    """
+    Envía cada turno al modelo Nova más barato capaz de resolverlo (micro, lite o pro)
+
+    Se usa en lugar del cliente del modelo: expone invoke y stream, y guarda métricas
+    de latencia, tokens y enrutamiento por modelo.
+    """
+
+    def __init__(self, llm_factory: Callable[[str], Any], policy: Optional[Dict[str, Any]] = None):
+        """
+        Args:
+            llm_factory: Crea el cliente para un model_id
+            policy: Cambios sobre DEFAULT_ROUTING_POLICY
+        """
+        self.llm_factory = llm_factory
+        self.classifier = QueryClassifier(policy)
+        self.policy = self.classifier.policy
+        self.last_route: Optional[Dict[str, Any]] = None
+
+        self._clients: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self.metrics: Dict[str, Dict[str, Any]] = {}
+
+    def _client(self, model_id: str) -> Any:
+        with self._lock:
+            if model_id not in self._clients:
+                self._clients[model_id] = self.llm_factory(model_id)
+            return self._clients[model_id]
+
+    @staticmethod
+    def _last_user_content(messages: List[Any]) -> Tuple[str, bool]:
+        """Texto del último mensaje del usuario y si incluye imagen"""
+        for message in reversed(messages):
+            if getattr(message, "type", None) == "human":
+                content = message.content
+                has_image = isinstance(content, list) and any(
+                    isinstance(block, dict) and block.get("type") in ("image", "image_url") for block in content
+                )
+                return texto_de_contenido(content), has_image
+        return "", False
+
+    @staticmethod
+    def _strip_cache_points(messages: List[Any]) -> List[Any]:
+        """Quita los checkpoints de caché para modelos que no los soportan"""
+        stripped = []
+        for message in messages:
+            if isinstance(message.content, list):
+                content = [block for block in message.content if not (isinstance(block, dict) and "cachePoint" in block)]
+                message = message.model_copy(update={"content": content})
+            stripped.append(message)
+        return stripped
+
+    def route(self, messages: List[Any], config: Optional[Dict[str, Any]] = None) -> Tuple[str, str, List[Any]]:
+        """
+        Retorna (nivel, model_id, mensajes) para el turno
+
+        Si config["metadata"]["user_message"] existe se clasifica ese texto en lugar del último
+        mensaje completo (que puede incluir el contexto de búsqueda del catálogo).
+        """
+        text, has_image = self._last_user_content(messages)
+        text = ((config or {}).get("metadata") or {}).get("user_message", text)
+        tier, features = self.classifier.classify(text, has_image)
+        model_id = self.policy["models"][tier]
+        self.last_route = {"tier": tier, "model_id": model_id, "features": features}
+        logger.info(f"Consulta enrutada a {model_id} (nivel {tier}, puntaje {features['score']})")
+
+        if not modelo_soporta_cache(model_id):
+            messages = self._strip_cache_points(messages)
+        return tier, model_id, messages
+
+    def _record(self, model_id: str, seconds: float, usage: Optional[Dict[str, int]]):
+        """Acumula las métricas del modelo"""
+        with self._lock:
+            metrics = self.metrics.setdefault(model_id, {
+                "calls": 0,
+                "latencies": deque(maxlen=1000),
+                "input_tokens": 0,
+                "cached_input_tokens": 0,
+                "output_tokens": 0
+            })
+            metrics["calls"] += 1
+            metrics["latencies"].append(seconds)
+            if usage:
+                metrics["input_tokens"] += usage["input_tokens"]
+                metrics["cached_input_tokens"] += usage["cached_input_tokens"]
+                metrics["output_tokens"] += usage["output_tokens"]
+
+    def invoke(self, messages: List[Any], config: Optional[Dict[str, Any]] = None, **kwargs) -> Any:
+        """Invoca el modelo elegido para el turno"""
+        _, model_id, messages = self.route(messages, config)
+        start = time.monotonic()
+        response = self._client(model_id).invoke(messages, config=config, **kwargs)
+        self._record(model_id, time.monotonic() - start, extraer_uso_tokens(response))
+        return response
+
+    def stream(self, messages: List[Any], config: Optional[Dict[str, Any]] = None, **kwargs) -> Iterator[Any]:
+        """Streaming con el modelo elegido para el turno"""
+        _, model_id, messages = self.route(messages, config)
+        start = time.monotonic()
+        usage = None
+        for chunk in self._client(model_id).stream(messages, config=config, **kwargs):
+            if getattr(chunk, "usage_metadata", None):
+                usage = extraer_uso_tokens(chunk)
+            yield chunk
+        self._record(model_id, time.monotonic() - start, usage)
+
+    def get_routing_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Métricas por modelo: llamadas, proporción, latencias y tokens"""
+        with self._lock:
+            total_calls = sum(metrics["calls"] for metrics in self.metrics.values())
+            stats = {}
+            for model_id, metrics in self.metrics.items():
+                latencies = sorted(metrics["latencies"])
+                stats[model_id] = {
+                    "calls": metrics["calls"],
+                    "share": metrics["calls"] / max(total_calls, 1),
+                    "p50_latency": latencies[len(latencies) // 2] if latencies else None,
+                    "avg_latency": sum(latencies) / len(latencies) if latencies else None,
+                    "input_tokens": metrics["input_tokens"],
+                    "cached_input_tokens": metrics["cached_input_tokens"],
+                    "output_tokens": metrics["output_tokens"]
+                }
+            return stats
+
+
+def main():
+    """Compara la latencia mediana con enrutador contra usar siempre Nova Pro (modelo simulado)"""
+    from stub_llm import StubBedrockLLM
+    from langchain_core.messages import HumanMessage
+
+    # Latencia relativa aproximada de cada modelo
+    speed = {"micro": 0.3, "lite": 0.6, "pro": 1.0}
+
+    def stub_factory(model_id: str) -> StubBedrockLLM:
+        tier = next(tier for tier in TIERS if f"nova-{tier}" in model_id)
+        return StubBedrockLLM(
+            model_id=model_id,
+            latencia_base=0.2 * speed[tier],
+            segundos_por_token_salida=0.002 * speed[tier]
+        )
+
+    queries = [
+        ("Hola", "micro"),
+        ("Gracias!", "micro"),
+        ("Busca la pieza PZ0003", "lite"),
+        ("¿Cuánto cuesta el radiador para Aveo 2022?", "lite"),
+        ("Mi auto Chevrolet Aveo 2022 está sobrecalentando y sale humo del cofre, ¿qué pieza falla?", "pro"),
+        ("Se prendió la luz de check engine en el tablero y el auto pierde potencia al acelerar", "pro"),
+        ("Tengo el código P0420 en el OBD, ¿qué tengo que cambiar? ¿es grave?", "pro"),
+        # Un solo síntoma también va a Pro
+        ("El motor se sobrecalienta", "pro"),
+        ("Se me prende el foco del motor", "pro"),
+        ("Mi auto no arranca", "pro"),
+        ("Escucho un ruido raro al frenar", "pro"),
+        ("Tengo una fuga de anticongelante", "pro"),
+        ("Mi carro tira aceite", "pro")
+    ]
+
+    router = ModelRouter(stub_factory)
+    pro_only = stub_factory(DEFAULT_ROUTING_POLICY["models"]["pro"])
+    routed_latencies, pro_latencies = [], []
+
+    for query, expected in queries:
+        start = time.monotonic()
+        router.invoke([HumanMessage(content=query)])
+        routed_latencies.append(time.monotonic() - start)
+
+        start = time.monotonic()
+        pro_only.invoke([HumanMessage(content=query)])
+        pro_latencies.append(time.monotonic() - start)
+
+        tier = router.last_route["tier"]
+        print(f"[{tier:5}] {'OK ' if tier == expected else 'ERR'} {query}")
+
+    routed_latencies.sort()
+    pro_latencies.sort()
+    print(f"Mediana con enrutador: {routed_latencies[len(queries) // 2]:.3f}s")
+    print(f"Mediana solo Nova Pro: {pro_latencies[len(queries) // 2]:.3f}s")
+    for model_id, stats in router.get_routing_stats().items():
+        print(f"{model_id}: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Perfilado opcional por solicitud con un muestreador de pila
+
+Se activa para todas las solicitudes con AUTOPARTES_PROFILE=1, para una fracción con
+AUTOPARTES_PROFILE_SAMPLE (por ejemplo 0.01) o para una solicitud concreta con el header
+X-Autopartes-Profile: 1. Cada perfil se guarda en formato "folded" (una pila por línea con su
+número de muestras), que abren speedscope y flamegraph.pl, con la sesión y el turno en el nombre.
+
+Desactivado, profile_request solo evalúa una condición y retorna un contexto vacío.
+"""
+import os
+import re
+import sys
+import time
+import random
+import logging
+import threading
+import contextlib
+from collections import Counter
+from datetime import datetime
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "X-Autopartes-Profile"
+
+PROFILE_ALWAYS = os.getenv("AUTOPARTES_PROFILE", "0") == "1"
+PROFILE_SAMPLE_RATE = float(os.getenv("AUTOPARTES_PROFILE_SAMPLE", "0"))
+PROFILE_DIR = os.getenv("AUTOPARTES_PROFILE_DIR", "perfiles")
+# Intervalo de muestreo (segundos)
+PROFILE_INTERVAL = float(os.getenv("AUTOPARTES_PROFILE_INTERVAL", "0.005"))
+
+_NOOP = contextlib.nullcontext()
+_local = threading.local()
+
+
+class SamplingProfiler:
+    """
+    Muestrea la pila de un hilo cada interval segundos desde un hilo aparte
+
+    A diferencia de cProfile no instrumenta cada llamada, así el perfil no distorsiona
+    el tiempo de pandas ni de LangChain; el tiempo esperando a Bedrock aparece como
+    pilas bloqueadas en la capa resiliente.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._thread_id: Optional[int] = None
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _fold(frame: Any) -> str:
+        """Pila en formato folded: de la raíz a la hoja, separada por punto y coma"""
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(reversed(stack))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is not None:
+                self.samples[self._fold(frame)] += 1
+
+    def start(self):
+        """Empieza a muestrear el hilo actual"""
+        self._thread_id = threading.get_ident()
+        self._sampler = threading.Thread(target=self._run, daemon=True, name="profiler")
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def write(self, path: str):
+        """Guarda las pilas en formato folded"""
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class _ProfileContext:
+    """Perfila el bloque y guarda el archivo al salir"""
+
+    def __init__(self, session_id: str, turn_id: Any, label: str):
+        self.session_id = session_id
+        self.turn_id = turn_id
+        self.label = label
+        self.profiler = SamplingProfiler()
+        self.path: Optional[str] = None
+
+    def __enter__(self) -> "_ProfileContext":
+        _local.active = True
+        self._start = time.perf_counter()
+        self.profiler.start()
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        self.profiler.stop()
+        _local.active = False
+        elapsed = time.perf_counter() - self._start
+
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            self.path = os.path.join(
+                PROFILE_DIR,
+                f"{_safe_name(self.label)}-{_safe_name(self.session_id)}-turno-{_safe_name(self.turn_id)}-{stamp}.folded"
+            )
+            self.profiler.write(self.path)
+            logger.info(f"Perfil de {elapsed:.3f}s ({sum(self.profiler.samples.values())} muestras) en {self.path}")
+        except OSError as e:
+            logger.error(f"No se pudo guardar el perfil: {str(e)}")
+        return False
+
+
+def _safe_name(value: Any) -> str:
+    """Parte de un nombre de archivo sin separadores de ruta (el session_id puede venir del cliente)"""
+    return re.sub(r"[^\w-]", "_", str(value))
+
+
+def profile_request(session_id: str, turn_id: Any, force: bool = False, label: str = "chat"):
+    """
+    Contexto que perfila el bloque si el perfilado está activo para esta solicitud
+
+    Dentro de un bloque ya perfilado (por ejemplo chat() dentro del rerun de Streamlit)
+    no se abre un segundo perfil: el externo ya cubre el tiempo.
+    """
+    if not (force or PROFILE_ALWAYS or (PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE)):
+        return _NOOP
+    if getattr(_local, "active", False):
+        return _NOOP
+    return _ProfileContext(session_id, turn_id, label)
+
+
+def header_requests_profile(value: Optional[str]) -> bool:
+    """Interpreta el valor del header de perfilado"""
+    return bool(value) and value.strip().lower() in ("1", "true", "si", "sí", "yes")
@@ -1,4 +1,8 @@
-"""
+# Prompt de diagnóstico de piezas.
+# Se divide en un prefijo estático (idéntico en cada turno, cacheable por Bedrock)
+# y un sufijo variable con el contexto de búsqueda y la pregunta del usuario.
+
+prompt_pieza_prefijo = """
 Análisis del problema (texto e imagen):
 
 Texto proporcionado: No has especificado detalles del vehículo (marca, modelo, año) ni síntomas adicionales, solo que la foto muestra un indicador de error en el tablero.
@@ -45,9 +49,13 @@ Advertencia: Algunas luces (como la de aceite o frenos) pueden indicar problemas
 
 Confirmación y claridad:
 Por favor, proporciona más detalles sobre la imagen (¿qué luz o mensaje aparece?) y el vehículo (marca, modelo, año, síntomas). Esto me permitirá identificar la pieza exacta y explicártelo de forma clara, adaptada a tu nivel de conocimiento. Si no estás seguro de qué significa el indicador, describe el símbolo o compárteme cualquier mensaje visible.
+"""
 
+prompt_pieza_sufijo = """{search_context}
 
 Te paso la pregunta del usuario
-{question_user}
+{user_message}
+
+"""
 
-"""
\ No newline at end of file
+prompt_pieza = prompt_pieza_prefijo + prompt_pieza_sufijo
@@ -0,0 +1,97 @@
+import math
+from typing import List, Dict, Any, Optional
+from langchain_core.messages import BaseMessage, SystemMessage, HumanMessage
+
+# Modelos que aceptan checkpoints de caché (cachePoint) en la API Converse
+MODELOS_CON_CACHE = (
+    "amazon.nova-micro",
+    "amazon.nova-lite",
+    "amazon.nova-pro",
+    "anthropic.claude-3-5-haiku",
+    "anthropic.claude-3-7-sonnet",
+)
+
+# model_id que delega la elección del modelo al enrutador (todos los niveles son Nova)
+MODELO_ENRUTADO = "auto"
+
+# Bedrock ignora los checkpoints cuyo prefijo no alcanza este tamaño
+MIN_TOKENS_CHECKPOINT = 1024
+
+# El texto del proyecto es en español: ~3.5 caracteres por token
+CARACTERES_POR_TOKEN = 3.5
+
+CACHE_POINT = {"cachePoint": {"type": "default"}}
+
+
+def estimar_tokens(texto: str) -> int:
+    """Estimación rápida de tokens de un texto"""
+    if not texto:
+        return 0
+    return math.ceil(len(texto) / CARACTERES_POR_TOKEN)
+
+
+def modelo_soporta_cache(model_id: str) -> bool:
+    """Indica si el modelo soporta prompt caching en Converse"""
+    if model_id == MODELO_ENRUTADO:
+        return True
+    return any(modelo in model_id for modelo in MODELOS_CON_CACHE)
+
+
+def construir_mensajes(prefijo_sistema: str, mensaje_usuario: Any, model_id: str,
+                       historial: Optional[List[BaseMessage]] = None) -> List[BaseMessage]:
+    """
+    Construye la lista de mensajes con el prefijo estático primero y el sufijo variable al final
+
+    Args:
+        prefijo_sistema: Texto estático (igual en todos los turnos)
+        mensaje_usuario: Parte variable del turno (texto o bloques de contenido)
+        model_id: ID del modelo, para decidir si se agrega el checkpoint de caché
+        historial: Mensajes anteriores de la conversación
+
+    Returns:
+        Mensajes listos para ChatBedrockConverse.invoke
+    """
+    contenido_sistema = [{"type": "text", "text": prefijo_sistema}]
+    if modelo_soporta_cache(model_id):
+        # Todo lo anterior al checkpoint se reutiliza entre turnos
+        contenido_sistema.append(dict(CACHE_POINT))
+
+    return [
+        SystemMessage(content=contenido_sistema),
+        *(historial or []),
+        HumanMessage(content=mensaje_usuario)
+    ]
+
+
+def texto_de_contenido(contenido: Any) -> str:
+    """Texto de un contenido de mensaje (str o lista de bloques, como en los chunks de Converse)"""
+    if isinstance(contenido, str):
+        return contenido
+    return "".join(
+        bloque if isinstance(bloque, str) else bloque.get("text", "")
+        for bloque in contenido
+        if isinstance(bloque, (str, dict))
+    )
+
+
+def extraer_uso_tokens(respuesta: Any) -> Dict[str, int]:
+    """
+    Extrae el uso de tokens (con y sin caché) de la respuesta del modelo
+
+    En Converse, inputTokens solo cuenta los tokens sin caché; los leídos y escritos en caché
+    llegan aparte (input_token_details en usage_metadata de langchain_aws).
+    """
+    uso = getattr(respuesta, "usage_metadata", None) or {}
+    detalles = uso.get("input_token_details") or {}
+
+    uncached_input_tokens = uso.get("input_tokens", 0) or 0
+    cached_input_tokens = detalles.get("cache_read", 0) or 0
+    cache_write_tokens = detalles.get("cache_creation", 0) or 0
+
+    return {
+        "input_tokens": uncached_input_tokens + cached_input_tokens + cache_write_tokens,
+        "cached_input_tokens": cached_input_tokens,
+        "cache_write_tokens": cache_write_tokens,
+        "uncached_input_tokens": uncached_input_tokens,
+        "output_tokens": uso.get("output_tokens", 0) or 0
+    }
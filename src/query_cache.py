@@ -0,0 +1,86 @@
+"""
+Caché de resultados de consultas al catálogo, compartida por todas las sesiones del proceso
+
+Guarda las posiciones de fila que cumple cada combinación de filtros (marca, modelo, pieza) y el
+top-k de cada búsqueda del chatbot, con la versión del catálogo en la clave: al publicar una
+versión nueva las entradas anteriores dejan de usarse y salen por LRU. Repetir una consulta
+cuesta una búsqueda en un diccionario en lugar de recalcular las máscaras sobre todo el catálogo.
+"""
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Callable, Hashable, Tuple
+
+import numpy as np
+
+DEFAULT_MAX_ENTRIES = 1024
+
+
+def canonical_filters(filters: Dict[str, List[Any]]) -> Tuple[Tuple[str, Tuple[str, ...]], ...]:
+    """Filtros en forma canónica: columnas y valores ordenados, sin repetidos ni listas vacías"""
+    return tuple(
+        (column, tuple(sorted({str(value) for value in values})))
+        for column, values in sorted(filters.items())
+        if values
+    )
+
+
+def frozen_positions(positions: np.ndarray) -> np.ndarray:
+    """Posiciones de solo lectura: el arreglo se comparte entre sesiones"""
+    positions = np.asarray(positions, dtype=np.int64)
+    positions.setflags(write=False)
+    return positions
+
+
+class QueryResultCache:
+    """LRU acotada de resultados por (catálogo, versión, consulta) con conteo de aciertos"""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """
+        Retorna el resultado en caché o lo calcula con compute() y lo guarda
+
+        compute se ejecuta fuera del lock; si dos sesiones fallan a la vez ambas calculan y la
+        segunda escritura reemplaza a la primera con el mismo valor.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        value = compute()
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+# Compartida por todos los buscadores (y sesiones de Streamlit) del proceso
+DEFAULT_QUERY_CACHE = QueryResultCache()
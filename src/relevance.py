@@ -0,0 +1,256 @@
+"""
+Ranking de relevancia del catálogo con BM25 y top-k con heap acotado
+
+El índice invertido se construye una vez por catálogo sobre los campos de texto (nombre de la
+pieza, descripción, compatibilidad, fabricante, ...). Cada consulta suma:
+    - BM25 de los términos de la consulta sobre los campos de texto
+    - un bono si la consulta coincide completa con una columna (por ejemplo el ID) o la contiene
+    - bonos si la consulta menciona la marca, el modelo o el año de la fila
+Solo se construyen los resultados del top-k, elegidos con un heap de tamaño k en lugar de
+ordenar todas las coincidencias.
+
+Las listas de filas por término se guardan en formato CSR (vocabulario, offsets y arreglos planos),
+así el índice se puede publicar junto con el catálogo compartido y los workers lo abren mapeado
+en memoria en lugar de construir cada uno su copia.
+"""
+import os
+import re
+import json
+import heapq
+import bisect
+import unicodedata
+from collections import Counter
+from typing import List, Dict, Any, Optional, Iterable, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from string_blob import StringBlob
+
+ID_COLUMN = "ID"
+
+# Columnas que se bonifican cuando la consulta menciona su valor (marca, modelo y año)
+BOOST_FIELDS = {"Marca de Auto": 2.0, "Modelo": 2.5, "Año": 1.5}
+
+# Bonos por coincidencia del identificador completo con alguna columna
+EXACT_MATCH_SCORE = 10.0
+PARTIAL_MATCH_SCORE = 1.0
+
+# Parámetros de BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Minúsculas, sin acentos y separado en palabras"""
+    text = unicodedata.normalize("NFKD", str(text).lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return _TOKEN_PATTERN.findall(text)
+
+
+def _column_tokens(series: pd.Series) -> List[List[str]]:
+    """Tokens de cada fila; en columnas categóricas se tokeniza cada categoría una sola vez"""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        by_code = [tokenize(value) for value in series.cat.categories.astype(str)]
+        return [by_code[code] if code >= 0 else [] for code in series.cat.codes.to_numpy()]
+    return [tokenize(value) if pd.notna(value) else [] for value in series.to_numpy(dtype=object)]
+
+
+class Postings:
+    """Filas (y pesos opcionales) por término en formato CSR; el vocabulario está ordenado"""
+
+    def __init__(self, vocabulary: Sequence[str], offsets: np.ndarray, rows: np.ndarray,
+                 weights: Optional[np.ndarray] = None):
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.rows = rows
+        self.weights = weights
+        # Vocabulario construido aquí: diccionario. Abierto de disco (mapeado): búsqueda binaria,
+        # así ningún proceso guarda una copia privada del vocabulario
+        self._token_ids = {token: i for i, token in enumerate(vocabulary)} if isinstance(vocabulary, list) else None
+
+    @classmethod
+    def build(cls, rows_by_token: Dict[str, List[int]],
+              weights_by_token: Optional[Dict[str, List[float]]] = None) -> "Postings":
+        vocabulary = sorted(rows_by_token)
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum([len(rows_by_token[token]) for token in vocabulary], out=offsets[1:])
+        rows = np.fromiter((row for token in vocabulary for row in rows_by_token[token]),
+                           dtype=np.int32, count=int(offsets[-1]))
+        weights = None
+        if weights_by_token is not None:
+            weights = np.fromiter((weight for token in vocabulary for weight in weights_by_token[token]),
+                                  dtype=np.float64, count=int(offsets[-1]))
+        return cls(vocabulary, offsets, rows, weights)
+
+    def __len__(self) -> int:
+        return len(self.vocabulary)
+
+    def token_id(self, token: str) -> Optional[int]:
+        """Posición del término en el vocabulario (None si no aparece)"""
+        if self._token_ids is not None:
+            return self._token_ids.get(token)
+        position = bisect.bisect_left(self.vocabulary, token)
+        if position < len(self.vocabulary) and self.vocabulary[position] == token:
+            return position
+        return None
+
+    def span(self, token_id: int) -> slice:
+        """Rango del término en rows y weights"""
+        return slice(int(self.offsets[token_id]), int(self.offsets[token_id + 1]))
+
+    def document_frequencies(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def save(self, directory: str, name: str) -> Dict[str, Any]:
+        """Guarda los arreglos como .npy y retorna la entrada del manifiesto"""
+        np.save(os.path.join(directory, f"{name}_offsets.npy"), self.offsets)
+        np.save(os.path.join(directory, f"{name}_rows.npy"), self.rows)
+        if self.weights is not None:
+            np.save(os.path.join(directory, f"{name}_weights.npy"), self.weights)
+        vocabulary = self.vocabulary if isinstance(self.vocabulary, StringBlob) else StringBlob.from_strings(self.vocabulary)
+        vocabulary.save(directory, f"{name}_vocab")
+        return {"name": name, "weights": self.weights is not None}
+
+    @classmethod
+    def load(cls, directory: str, entry: Dict[str, Any], mmap_mode: Optional[str] = "r") -> "Postings":
+        name = entry["name"]
+        weights = None
+        if entry["weights"]:
+            weights = np.load(os.path.join(directory, f"{name}_weights.npy"), mmap_mode=mmap_mode)
+        return cls(
+            StringBlob.load(directory, f"{name}_vocab", mmap_mode),
+            np.load(os.path.join(directory, f"{name}_offsets.npy"), mmap_mode=mmap_mode),
+            np.load(os.path.join(directory, f"{name}_rows.npy"), mmap_mode=mmap_mode),
+            weights
+        )
+
+
+class BM25Index:
+    """Índice invertido de un catálogo (posiciones de fila, no etiquetas del índice)"""
+
+    def __init__(self, df: Optional[pd.DataFrame], text_fields: Optional[List[str]] = None,
+                 boost_fields: Optional[Dict[str, float]] = None,
+                 k1: float = BM25_K1, b: float = BM25_B):
+        """
+        Args:
+            df: Catálogo (ya compactado o no)
+            text_fields: Campos para BM25 (por defecto, todas las columnas de texto menos el ID)
+            boost_fields: Columna -> bono cuando la consulta menciona su valor
+        """
+        if df is None:
+            # Construido por load() a partir de un índice publicado
+            return
+        if text_fields is None:
+            text_fields = [column for column in df.columns
+                           if column != ID_COLUMN and not pd.api.types.is_numeric_dtype(df[column].dtype)]
+        boost_fields = BOOST_FIELDS if boost_fields is None else boost_fields
+        self.text_fields = [field for field in text_fields if field in df.columns]
+        self.boost_fields = {field: boost for field, boost in boost_fields.items() if field in df.columns}
+        self.num_rows = len(df)
+
+        term_counts = [Counter() for _ in range(self.num_rows)]
+        for field in self.text_fields:
+            for position, tokens in enumerate(_column_tokens(df[field])):
+                term_counts[position].update(tokens)
+
+        lengths = np.array([sum(counts.values()) for counts in term_counts], dtype=np.float64)
+        avg_length = lengths.mean() if self.num_rows else 0.0
+        norms = k1 * (1 - b + b * lengths / avg_length) if avg_length else np.full(self.num_rows, k1)
+
+        # El factor de frecuencia de BM25 depende solo de la fila: se precalcula por posting
+        rows_by_token: Dict[str, List[int]] = {}
+        weights_by_token: Dict[str, List[float]] = {}
+        for position, counts in enumerate(term_counts):
+            for token, tf in counts.items():
+                rows_by_token.setdefault(token, []).append(position)
+                weights_by_token.setdefault(token, []).append(tf * (k1 + 1) / (tf + norms[position]))
+
+        self.postings = Postings.build(rows_by_token, weights_by_token)
+        frequencies = self.postings.document_frequencies()
+        self.idf = np.log(1 + (self.num_rows - frequencies + 0.5) / (frequencies + 0.5))
+
+        # Filas por token de cada columna bonificada (marca, modelo, año)
+        self.boost_postings: Dict[str, Postings] = {}
+        for field in self.boost_fields:
+            rows_by_field_token: Dict[str, List[int]] = {}
+            for position, tokens in enumerate(_column_tokens(df[field])):
+                for token in set(tokens):
+                    rows_by_field_token.setdefault(token, []).append(position)
+            self.boost_postings[field] = Postings.build(rows_by_field_token)
+
+    def save(self, directory: str):
+        """Guarda el índice en directory (por ejemplo, junto con una versión del catálogo compartido)"""
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "idf.npy"), self.idf)
+        manifest = {
+            "num_rows": self.num_rows,
+            "text_fields": self.text_fields,
+            "boost_fields": self.boost_fields,
+            "postings": self.postings.save(directory, "terms"),
+            "boost_postings": {
+                field: postings.save(directory, f"boost_{i}")
+                for i, (field, postings) in enumerate(self.boost_postings.items())
+            }
+        }
+        with open(os.path.join(directory, "index.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, directory: str, mmap_mode: Optional[str] = "r") -> "BM25Index":
+        """Abre un índice guardado con save(); los arreglos quedan mapeados en memoria"""
+        with open(os.path.join(directory, "index.json"), encoding="utf-8") as f:
+            manifest = json.load(f)
+        index = cls(None)
+        index.num_rows = manifest["num_rows"]
+        index.text_fields = manifest["text_fields"]
+        index.boost_fields = manifest["boost_fields"]
+        index.postings = Postings.load(directory, manifest["postings"], mmap_mode)
+        index.idf = np.load(os.path.join(directory, "idf.npy"), mmap_mode=mmap_mode)
+        index.boost_postings = {
+            field: Postings.load(directory, entry, mmap_mode)
+            for field, entry in manifest["boost_postings"].items()
+        }
+        return index
+
+    def score(self, query: str) -> np.ndarray:
+        """Puntaje BM25 más los bonos de marca, modelo y año de cada fila"""
+        scores = np.zeros(self.num_rows, dtype=np.float64)
+        tokens = set(tokenize(query))
+        for token in tokens:
+            token_id = self.postings.token_id(token)
+            if token_id is not None:
+                span = self.postings.span(token_id)
+                scores[self.postings.rows[span]] += self.idf[token_id] * self.postings.weights[span]
+
+        for field, boost in self.boost_fields.items():
+            postings = self.boost_postings[field]
+            for token in tokens:
+                token_id = postings.token_id(token)
+                if token_id is not None:
+                    scores[postings.rows[postings.span(token_id)]] += boost
+        return scores
+
+    def matched_field(self, df: pd.DataFrame, position: int, query: str) -> Optional[str]:
+        """Campo de la fila que comparte más términos con la consulta (solo para los resultados del top-k)"""
+        tokens = set(tokenize(query))
+        best_field, best_overlap = None, 0
+        for field in [*self.boost_fields, *self.text_fields]:
+            overlap = len(tokens.intersection(tokenize(df[field].iat[position])))
+            if overlap > best_overlap:
+                best_field, best_overlap = field, overlap
+        return best_field
+
+
+def top_k_positions(scores: np.ndarray, k: int) -> List[Tuple[float, int]]:
+    """
+    Las k filas de mayor puntaje como (puntaje, posición)
+
+    heapq.nlargest mantiene un heap de tamaño k mientras recorre los candidatos; a igual
+    puntaje conserva el orden del catálogo.
+    """
+    candidates: Iterable[int] = np.flatnonzero(scores > 0).tolist()
+    positions = heapq.nlargest(k, candidates, key=scores.__getitem__)
+    return [(float(scores[position]), position) for position in positions]
@@ -0,0 +1,475 @@
+import os
+import time
+import uuid
+import random
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Any, Optional, Callable, Iterator
+
+import boto3
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from prompt_cache import texto_de_contenido
+
+logger = logging.getLogger(__name__)
+
+# Regiones que ofrece la barra lateral de configuración
+REGIONES_BEDROCK = ["us-east-2", "us-east-1", "us-west-2", "eu-west-1"]
+
+# Códigos de error de Bedrock que vale la pena reintentar
+CODIGOS_REINTENTABLES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+    "InternalServerException"
+}
+
+# Configuración del cliente boto3: el plazo por turno y los reintentos los maneja ResilientLLM,
+# así que el cliente no debe quedarse esperando ni reintentar por su cuenta
+BEDROCK_CLIENT_CONFIG = boto3.session.Config(
+    read_timeout=60,
+    connect_timeout=5,
+    retries={'max_attempts': 1, 'mode': 'standard'}
+)
+
+
+class DeadlineExceededError(TimeoutError):
+    """El turno superó el plazo máximo configurado"""
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """Indica si el error es de throttling o disponibilidad (mismo formato que botocore ClientError)"""
+    response = getattr(error, "response", None) or {}
+    code = response.get("Error", {}).get("Code", "")
+    return code in CODIGOS_REINTENTABLES
+
+
+def is_throttling_error(error: Exception) -> bool:
+    """Indica si el error es por exceso de solicitudes"""
+    response = getattr(error, "response", None) or {}
+    code = response.get("Error", {}).get("Code", "")
+    return code in ("ThrottlingException", "TooManyRequestsException")
+
+
+def model_for_region(model_id: str, region: str) -> str:
+    """Ajusta el prefijo del perfil de inferencia (us./eu./apac.) a la región indicada"""
+    prefixes = {"us": "us.", "eu": "eu.", "ap": "apac."}
+    for prefix in prefixes.values():
+        if model_id.startswith(prefix):
+            return prefixes.get(region.split("-")[0], prefix) + model_id[len(prefix):]
+    return model_id
+
+
+def default_hedge_region(primary_region: str, regions: List[str] = REGIONES_BEDROCK) -> Optional[str]:
+    """Elige la región para solicitudes duplicadas, preferentemente de la misma geografía"""
+    others = [region for region in regions if region != primary_region]
+    same_geography = [region for region in others if region.split("-")[0] == primary_region.split("-")[0]]
+    return (same_geography or others or [None])[0]
+
+
+class AdaptiveConcurrencyLimiter:
+    """Limita las llamadas concurrentes al modelo con AIMD: sube de a poco con éxitos y se reduce a la mitad con throttling"""
+
+    def __init__(self, initial_limit: float = 8, min_limit: float = 1, max_limit: float = 64):
+        self.limit = float(initial_limit)
+        self.min_limit = float(min_limit)
+        self.max_limit = float(max_limit)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Espera un espacio libre; retorna False si se agota el tiempo"""
+        with self._condition:
+            acquired = self._condition.wait_for(lambda: self.in_flight < int(self.limit), timeout=timeout)
+            if acquired:
+                self.in_flight += 1
+            return acquired
+
+    def release(self, throttled: bool = False):
+        """Libera el espacio y ajusta el límite según el resultado"""
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.min_limit, self.limit / 2)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+# Limitador y pool de hilos por modelo, compartidos por todas las sesiones del proceso
+_shared_resources: Dict[str, Any] = {}
+_shared_resources_lock = threading.Lock()
+
+
+def shared_invocation_resources(key: str) -> Any:
+    """
+    (limitador, pool de hilos) compartidos del proceso para un modelo
+
+    Streamlit crea un ResilientLLM por sesión: con recursos propios cada limitador solo vería
+    las llamadas de su sesión y el AIMD no limitaría nada.
+    """
+    with _shared_resources_lock:
+        if key not in _shared_resources:
+            limiter = AdaptiveConcurrencyLimiter()
+            executor = ThreadPoolExecutor(max_workers=int(limiter.max_limit) * 2,
+                                          thread_name_prefix=f"bedrock-{key}")
+            _shared_resources[key] = (limiter, executor)
+        return _shared_resources[key]
+
+
+class LatencyTracker:
+    """Ventana de latencias recientes para estimar percentiles"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        """Percentil de la ventana, o None si aún no hay suficientes muestras"""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+
+class _StreamGate:
+    """Decide qué intento puede escribir tokens en los callbacks del usuario"""
+
+    def __init__(self):
+        self.owner: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def claim(self, attempt: str) -> bool:
+        with self._lock:
+            if self.owner is None:
+                self.owner = attempt
+            return self.owner == attempt
+
+
+class _GatedCallbackHandler(BaseCallbackHandler):
+    """Reenvía tokens a los callbacks originales solo si el intento es dueño del stream"""
+
+    def __init__(self, handlers: List[BaseCallbackHandler], gate: _StreamGate, attempt: str):
+        self.handlers = handlers
+        self.gate = gate
+        self.attempt = attempt
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        if self.gate.claim(self.attempt):
+            for handler in self.handlers:
+                handler.on_llm_new_token(token, **kwargs)
+
+    def on_llm_end(self, response: LLMResult, **kwargs) -> None:
+        if self.gate.claim(self.attempt):
+            for handler in self.handlers:
+                handler.on_llm_end(response, **kwargs)
+
+
+class ResilientLLM:
+    """
+    Capa de invocación resiliente sobre ChatBedrockConverse
+
+    - Plazo máximo por turno (deadline_seconds)
+    - Reintentos con backoff exponencial y jitter ante throttling
+    - Limitador de concurrencia adaptativo (AIMD)
+    - Hedging opcional: si el primer intento supera el percentil hedge_percentile de latencia
+      sin emitir tokens, se envía un segundo intento a otra región y se usa el que termine primero
+    """
+
+    def __init__(self, llm_factory: Callable[[str], Any], primary_region: str,
+                 hedge_region: Optional[str] = None, hedging: bool = False,
+                 deadline_seconds: float = 60.0, max_attempts: int = 4,
+                 backoff_base: float = 0.25, backoff_max: float = 4.0,
+                 hedge_initial_delay: float = 3.0, hedge_percentile: float = 90,
+                 limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                 executor: Optional[ThreadPoolExecutor] = None):
+        """
+        Args:
+            llm_factory: Crea el cliente del modelo para una región
+            primary_region: Región principal
+            hedge_region: Región para el intento duplicado (por defecto, otra de REGIONES_BEDROCK)
+            hedging: Activa las solicitudes duplicadas
+            deadline_seconds: Plazo máximo por turno, incluidos reintentos
+            max_attempts: Intentos máximos ante throttling
+            backoff_base: Espera base del backoff exponencial (segundos)
+            backoff_max: Espera máxima entre intentos (segundos)
+            hedge_initial_delay: Espera antes de duplicar mientras no hay suficientes muestras para el percentil
+            hedge_percentile: Percentil de latencia tras el cual se duplica. Con el p95 basta que el 5%
+                de la ventana sean respuestas lentas para que la espera sea la de una respuesta lenta
+                y el hedging deje de servir
+            limiter: Limitador de concurrencia compartido
+            executor: Pool de hilos para los intentos (compartido junto con el limitador)
+        """
+        self.llm_factory = llm_factory
+        self.primary_region = primary_region
+        self.hedge_region = hedge_region or default_hedge_region(primary_region)
+        self.hedging = hedging and self.hedge_region is not None
+        self.deadline_seconds = deadline_seconds
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_initial_delay = hedge_initial_delay
+        self.hedge_percentile = hedge_percentile
+        self.limiter = limiter or AdaptiveConcurrencyLimiter()
+        # Latencia de respuestas completas (define la espera del hedging) y, aparte, tiempo al
+        # primer fragmento en streaming: mezclarlas bajaría el percentil y se duplicaría demasiado pronto
+        self.latencies = LatencyTracker()
+        self.first_token_latencies = LatencyTracker()
+
+        self._clients: Dict[str, Any] = {}
+        self._clients_lock = threading.Lock()
+        self._executor = executor or ThreadPoolExecutor(max_workers=int(self.limiter.max_limit) * 2,
+                                                        thread_name_prefix="bedrock")
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            "calls": 0,
+            "attempts": 0,
+            "retries": 0,
+            "throttled": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "deadline_exceeded": 0
+        }
+
+    def _count(self, key: str, amount: int = 1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def _client(self, region: str) -> Any:
+        """Cliente del modelo por región, creado una sola vez"""
+        with self._clients_lock:
+            if region not in self._clients:
+                self._clients[region] = self.llm_factory(region)
+            return self._clients[region]
+
+    def create_clients(self):
+        """Crea por adelantado los clientes de la región principal y, con hedging, de la secundaria"""
+        self._client(self.primary_region)
+        if self.hedging:
+            self._client(self.hedge_region)
+
+    def _remaining(self, deadline: float) -> float:
+        return deadline - time.monotonic()
+
+    def _backoff(self, attempt: int, deadline: float):
+        """Espera con backoff exponencial y jitter completo antes del siguiente intento"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+        if delay >= self._remaining(deadline):
+            self._count("deadline_exceeded")
+            raise DeadlineExceededError(f"Plazo de {self.deadline_seconds}s agotado tras {attempt} intentos")
+        time.sleep(delay)
+
+    def _timed_invoke(self, region: str, messages: Any, config: Optional[Dict[str, Any]], **kwargs) -> Any:
+        self._count("attempts")
+        start = time.monotonic()
+        response = self._client(region).invoke(messages, config=config, **kwargs)
+        self.latencies.record(time.monotonic() - start)
+        return response
+
+    def _release_when_done(self, futures: List[Future]):
+        """
+        Libera el espacio del limitador cuando terminan todos los intentos de la llamada
+
+        Los intentos abandonados (el perdedor del hedging o los que siguen al agotarse el plazo)
+        siguen ocupando una conexión con Bedrock: liberar antes dejaría pasar más llamadas de las
+        que permite el límite.
+        """
+        if not futures:
+            self.limiter.release()
+            return
+        lock = threading.Lock()
+        remaining = [len(futures)]
+
+        def on_done(_: Future):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            errors = [future.exception() for future in futures if not future.cancelled()]
+            self.limiter.release(throttled=any(error is not None and is_throttling_error(error) for error in errors))
+
+        for future in futures:
+            future.add_done_callback(on_done)
+
+    def _invoke_once(self, messages: Any, config: Optional[Dict[str, Any]], deadline: float, **kwargs) -> Any:
+        """Un intento (posiblemente duplicado en otra región) dentro del plazo"""
+        if not self.limiter.acquire(timeout=max(self._remaining(deadline), 0)):
+            self._count("deadline_exceeded")
+            raise DeadlineExceededError("Sin capacidad disponible dentro del plazo")
+
+        futures: List[Future] = []
+        try:
+            handlers = list((config or {}).get("callbacks") or [])
+            gate = _StreamGate()
+            primary_config = {**(config or {}), "callbacks": [_GatedCallbackHandler(handlers, gate, "primary")]}
+            primary = self._executor.submit(self._timed_invoke, self.primary_region, messages, primary_config, **kwargs)
+            futures.append(primary)
+            pending = {primary}
+
+            if self.hedging:
+                hedge_delay = self.latencies.percentile(self.hedge_percentile) or self.hedge_initial_delay
+                done, _ = wait(pending, timeout=min(hedge_delay, max(self._remaining(deadline), 0)))
+                # Solo se duplica si el primer intento sigue sin emitir tokens
+                if not done and self._remaining(deadline) > 0 and gate.owner is None:
+                    self._count("hedges")
+                    logger.info(f"Duplicando solicitud en {self.hedge_region} tras {hedge_delay:.2f}s")
+                    hedge_config = {key: value for key, value in (config or {}).items() if key != "callbacks"}
+                    hedge = self._executor.submit(self._timed_invoke, self.hedge_region, messages,
+                                                  hedge_config, **kwargs)
+                    futures.append(hedge)
+                    pending.add(hedge)
+
+            error = None
+            while pending:
+                done, pending = wait(pending, timeout=max(self._remaining(deadline), 0), return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    if future.exception() is not None:
+                        error = future.exception()
+                        continue
+                    response = future.result()
+                    if future is not primary:
+                        if not gate.claim("hedge"):
+                            # El primer intento ya está emitiendo tokens: se espera a que termine
+                            continue
+                        self._count("hedge_wins")
+                        run_id = uuid.uuid4()
+                        for handler in handlers:
+                            handler.on_llm_new_token(texto_de_contenido(response.content), run_id=run_id)
+                            handler.on_llm_end(LLMResult(generations=[]), run_id=run_id)
+                    return response
+
+            if error is not None:
+                raise error
+            self._count("deadline_exceeded")
+            raise DeadlineExceededError(f"Plazo de {self.deadline_seconds}s agotado esperando al modelo")
+        finally:
+            self._release_when_done(futures)
+
+    def invoke(self, messages: Any, config: Optional[Dict[str, Any]] = None, **kwargs) -> Any:
+        """Invoca el modelo con plazo, reintentos, limitador y hedging"""
+        self._count("calls")
+        deadline = time.monotonic() + self.deadline_seconds
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return self._invoke_once(messages, config, deadline, **kwargs)
+            except Exception as e:
+                if not is_retryable_error(e) or attempt >= self.max_attempts:
+                    raise
+                if is_throttling_error(e):
+                    self._count("throttled")
+                self._count("retries")
+                logger.warning(f"Reintentando llamada a Bedrock ({attempt}/{self.max_attempts}): {str(e)}")
+                self._backoff(attempt, deadline)
+
+    def stream(self, messages: Any, config: Optional[Dict[str, Any]] = None, **kwargs) -> Iterator[Any]:
+        """Streaming con plazo y reintentos hasta recibir el primer fragmento (sin hedging)"""
+        self._count("calls")
+        deadline = time.monotonic() + self.deadline_seconds
+        attempt = 0
+        while True:
+            attempt += 1
+            if not self.limiter.acquire(timeout=max(self._remaining(deadline), 0)):
+                self._count("deadline_exceeded")
+                raise DeadlineExceededError("Sin capacidad disponible dentro del plazo")
+            throttled = False
+            started = False
+            try:
+                self._count("attempts")
+                start = time.monotonic()
+                for chunk in self._client(self.primary_region).stream(messages, config=config, **kwargs):
+                    if not started:
+                        started = True
+                        self.first_token_latencies.record(time.monotonic() - start)
+                    yield chunk
+                    if self._remaining(deadline) <= 0:
+                        self._count("deadline_exceeded")
+                        raise DeadlineExceededError(f"Plazo de {self.deadline_seconds}s agotado durante el streaming")
+                return
+            except Exception as e:
+                throttled = is_throttling_error(e)
+                # Una vez emitidos fragmentos ya no se puede reintentar sin duplicar texto
+                if started or not is_retryable_error(e) or attempt >= self.max_attempts:
+                    raise
+                if throttled:
+                    self._count("throttled")
+                self._count("retries")
+                logger.warning(f"Reintentando streaming de Bedrock ({attempt}/{self.max_attempts}): {str(e)}")
+            finally:
+                self.limiter.release(throttled=throttled)
+            self._backoff(attempt, deadline)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Estadísticas de la capa de invocación"""
+        with self._stats_lock:
+            stats = dict(self.stats)
+        return {
+            **stats,
+            "concurrency_limit": round(self.limiter.limit, 2),
+            "in_flight": self.limiter.in_flight,
+            "p95_latency": self.latencies.percentile(95),
+            "p95_first_token": self.first_token_latencies.percentile(95)
+        }
+
+
+def create_resilient_llm(llm_factory: Callable[[str], Any], primary_region: str,
+                         shared_key: Optional[str] = None) -> ResilientLLM:
+    """
+    Crea la capa resiliente con la configuración de las variables de entorno
+
+    Con shared_key (por ejemplo el model_id) el limitador y el pool de hilos son los del proceso
+    para ese modelo, así varias instancias (una por sesión de Streamlit) comparten la concurrencia.
+    """
+    limiter, executor = shared_invocation_resources(shared_key) if shared_key else (None, None)
+    return ResilientLLM(
+        llm_factory,
+        primary_region,
+        limiter=limiter,
+        executor=executor,
+        hedge_region=os.getenv("AUTOPARTES_HEDGE_REGION") or None,
+        hedging=os.getenv("AUTOPARTES_HEDGING", "0") == "1",
+        deadline_seconds=float(os.getenv("AUTOPARTES_DEADLINE_S", "60"))
+    )
+
+
+def main():
+    """Compara la latencia con y sin hedging contra el modelo simulado con lentitud y throttling inyectados"""
+    from stub_llm import StubBedrockLLM
+    from langchain_core.messages import HumanMessage
+
+    def stub_factory(region: str) -> StubBedrockLLM:
+        return StubBedrockLLM(
+            latencia_base=0.05,
+            segundos_por_token_salida=0.0,
+            probabilidad_lentitud=0.03,
+            latencia_lenta=2.0,
+            probabilidad_throttling=0.05
+        )
+
+    for hedging in (False, True):
+        llm = ResilientLLM(stub_factory, "us-east-2", hedging=hedging, deadline_seconds=10,
+                           hedge_initial_delay=0.2, backoff_base=0.05)
+        latencies = []
+        for i in range(200):
+            start = time.monotonic()
+            llm.invoke([HumanMessage(content=f"consulta {i}")])
+            latencies.append(time.monotonic() - start)
+        latencies.sort()
+        print(f"hedging={hedging}: p50={latencies[99]:.3f}s p95={latencies[189]:.3f}s "
+              f"p99={latencies[197]:.3f}s stats={llm.get_stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Comparación del orden actual de search_piece contra el ranking BM25 con top-k
+
+Las consultas se generan del propio catálogo a partir de atributos de una fila (ID, modelo,
+pieza + marca + modelo, pieza + año); la relevancia de cada fila es el número de atributos
+que cumple. Se reporta precision@k (filas que cumplen todos los atributos, sobre el máximo
+alcanzable), nDCG@k y la latencia de cada búsqueda.
+
+En esas consultas el texto es exactamente el valor de los atributos, así que cualquier orden que
+busque coincidencias las resuelve casi siempre. Las consultas de control (pieza_parcial y
+con_errores) escriben el texto como un usuario: solo la primera palabra de la pieza, o con letras
+transpuestas. Se juzgan con los mismos atributos de la fila original, que el texto ya no contiene.
+
+Ejemplo desde la carpeta src (catálogo replicado 100 veces):
+    python search_benchmark.py --factor 100 --consultas 200
+"""
+import os
+import sys
+import math
+import time
+import random
+import logging
+import argparse
+import tempfile
+from typing import List, Dict, Any, Tuple
+
+import numpy as np
+import pandas as pd
+
+from model import LocalCSVSearcher
+from query_cache import QueryResultCache
+from load_test import percentile
+
+# Atributos que forman cada tipo de consulta
+QUERY_TYPES = {
+    "id": ["ID"],
+    "modelo": ["Modelo"],
+    "pieza_marca_modelo": ["Nombre de Pieza", "Marca de Auto", "Modelo"],
+    "pieza_año": ["Nombre de Pieza", "Año"]
+}
+
+# Consultas de control: atributos con que se juzgan (el texto se arma en query_text)
+HELD_OUT_TYPES = {
+    "pieza_parcial": ["Nombre de Pieza", "Modelo"],
+    "con_errores": ["Nombre de Pieza", "Marca de Auto", "Modelo"]
+}
+
+STRATEGIES = ("actual", "bm25")
+
+
+def replicate_catalog(df: pd.DataFrame, factor: int) -> pd.DataFrame:
+    """Repite el catálogo factor veces con IDs únicos"""
+    if factor <= 1:
+        return df
+    copies = []
+    for copy in range(factor):
+        part = df.copy()
+        part["ID"] = part["ID"].astype(str) + f"-{copy:04d}"
+        copies.append(part)
+    return pd.concat(copies, ignore_index=True)
+
+
+def misspell(word: str, rng: random.Random) -> str:
+    """Transpone dos letras contiguas del interior de la palabra (las palabras cortas no cambian)"""
+    if len(word) < 5:
+        return word
+    i = rng.randrange(1, len(word) - 2)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+
+def query_text(query_type: str, attributes: Dict[str, Any], rng: random.Random) -> str:
+    """Texto de la consulta; en las de control no coincide literalmente con los atributos"""
+    values = [str(value) for value in attributes.values()]
+    if query_type == "pieza_parcial":
+        piece, model = values
+        return f"{piece.split()[0].lower()} {model.lower()}"
+    if query_type == "con_errores":
+        return " ".join(misspell(word, rng) for value in values for word in value.split())
+    return " ".join(values)
+
+
+def build_queries(df: pd.DataFrame, count: int, seed: int) -> List[Dict[str, Any]]:
+    """Consultas de cada tipo (incluidas las de control) a partir de filas al azar"""
+    rng = random.Random(seed)
+    query_types = {**QUERY_TYPES, **HELD_OUT_TYPES}
+    queries = []
+    for number in range(count):
+        query_type = list(query_types)[number % len(query_types)]
+        row = df.iloc[rng.randrange(len(df))]
+        attributes = {column: row[column] for column in query_types[query_type]}
+        queries.append({
+            "type": query_type,
+            "text": query_text(query_type, attributes, rng),
+            "attributes": attributes
+        })
+    return queries
+
+
+def relevance_grades(df: pd.DataFrame, attributes: Dict[str, Any]) -> np.ndarray:
+    """Número de atributos de la consulta que cumple cada fila"""
+    grades = np.zeros(len(df), dtype=np.int64)
+    for column, value in attributes.items():
+        grades += (df[column].astype(str) == str(value)).to_numpy()
+    return grades
+
+
+def dcg(gains: List[float]) -> float:
+    return sum((2 ** gain - 1) / math.log2(rank + 2) for rank, gain in enumerate(gains))
+
+
+def evaluate(grades: np.ndarray, positions: List[int], full_grade: int, k: int) -> Tuple[float, float]:
+    """(precision@k, nDCG@k) de las posiciones retornadas"""
+    gains = [int(grades[position]) for position in positions[:k]]
+    ideal = dcg(sorted(grades.tolist(), reverse=True)[:k])
+    # Con menos de k filas relevantes (por ejemplo una consulta por ID) el máximo alcanzable es 1
+    relevant = int(np.count_nonzero(grades == full_grade))
+    precision = sum(1 for gain in gains if gain == full_grade) / max(min(k, relevant), 1)
+    return precision, (dcg(gains) / ideal) if ideal else 0.0
+
+
+def run_benchmark(searcher: LocalCSVSearcher, file_name: str, queries: List[Dict[str, Any]],
+                  k: int) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """Métricas por estrategia y tipo de consulta"""
+    df = searcher.load_csv_from_local(file_name)
+    searcher.get_index(file_name)
+    position_of = {label: position for position, label in enumerate(df.index)}
+
+    measurements = {strategy: {} for strategy in STRATEGIES}
+    for query in queries:
+        grades = relevance_grades(df, query["attributes"])
+        for strategy in STRATEGIES:
+            start = time.perf_counter()
+            results = searcher.search_piece(file_name, query["text"], top_k=k if strategy == "bm25" else None)
+            latency = time.perf_counter() - start
+            # El chatbot usaba los primeros resultados en el orden en que llegan
+            positions = [position_of[result["row_index"]] for result in results["results"][:k]]
+            precision, ndcg = evaluate(grades, positions, len(query["attributes"]), k)
+            for group in ("todas", query["type"]):
+                stats = measurements[strategy].setdefault(group, {"precision": [], "ndcg": [], "latency": []})
+                stats["precision"].append(precision)
+                stats["ndcg"].append(ndcg)
+                stats["latency"].append(latency)
+
+    return {
+        strategy: {
+            group: {
+                "queries": len(stats["latency"]),
+                "precision": float(np.mean(stats["precision"])),
+                "ndcg": float(np.mean(stats["ndcg"])),
+                "latency_p50": percentile(stats["latency"], 50),
+                "latency_p95": percentile(stats["latency"], 95)
+            }
+            for group, stats in groups.items()
+        }
+        for strategy, groups in measurements.items()
+    }
+
+
+def print_report(report: Dict[str, Dict[str, Dict[str, float]]], k: int):
+    print(f"{'Consulta':20} {'Orden':7} {'N':>4} {f'P@{k}':>6} {f'nDCG@{k}':>8} {'p50 (ms)':>9} {'p95 (ms)':>9}")
+    for group in report["actual"]:
+        for strategy in STRATEGIES:
+            stats = report[strategy][group]
+            print(f"{group:20} {strategy:7} {stats['queries']:4d} {stats['precision']:6.3f} {stats['ndcg']:8.3f} "
+                  f"{stats['latency_p50'] * 1000:9.2f} {stats['latency_p95'] * 1000:9.2f}")
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(description="Calidad y latencia del ranking del catálogo")
+    parser.add_argument("--csv", default="../base_autopartes_dummy.csv")
+    parser.add_argument("--factor", type=int, default=1, help="Veces que se replica el catálogo")
+    parser.add_argument("--consultas", type=int, default=100)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--semilla", type=int, default=7)
+    args = parser.parse_args(argv)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as directory:
+        catalog = replicate_catalog(pd.read_csv(args.csv), args.factor)
+        catalog.to_csv(os.path.join(directory, "catalogo.csv"), index=False)
+        # Sin caché de consultas: cada búsqueda se mide completa, no como un acierto en la caché
+        searcher = LocalCSVSearcher(directory, query_cache=QueryResultCache(max_entries=0))
+        queries = build_queries(searcher.load_csv_from_local("catalogo.csv"), args.consultas, args.semilla)
+        print(f"Catálogo: {len(catalog)} filas · {len(queries)} consultas")
+        print_report(run_benchmark(searcher, "catalogo.csv", queries, args.k), args.k)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
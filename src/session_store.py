@@ -0,0 +1,93 @@
+import os
+import json
+import asyncio
+import logging
+from typing import List, Dict, Any
+
+try:
+    import redis.asyncio as redis
+except ImportError:  # redis es opcional: sin él solo se puede usar un worker
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# Las sesiones inactivas expiran tras 24 horas
+SESSION_TTL_SECONDS = 24 * 60 * 60
+
+# Mensajes que se conservan por sesión (igual que ConversationMemory)
+SESSION_MAX_MESSAGES = 10
+
+
+class InMemorySessionStore:
+    """Guarda el historial de cada sesión en memoria del proceso (solo válido con un worker)"""
+
+    def __init__(self, max_messages: int = SESSION_MAX_MESSAGES):
+        self._sessions: Dict[str, List[Dict[str, Any]]] = {}
+        self._lock = asyncio.Lock()
+        self.max_messages = max_messages
+
+    async def load(self, session_id: str) -> List[Dict[str, Any]]:
+        """Retorna los mensajes guardados de la sesión"""
+        async with self._lock:
+            return list(self._sessions.get(session_id, []))
+
+    async def append(self, session_id: str, messages: List[Dict[str, Any]]):
+        """Agrega los mensajes nuevos del turno (dos turnos concurrentes no se pisan)"""
+        async with self._lock:
+            history = self._sessions.setdefault(session_id, [])
+            history.extend(messages)
+            del history[:-self.max_messages]
+
+    async def delete(self, session_id: str):
+        """Elimina la sesión"""
+        async with self._lock:
+            self._sessions.pop(session_id, None)
+
+
+class RedisSessionStore:
+    """Guarda el historial de cada sesión en Redis, compartido entre workers y hosts"""
+
+    def __init__(self, url: str, ttl_seconds: int = SESSION_TTL_SECONDS,
+                 prefix: str = "autopartes:historial:", max_messages: int = SESSION_MAX_MESSAGES):
+        self.client = redis.from_url(url, decode_responses=True)
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+        self.max_messages = max_messages
+
+    async def load(self, session_id: str) -> List[Dict[str, Any]]:
+        """Retorna los mensajes guardados de la sesión"""
+        items = await self.client.lrange(self.prefix + session_id, 0, -1)
+        return [json.loads(item) for item in items]
+
+    async def append(self, session_id: str, messages: List[Dict[str, Any]]):
+        """
+        Agrega los mensajes nuevos del turno al final de la lista y renueva su expiración
+
+        RPUSH es atómico: dos turnos concurrentes de la misma sesión (en distintos workers)
+        agregan sus mensajes sin que uno sobrescriba el historial del otro.
+        """
+        if not messages:
+            return
+        key = self.prefix + session_id
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, *(json.dumps(message, ensure_ascii=False) for message in messages))
+            pipe.ltrim(key, -self.max_messages, -1)
+            pipe.expire(key, self.ttl_seconds)
+            await pipe.execute()
+
+    async def delete(self, session_id: str):
+        """Elimina la sesión"""
+        await self.client.delete(self.prefix + session_id)
+
+
+def create_session_store():
+    """Crea el almacén de sesiones según REDIS_URL (memoria local si no está configurado)"""
+    url = os.getenv("REDIS_URL")
+    if url:
+        if redis is None:
+            raise RuntimeError("REDIS_URL está configurado pero el paquete redis no está instalado")
+        logger.info("Usando Redis para el estado de sesiones")
+        return RedisSessionStore(url)
+
+    logger.warning("REDIS_URL no configurado: las sesiones se guardan en memoria del worker")
+    return InMemorySessionStore()
@@ -0,0 +1,257 @@
+"""
+Búsqueda distribuida (scatter-gather) entre los catálogos de varios proveedores
+
+Cada archivo CSV es un shard con su propio índice en LocalCSVSearcher. La consulta se envía a
+todos los shards en paralelo, cada shard devuelve solo su top-k y los resultados se combinan con
+un heap; la misma pieza (ID) ofrecida por varios proveedores se queda con el menor precio. Si un
+shard no responde a tiempo se devuelven los resultados parciales.
+
+La búsqueda de un shard es casi toda código de pandas que retiene el GIL: en un pool de hilos
+los shards se ejecutan uno tras otro y la latencia crece con su número (catálogos de 20 000
+filas: 98 ms con 1 shard, 180 ms con 2, 376 ms con 4 y 775 ms con 8). Con processes=True cada
+shard vive en su propio proceso, que carga solo su catálogo (o lo abre del catálogo compartido
+si se publicó ahí), y la latencia queda cerca de la del shard más lento. Esto requiere un núcleo
+por shard: con una sola vCPU los procesos no ganan nada y agregan el costo de serializar los
+resultados (4 shards: 523 ms con hilos y 590 ms con procesos).
+"""
+import time
+import heapq
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from typing import List, Dict, Any, Optional, Tuple
+
+from single_flight import SingleFlight, normalize_key
+
+logger = logging.getLogger(__name__)
+
+PRICE_COLUMN = "Precio (MXN)"
+ID_COLUMN = "ID"
+
+# Puntaje por tipo de coincidencia cuando el shard no entrega uno propio
+MATCH_TYPE_SCORES = {"exact": 2.0, "partial": 1.0}
+
+
+def result_score(result: Dict[str, Any]) -> float:
+    """Relevancia del resultado: la del shard si existe, si no según el tipo de coincidencia"""
+    if result.get('score') is not None:
+        return float(result['score'])
+    return MATCH_TYPE_SCORES.get(result.get('match_type'), 0.0)
+
+
+def result_price(result: Dict[str, Any]) -> float:
+    """Precio del resultado (infinito si no tiene)"""
+    try:
+        return float(result['row_data'][PRICE_COLUMN])
+    except (KeyError, TypeError, ValueError):
+        return float("inf")
+
+
+def rank_key(result: Dict[str, Any]) -> Tuple[float, float]:
+    """Orden global: mayor relevancia primero y, a igual relevancia, menor precio"""
+    return -result_score(result), result_price(result)
+
+
+def offer_key(result: Dict[str, Any]) -> Tuple[float, float]:
+    """
+    Mejor oferta de una misma pieza: menor precio y, a igual precio, mayor relevancia
+
+    Los puntajes BM25 de shards distintos no son comparables (cada índice tiene sus propios idf),
+    así que entre proveedores de la misma pieza decide el precio.
+    """
+    return result_price(result), -result_score(result)
+
+
+def shard_top_k(csv_searcher: Any, file_name: str, piece_identifier: str,
+                search_columns: Optional[List[str]], top_k: int) -> Dict[str, Any]:
+    """Busca en un shard y retorna su top-k por relevancia"""
+    results = csv_searcher.search_piece(file_name, piece_identifier, search_columns, top_k)
+    return {
+        **results,
+        'results': heapq.nsmallest(top_k, results['results'], key=rank_key)
+    }
+
+
+# Buscador del proceso de un shard (processes=True), creado por _init_shard_process
+_process_searcher = None
+
+
+def _init_shard_process(assets_path: str, shared_catalog_dir: Optional[str]):
+    global _process_searcher
+    # Importación diferida: model importa este módulo
+    from model import LocalCSVSearcher
+    logging.getLogger().setLevel(logging.WARNING)
+    _process_searcher = LocalCSVSearcher(assets_path, shared_catalog_dir)
+
+
+def _warm_shard_process(file_name: str) -> int:
+    _process_searcher.get_index(file_name)
+    return len(_process_searcher.load_csv_from_local(file_name))
+
+
+def _search_in_shard_process(file_name: str, piece_identifier: str, search_columns: Optional[List[str]],
+                             top_k: int) -> Dict[str, Any]:
+    return shard_top_k(_process_searcher, file_name, piece_identifier, search_columns, top_k)
+
+
+class ShardedCatalogSearcher:
+    """Busca en varios catálogos en paralelo y combina el top-k"""
+
+    def __init__(self, csv_searcher: Any, file_names: List[str], top_k: int = 10,
+                 shard_timeout: float = 2.0, max_workers: Optional[int] = None, processes: bool = False):
+        """
+        Args:
+            csv_searcher: LocalCSVSearcher que carga y cachea cada shard
+            file_names: Archivos CSV de los proveedores (uno por shard)
+            top_k: Resultados que se devuelven (y que aporta cada shard)
+            shard_timeout: Tiempo máximo de espera por la respuesta de todos los shards (segundos)
+            max_workers: Hilos del pool (por defecto, uno por shard hasta 32; sin uso con processes)
+            processes: Un proceso por shard en lugar de hilos (búsquedas realmente en paralelo)
+        """
+        self.csv_searcher = csv_searcher
+        self.file_names = list(file_names)
+        self.top_k = top_k
+        self.shard_timeout = shard_timeout
+        self.processes = processes
+        self._executor = None
+        self._shard_executors: Dict[str, Optional[Executor]] = {}
+        self._processes_lock = threading.Lock()
+        if processes:
+            # Los procesos se crean en la primera búsqueda (o en el calentamiento), no al importar
+            self._shard_executors = {file_name: None for file_name in self.file_names}
+        else:
+            self._executor = ThreadPoolExecutor(
+                max_workers=max_workers or min(len(self.file_names), 32) or 1,
+                thread_name_prefix="shard"
+            )
+        self.search_flight = SingleFlight()
+        self._stats_lock = threading.Lock()
+        self.stats = {"searches": 0, "shard_timeouts": 0, "shard_errors": 0}
+
+    def _count(self, key: str):
+        # Las búsquedas de distintas sesiones corren en hilos distintos
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _shard_process(self, file_name: str) -> Executor:
+        """Proceso dedicado del shard (spawn: el proceso padre tiene hilos de uvicorn y del pool)"""
+        with self._processes_lock:
+            executor = self._shard_executors.get(file_name)
+            if executor is None:
+                shared_catalog = getattr(self.csv_searcher, "shared_catalog", None)
+                executor = ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_shard_process,
+                    initargs=(self.csv_searcher.assets_path, shared_catalog.base_dir if shared_catalog else None)
+                )
+                self._shard_executors[file_name] = executor
+            return executor
+
+    def _submit(self, file_name: str, piece_identifier: str, search_columns: Optional[List[str]], top_k: int):
+        if self.processes:
+            return self._shard_process(file_name).submit(
+                _search_in_shard_process, file_name, piece_identifier, search_columns, top_k
+            )
+        return self._executor.submit(shard_top_k, self.csv_searcher, file_name, piece_identifier,
+                                     search_columns, top_k)
+
+    def warm(self):
+        """
+        Carga el catálogo y construye el índice de cada shard, esperando sin plazo
+
+        Con processes=True también arranca los procesos, que tardan varios segundos en importar
+        pandas y LangChain: sin calentarlos, las primeras búsquedas agotarían shard_timeout.
+        """
+        if self.processes:
+            futures = [self._shard_process(file_name).submit(_warm_shard_process, file_name)
+                       for file_name in self.file_names]
+        else:
+            futures = [self._executor.submit(self.csv_searcher.get_index, file_name)
+                       for file_name in self.file_names]
+        for future in futures:
+            future.result()
+
+    def close(self):
+        """Detiene los hilos o procesos de los shards"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        for executor in self._shard_executors.values():
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    def search_piece(self, piece_identifier: str, search_columns: Optional[List[str]] = None,
+                     top_k: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Busca la pieza en todos los shards (las búsquedas idénticas concurrentes se agrupan)
+
+        Returns:
+            Igual que LocalCSVSearcher.search_piece, más 'shards' (estado por archivo) y 'partial'
+        """
+        top_k = top_k or self.top_k
+        key = normalize_key(self.file_names, piece_identifier, search_columns, top_k)
+        results, _ = self.search_flight.do(
+            key, lambda: self._scatter_gather(piece_identifier, search_columns, top_k)
+        )
+        return results
+
+    def _scatter_gather(self, piece_identifier: str, search_columns: Optional[List[str]],
+                        top_k: int) -> Dict[str, Any]:
+        start = time.perf_counter()
+        self._count("searches")
+        futures = {
+            self._submit(file_name, piece_identifier, search_columns, top_k): file_name
+            for file_name in self.file_names
+        }
+        done, not_done = wait(futures, timeout=self.shard_timeout)
+
+        shards: Dict[str, str] = {}
+        best_by_id: Dict[Any, Dict[str, Any]] = {}
+        total_matches = 0
+        for future in done:
+            file_name = futures[future]
+            error = future.exception()
+            if isinstance(error, BrokenProcessPool):
+                # El proceso del shard murió: se reemplaza en la siguiente búsqueda
+                with self._processes_lock:
+                    self._shard_executors[file_name] = None
+            shard_results = future.result() if error is None else {'error': str(error) or type(error).__name__}
+            if shard_results.get('error'):
+                shards[file_name] = "error"
+                self._count("shard_errors")
+                logger.warning(f"Error en el shard {file_name}: {shard_results['error']}")
+                continue
+
+            shards[file_name] = "ok"
+            total_matches += shard_results['total_matches']
+            for result in shard_results['results']:
+                result = {**result, 'file_name': file_name}
+                # La misma pieza en varios proveedores: se conserva la de menor precio
+                piece_key = result['row_data'].get(ID_COLUMN, (file_name, result.get('row_index')))
+                current = best_by_id.get(piece_key)
+                if current is None or offer_key(result) < offer_key(current):
+                    best_by_id[piece_key] = result
+
+        for future in not_done:
+            shards[futures[future]] = "timeout"
+            self._count("shard_timeouts")
+            logger.warning(f"El shard {futures[future]} no respondió en {self.shard_timeout}s")
+
+        # Primero se deduplica por precio y después se ordena el resultado por relevancia
+        merged = heapq.nsmallest(top_k, best_by_id.values(), key=rank_key)
+        logger.info(
+            f"Búsqueda en {len(self.file_names)} shards: {len(merged)} resultados "
+            f"en {(time.perf_counter() - start) * 1000:.1f} ms"
+        )
+        return {
+            'piece_identifier': piece_identifier,
+            'total_matches': len(merged),
+            'total_shard_matches': total_matches,
+            'results': merged,
+            'shards': shards,
+            'partial': bool(not_done) or "error" in shards.values(),
+            'search_timestamp': datetime.now().isoformat()
+        }
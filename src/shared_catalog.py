@@ -0,0 +1,349 @@
+"""
+Catálogo compartido entre procesos mediante archivos mapeados en memoria
+
+Un único proceso cargador publica cada versión del catálogo en un directorio (idealmente en
+/dev/shm). Los workers abren los arreglos con np.load(mmap_mode='r'), de modo que el sistema
+operativo comparte las mismas páginas entre todos los procesos en lugar de mantener una copia
+privada del DataFrame por worker. Las columnas de texto con pocos valores distintos se guardan
+como códigos de categoría; las de muchos valores (ID, descripciones) como un bloque UTF-8 con
+offsets, igual que los snippets, para que sus textos tampoco se copien en cada worker.
+
+Publicar una versión nueva desde la carpeta src:
+    python shared_catalog.py ../base_autopartes_dummy.csv /dev/shm/autopartes
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas.api.extensions import ExtensionArray, ExtensionDtype, take
+
+from relevance import BM25Index
+from string_blob import StringBlob, encode_strings
+
+logger = logging.getLogger(__name__)
+
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+INDEX_DIR = "bm25"
+
+# Versiones anteriores que se conservan para los workers que aún no se han actualizado
+KEEP_VERSIONS = 2
+
+# Intentos para abrir la versión actual si el cargador la borra mientras se abre
+ATTACH_ATTEMPTS = 3
+
+# Una columna de texto se publica como categórica solo con a lo más estos valores distintos:
+# cada worker carga las categorías en su propia memoria
+MAX_SHARED_CATEGORIES = 1024
+
+
+class SharedStringDtype(ExtensionDtype):
+    """Tipo de las columnas de texto guardadas como bloque UTF-8 compartido"""
+
+    name = "shared_str"
+    type = str
+    kind = "O"
+    na_value = np.nan
+
+    @classmethod
+    def construct_array_type(cls):
+        return SharedStringArray
+
+
+class SharedStringArray(ExtensionArray):
+    """
+    Columna de texto de solo lectura sobre un StringBlob (mapeado en memoria)
+
+    Los textos se decodifican al leerlos; las selecciones (filtros, take) solo guardan las
+    posiciones de las filas, nunca una copia de los textos.
+    """
+
+    def __init__(self, strings: StringBlob, nulls: np.ndarray, positions: Optional[np.ndarray] = None):
+        self.strings = strings
+        self.nulls = nulls
+        # Filas del bloque que forman el arreglo (None: todas, en orden); -1 es un valor faltante
+        self.positions = positions
+
+    @property
+    def dtype(self) -> SharedStringDtype:
+        return SharedStringDtype()
+
+    def __len__(self) -> int:
+        return len(self.nulls) if self.positions is None else len(self.positions)
+
+    def _rows(self) -> np.ndarray:
+        return np.arange(len(self.nulls)) if self.positions is None else self.positions
+
+    def _values(self, rows: np.ndarray) -> np.ndarray:
+        values = np.full(len(rows), np.nan, dtype=object)
+        valid = rows >= 0
+        valid[valid] = ~self.nulls[rows[valid]]
+        values[valid] = self.strings.decode(rows[valid])
+        return values
+
+    def __getitem__(self, item):
+        if pd.api.types.is_integer(item):
+            row = int(self._rows()[item]) if self.positions is not None else range(len(self))[item]
+            return np.nan if row < 0 or self.nulls[row] else self.strings[row]
+        if isinstance(item, slice) and item == slice(None):
+            return self
+        if not isinstance(item, slice):
+            item = pd.api.indexers.check_array_indexer(self, item)
+        return type(self)(self.strings, self.nulls, self._rows()[item])
+
+    def __iter__(self):
+        return iter(self._values(self._rows()))
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        values = self._values(self._rows())
+        return values if dtype is None else values.astype(dtype)
+
+    def __eq__(self, other):
+        return np.asarray(self) == (np.asarray(other, dtype=object) if isinstance(other, ExtensionArray) else other)
+
+    @property
+    def nbytes(self) -> int:
+        return self.strings.nbytes + int(self.nulls.nbytes) + (0 if self.positions is None else int(self.positions.nbytes))
+
+    def isna(self) -> np.ndarray:
+        rows = self._rows()
+        missing = rows < 0
+        missing[~missing] = self.nulls[rows[~missing]]
+        return missing
+
+    def take(self, indices, allow_fill: bool = False, fill_value=None) -> "SharedStringArray":
+        if allow_fill and fill_value is not None and not pd.isna(fill_value):
+            return self._from_sequence(take(np.asarray(self), indices, allow_fill=True, fill_value=fill_value))
+        rows = take(self._rows(), indices, allow_fill=allow_fill, fill_value=-1)
+        return type(self)(self.strings, self.nulls, np.asarray(rows, dtype=np.int64))
+
+    def copy(self) -> "SharedStringArray":
+        # Los datos son de solo lectura: basta con copiar las posiciones
+        return type(self)(self.strings, self.nulls, None if self.positions is None else self.positions.copy())
+
+    @classmethod
+    def _from_sequence(cls, scalars, *, dtype=None, copy: bool = False) -> "SharedStringArray":
+        blob, offsets, nulls = encode_strings(scalars)
+        return cls(StringBlob(blob, offsets), nulls)
+
+    @classmethod
+    def _from_factorized(cls, values, original) -> "SharedStringArray":
+        return cls._from_sequence(values)
+
+    @classmethod
+    def _concat_same_type(cls, to_concat) -> "SharedStringArray":
+        to_concat = list(to_concat)
+        if all(array.strings is to_concat[0].strings for array in to_concat):
+            return cls(to_concat[0].strings, to_concat[0].nulls, np.concatenate([array._rows() for array in to_concat]))
+        return cls._from_sequence(np.concatenate([np.asarray(array) for array in to_concat]))
+
+    def _values_for_factorize(self):
+        return np.asarray(self), np.nan
+
+
+class SharedSnippets:
+    """Textos precalculados por fila guardados como un bloque UTF-8 con offsets, compartido entre procesos"""
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray, tokens: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+        self.tokens = tokens
+
+    def get(self, position: int) -> Tuple[str, int]:
+        """Retorna (texto, tokens) de la fila en la posición indicada"""
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return bytes(self.blob[start:end]).decode("utf-8"), int(self.tokens[position])
+
+
+class SharedCatalogSnapshot:
+    """Una versión publicada del catálogo, abierta en modo solo lectura"""
+
+    def __init__(self, version: str, source_file: str, df: pd.DataFrame, snippets: SharedSnippets,
+                 index: Optional[BM25Index] = None):
+        self.version = version
+        self.source_file = source_file
+        self.df = df
+        self.snippets = snippets
+        self.index = index
+
+
+def publish_catalog(df: pd.DataFrame, snippets: pd.DataFrame, base_dir: str, source_file: str,
+                    index: Optional[BM25Index] = None) -> str:
+    """
+    Publica una versión del catálogo de forma atómica
+
+    Args:
+        df: Catálogo a publicar
+        snippets: Textos por fila con columnas 'text' y 'tokens' (ver LocalCSVSearcher._render_snippets)
+        base_dir: Directorio compartido por el cargador y los workers
+        source_file: Nombre del archivo CSV de origen (con el que lo piden los workers)
+        index: Índice BM25 del catálogo; si se publica, los workers no construyen el suyo
+
+    Returns:
+        Identificador de la versión publicada
+    """
+    os.makedirs(base_dir, exist_ok=True)
+    version = f"v{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+    tmp_dir = os.path.join(base_dir, f".tmp-{version}")
+    os.makedirs(tmp_dir)
+
+    columns = []
+    for i, column in enumerate(df.columns):
+        series = df[column]
+        entry = {"name": column, "file": f"col_{i}.npy"}
+        if pd.api.types.is_numeric_dtype(series.dtype) and not isinstance(series.dtype, pd.CategoricalDtype):
+            np.save(os.path.join(tmp_dir, entry["file"]), series.to_numpy())
+            entry["kind"] = "numeric"
+        elif series.nunique(dropna=True) <= MAX_SHARED_CATEGORIES:
+            # Codificación por diccionario: los códigos se comparten, las categorías son pocas
+            categorical = pd.Categorical(series)
+            np.save(os.path.join(tmp_dir, entry["file"]), categorical.codes)
+            entry["kind"] = "categorical"
+            entry["categories"] = categorical.categories.tolist()
+        else:
+            # Muchos valores distintos: bloque UTF-8 con offsets, compartido como los snippets
+            blob, offsets, nulls = encode_strings(series.to_numpy(dtype=object))
+            StringBlob(blob, offsets).save(tmp_dir, f"col_{i}")
+            np.save(os.path.join(tmp_dir, entry["file"]), nulls)
+            entry["kind"] = "text"
+        columns.append(entry)
+
+    encoded = [text.encode("utf-8") for text in snippets['text']]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in encoded], out=offsets[1:])
+    np.save(os.path.join(tmp_dir, "snippets_blob.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+    np.save(os.path.join(tmp_dir, "snippets_offsets.npy"), offsets)
+    np.save(os.path.join(tmp_dir, "snippets_tokens.npy"), snippets['tokens'].to_numpy(dtype=np.int32))
+    if index is not None:
+        index.save(os.path.join(tmp_dir, INDEX_DIR))
+
+    manifest = {
+        "version": version,
+        "source_file": source_file,
+        "rows": len(df),
+        "columns": columns,
+        "index": index is not None,
+        "published_at": datetime.now().isoformat()
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
+    # Primero el directorio completo, después el puntero: los workers nunca ven una versión a medias
+    os.rename(tmp_dir, os.path.join(base_dir, version))
+    pointer_tmp = os.path.join(base_dir, f".{CURRENT_FILE}.tmp")
+    with open(pointer_tmp, "w") as f:
+        f.write(version)
+    os.replace(pointer_tmp, os.path.join(base_dir, CURRENT_FILE))
+
+    _remove_old_versions(base_dir, version)
+    logger.info(f"Catálogo publicado: {version} ({len(df)} filas) en {base_dir}")
+    return version
+
+
+def _remove_old_versions(base_dir: str, current_version: str):
+    """Elimina versiones antiguas; los workers que aún las tengan mapeadas conservan sus páginas"""
+    versions = sorted(name for name in os.listdir(base_dir) if name.startswith("v") and name != current_version)
+    for version in versions[:max(len(versions) - (KEEP_VERSIONS - 1), 0)]:
+        shutil.rmtree(os.path.join(base_dir, version), ignore_errors=True)
+
+
+def attach_catalog(base_dir: str) -> SharedCatalogSnapshot:
+    """
+    Abre en modo solo lectura la versión actual publicada en base_dir
+
+    Entre leer el puntero y abrir los archivos pueden publicarse varias versiones y el cargador
+    borrar la leída; en ese caso se vuelve a leer el puntero y se abre la versión nueva.
+    """
+    for attempt in range(ATTACH_ATTEMPTS):
+        with open(os.path.join(base_dir, CURRENT_FILE)) as f:
+            version = f.read().strip()
+        try:
+            return _attach_version(base_dir, version)
+        except FileNotFoundError:
+            if attempt == ATTACH_ATTEMPTS - 1:
+                raise
+            logger.info(f"La versión {version} se eliminó mientras se abría; se lee de nuevo el puntero")
+
+
+def _attach_version(base_dir: str, version: str) -> SharedCatalogSnapshot:
+    version_dir = os.path.join(base_dir, version)
+
+    with open(os.path.join(version_dir, MANIFEST_FILE), encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    data = {}
+    for entry in manifest["columns"]:
+        array = np.load(os.path.join(version_dir, entry["file"]), mmap_mode="r")
+        if entry["kind"] == "categorical":
+            data[entry["name"]] = pd.Categorical.from_codes(
+                array, categories=pd.Index(entry["categories"]), validate=False
+            )
+        elif entry["kind"] == "text":
+            strings = StringBlob.load(version_dir, os.path.splitext(entry["file"])[0])
+            data[entry["name"]] = SharedStringArray(strings, array)
+        else:
+            data[entry["name"]] = array
+    # copy=False mantiene los arreglos mapeados en lugar de consolidarlos en una copia privada
+    df = pd.DataFrame(data, copy=False)
+
+    snippets = SharedSnippets(
+        np.load(os.path.join(version_dir, "snippets_blob.npy"), mmap_mode="r"),
+        np.load(os.path.join(version_dir, "snippets_offsets.npy"), mmap_mode="r"),
+        np.load(os.path.join(version_dir, "snippets_tokens.npy"), mmap_mode="r")
+    )
+    index = BM25Index.load(os.path.join(version_dir, INDEX_DIR)) if manifest.get("index") else None
+    logger.info(f"Catálogo compartido {version} abierto desde {version_dir}")
+    return SharedCatalogSnapshot(version, manifest["source_file"], df, snippets, index)
+
+
+class SharedCatalogReader:
+    """Mantiene abierta la versión actual del catálogo y detecta publicaciones nuevas"""
+
+    def __init__(self, base_dir: str, check_interval: float = 5.0):
+        self.base_dir = base_dir
+        self.check_interval = check_interval
+        self._snapshot: Optional[SharedCatalogSnapshot] = None
+        self._last_check = 0.0
+
+    def current(self) -> SharedCatalogSnapshot:
+        """Retorna la versión actual, revisando el puntero como máximo cada check_interval segundos"""
+        now = time.monotonic()
+        if self._snapshot is None or now - self._last_check >= self.check_interval:
+            self._last_check = now
+            with open(os.path.join(self.base_dir, CURRENT_FILE)) as f:
+                version = f.read().strip()
+            if self._snapshot is None or self._snapshot.version != version:
+                self._snapshot = attach_catalog(self.base_dir)
+        return self._snapshot
+
+    def serves(self, file_name: str) -> bool:
+        """Indica si el catálogo publicado corresponde al archivo solicitado"""
+        return os.path.basename(self.current().source_file) == os.path.basename(file_name)
+
+
+def main(argv: List[str]):
+    """Publica un CSV como nueva versión del catálogo compartido"""
+    if len(argv) != 2:
+        print("Uso: python shared_catalog.py <archivo.csv> <directorio_compartido>")
+        sys.exit(1)
+
+    from model import LocalCSVSearcher
+    from catalog_compaction import compact_catalog
+
+    csv_path, base_dir = argv
+    df, _ = compact_catalog(pd.read_csv(csv_path))
+    version = publish_catalog(df, LocalCSVSearcher._render_snippets(df), base_dir, os.path.basename(csv_path),
+                              index=BM25Index(df))
+    print(f"Versión publicada: {version}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
@@ -0,0 +1,212 @@
+import json
+import uuid
+import hashlib
+import logging
+import threading
+import unicodedata
+from typing import List, Dict, Any, Optional, Callable, Iterator, Tuple
+
+from langchain_core.outputs import LLMResult
+from prompt_cache import texto_de_contenido
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_key(*parts: Any) -> str:
+    """Clave canónica: minúsculas, sin acentos y con espacios colapsados"""
+    text = "\x1f".join(json.dumps(part, ensure_ascii=False, default=str, sort_keys=True) for part in parts)
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return hashlib.sha256(" ".join(text.split()).encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    """Una llamada en curso compartida por varios solicitantes"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.done = False
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.chunks: List[Any] = []
+
+
+class SingleFlight:
+    """
+    Agrupa solicitudes concurrentes con la misma clave en una sola llamada
+
+    El primer solicitante ejecuta la función; los que llegan mientras está en curso esperan
+    y reciben el mismo resultado (o los mismos fragmentos, en streaming).
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "upstream_calls": 0, "coalesced": 0}
+
+    def _join(self, key: str) -> Tuple[_Flight, bool]:
+        """Retorna (vuelo, es_líder) para la clave"""
+        with self._lock:
+            self.stats["requests"] += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+                self.stats["upstream_calls"] += 1
+            else:
+                self.stats["coalesced"] += 1
+            return flight, leader
+
+    def _finish(self, key: str, flight: _Flight, result: Any = None, error: Optional[BaseException] = None):
+        with self._lock:
+            self._flights.pop(key, None)
+        with flight.condition:
+            flight.result = result
+            flight.error = error
+            flight.done = True
+            flight.condition.notify_all()
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Ejecuta fn una sola vez por clave en curso; retorna (resultado, compartido)"""
+        flight, leader = self._join(key)
+        if leader:
+            try:
+                result = fn()
+            except BaseException as e:
+                self._finish(key, flight, error=e)
+                raise
+            self._finish(key, flight, result=result)
+            return result, False
+
+        with flight.condition:
+            flight.condition.wait_for(lambda: flight.done)
+        if flight.error is not None:
+            raise flight.error
+        return flight.result, True
+
+    def do_stream(self, key: str, fn: Callable[[], Iterator[Any]],
+                  shared_chunk: Optional[Callable[[Any], Any]] = None) -> Iterator[Any]:
+        """
+        Versión en streaming: un hilo consume el generador de origen y todos los solicitantes
+        reciben cada fragmento desde el principio, aunque se unan a mitad del stream
+
+        shared_chunk, si se indica, transforma los fragmentos que reciben los solicitantes agrupados.
+        """
+        flight, leader = self._join(key)
+        transform = shared_chunk if (shared_chunk is not None and not leader) else None
+        if leader:
+            threading.Thread(target=self._pump, args=(key, flight, fn), daemon=True,
+                             name="single-flight-stream").start()
+
+        position = 0
+        while True:
+            with flight.condition:
+                flight.condition.wait_for(lambda: position < len(flight.chunks) or flight.done)
+                pending = flight.chunks[position:]
+                finished = flight.done
+            for chunk in pending:
+                yield transform(chunk) if transform else chunk
+            position += len(pending)
+            if finished and position >= len(flight.chunks):
+                break
+
+        if flight.error is not None:
+            raise flight.error
+
+    def _pump(self, key: str, flight: _Flight, fn: Callable[[], Iterator[Any]]):
+        """Consume el generador de origen y publica los fragmentos"""
+        try:
+            for chunk in fn():
+                with flight.condition:
+                    flight.chunks.append(chunk)
+                    flight.condition.notify_all()
+        except BaseException as e:
+            self._finish(key, flight, error=e)
+            return
+        self._finish(key, flight)
+
+
+# Compartido por todas las sesiones del proceso
+DEFAULT_FLIGHT = SingleFlight()
+
+
+class CoalescingLLM:
+    """
+    Cliente del modelo que agrupa llamadas idénticas concurrentes
+
+    Turnos con los mismos mensajes (normalizados) comparten una sola invocación upstream.
+    Si el llamador pasa callbacks, el líder recibe los tokens conforme llegan (con el hedging
+    de la capa resiliente) y los demás solicitantes reciben el texto final al terminar.
+
+    Las respuestas compartidas llevan response_metadata["coalesced"] y usage_metadata vacío:
+    los tokens de la única llamada upstream se cuentan solo en la sesión del líder.
+    """
+
+    def __init__(self, llm: Any, namespace: str = "", flight: Optional[SingleFlight] = None):
+        """
+        Args:
+            llm: Cliente del modelo (ResilientLLM, ModelRouter, ChatBedrockConverse...)
+            namespace: Separa las claves de modelos distintos (por ejemplo, el model_id)
+            flight: Agrupador compartido (por defecto, el del proceso)
+        """
+        self.llm = llm
+        self.namespace = namespace
+        self.flight = flight or DEFAULT_FLIGHT
+
+    def __getattr__(self, name: str) -> Any:
+        # Expone get_stats, get_routing_stats, last_route... del cliente envuelto
+        if name == "llm":
+            raise AttributeError(name)
+        return getattr(self.llm, name)
+
+    def _key(self, mode: str, messages: List[Any]) -> str:
+        # invoke y stream producen resultados distintos (mensaje vs. fragmentos): no comparten vuelo
+        return normalize_key(self.namespace, mode, [(message.type, message.content) for message in messages])
+
+    @staticmethod
+    def _without_callbacks(config: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        return {key: value for key, value in (config or {}).items() if key != "callbacks"}
+
+    @staticmethod
+    def _shared_copy(message: Any) -> Any:
+        """Copia para un solicitante agrupado: sin uso de tokens y marcada como compartida"""
+        return message.model_copy(update={
+            "usage_metadata": None,
+            "response_metadata": {**(message.response_metadata or {}), "coalesced": True}
+        })
+
+    def invoke(self, messages: List[Any], config: Optional[Dict[str, Any]] = None, **kwargs) -> Any:
+        """Invoca el modelo compartiendo la llamada con solicitudes idénticas en curso"""
+        handlers = (config or {}).get("callbacks") or []
+        # Los callbacks del líder van a la llamada upstream: sus tokens pasan por el hedging
+        # de ResilientLLM; los callbacks de los demás no se pueden enganchar a esa llamada
+        response, shared = self.flight.do(
+            self._key("invoke", messages),
+            lambda: self.llm.invoke(messages, config=config, **kwargs)
+        )
+        if not shared:
+            return response
+
+        response = self._shared_copy(response)
+        if handlers:
+            run_id = uuid.uuid4()
+            text = texto_de_contenido(response.content)
+            for handler in handlers:
+                if text:
+                    handler.on_llm_new_token(text, run_id=run_id)
+                handler.on_llm_end(LLMResult(generations=[]), run_id=run_id)
+        return response
+
+    def stream(self, messages: List[Any], config: Optional[Dict[str, Any]] = None, **kwargs) -> Iterator[Any]:
+        """Streaming compartido: cada solicitante recibe todos los fragmentos de la única llamada upstream"""
+        upstream_config = self._without_callbacks(config)
+        return self.flight.do_stream(
+            self._key("stream", messages),
+            lambda: self.llm.stream(messages, config=upstream_config, **kwargs),
+            shared_chunk=self._shared_copy
+        )
+
+    def get_coalescing_stats(self) -> Dict[str, int]:
+        """Solicitudes recibidas, llamadas upstream y solicitudes agrupadas"""
+        return dict(self.flight.stats)
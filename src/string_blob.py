@@ -0,0 +1,75 @@
+"""
+Textos guardados como un solo bloque UTF-8 con offsets
+
+Un arreglo de objetos str cuesta decenas de bytes por fila más el texto, y al abrirlo cada proceso
+crea su propia copia. Como bloque de bytes más offsets, los dos arreglos se pueden mapear en memoria
+desde disco (np.load con mmap_mode='r') y todos los procesos comparten las mismas páginas; cada
+texto se decodifica solo cuando se lee.
+"""
+import os
+from typing import List, Optional, Iterable, Sequence, Tuple
+
+import numpy as np
+
+
+def encode_strings(values: Iterable[Optional[str]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Codifica los textos
+
+    Returns:
+        (bloque uint8, offsets int64 de len(values) + 1, máscara de valores nulos)
+    """
+    encoded: List[bytes] = []
+    nulls: List[bool] = []
+    for value in values:
+        missing = value is None or (isinstance(value, float) and np.isnan(value))
+        nulls.append(missing)
+        encoded.append(b"" if missing else str(value).encode("utf-8"))
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in encoded], out=offsets[1:])
+    blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return blob, offsets, np.asarray(nulls, dtype=bool)
+
+
+class StringBlob(Sequence):
+    """Secuencia de solo lectura de textos sobre (bloque, offsets)"""
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position: int) -> str:
+        if position < 0:
+            position += len(self)
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return bytes(self.blob[start:end]).decode("utf-8")
+
+    def decode(self, rows: np.ndarray) -> List[str]:
+        """Decodifica varias filas de una vez (más rápido que leerlas una por una)"""
+        rows = np.asarray(rows, dtype=np.int64)
+        data = memoryview(self.blob)
+        starts, ends = self.offsets[rows].tolist(), self.offsets[rows + 1].tolist()
+        return [str(data[start:end], "utf-8") for start, end in zip(starts, ends)]
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.blob.nbytes + self.offsets.nbytes)
+
+    def save(self, directory: str, name: str):
+        np.save(os.path.join(directory, f"{name}_blob.npy"), self.blob)
+        np.save(os.path.join(directory, f"{name}_offsets.npy"), self.offsets)
+
+    @classmethod
+    def from_strings(cls, values: Iterable[str]) -> "StringBlob":
+        blob, offsets, _ = encode_strings(values)
+        return cls(blob, offsets)
+
+    @classmethod
+    def load(cls, directory: str, name: str, mmap_mode: Optional[str] = "r") -> "StringBlob":
+        return cls(
+            np.load(os.path.join(directory, f"{name}_blob.npy"), mmap_mode=mmap_mode),
+            np.load(os.path.join(directory, f"{name}_offsets.npy"), mmap_mode=mmap_mode)
+        )
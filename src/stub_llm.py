@@ -0,0 +1,161 @@
+import re
+import time
+import random
+import hashlib
+import threading
+from typing import List, Dict, Any, Optional, Iterator, Tuple
+from pydantic import PrivateAttr
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage, AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from prompt_cache import estimar_tokens, modelo_soporta_cache, MIN_TOKENS_CHECKPOINT
+
+
+class StubThrottlingError(Exception):
+    """Error de throttling simulado, con la misma forma que botocore.exceptions.ClientError"""
+
+    def __init__(self, message: str = "Rate exceeded"):
+        super().__init__(message)
+        self.response = {"Error": {"Code": "ThrottlingException", "Message": message}}
+
+
+class StubBedrockLLM(BaseChatModel):
+    """
+    Modelo local que imita a ChatBedrockConverse sin llamar a AWS.
+
+    Simula la latencia (proporcional a los tokens procesados) y el prompt caching de Bedrock:
+    el prefijo anterior a cada cachePoint se guarda por hash y en los turnos siguientes se
+    cobra como tokens en caché, mucho más baratos que los tokens sin caché.
+    """
+
+    model_id: str = "us.amazon.nova-lite-v1:0"
+    latencia_base: float = 0.05
+    segundos_por_token_entrada: float = 0.0002
+    segundos_por_token_cacheado: float = 0.00002
+    segundos_por_token_salida: float = 0.002
+    ttl_cache: float = 300.0
+    respuesta: Optional[str] = None
+
+    # Inyección de fallas para probar reintentos y hedging
+    probabilidad_throttling: float = 0.0
+    probabilidad_lentitud: float = 0.0
+    latencia_lenta: float = 5.0
+
+    _cache_prefijos: Dict[str, float] = PrivateAttr(default_factory=dict)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self) -> str:
+        return "bedrock-converse-stub"
+
+    @staticmethod
+    def _texto_bloque(bloque: Any) -> str:
+        """Texto de un bloque de contenido (str o dict)"""
+        if isinstance(bloque, str):
+            return bloque
+        if isinstance(bloque, dict):
+            return bloque.get("text", "")
+        return ""
+
+    def _analizar_mensajes(self, messages: List[BaseMessage]) -> Tuple[int, List[Tuple[str, int]], str]:
+        """
+        Recorre los mensajes en orden calculando tokens y checkpoints
+
+        Returns:
+            (tokens totales, [(hash del prefijo, tokens del prefijo)], último texto del usuario)
+        """
+        hasher = hashlib.sha256()
+        total_tokens = 0
+        checkpoints = []
+        ultimo_usuario = ""
+
+        for message in messages:
+            hasher.update(message.type.encode())
+            bloques = message.content if isinstance(message.content, list) else [message.content]
+            for bloque in bloques:
+                if isinstance(bloque, dict) and "cachePoint" in bloque:
+                    checkpoints.append((hasher.copy().hexdigest(), total_tokens))
+                    continue
+                texto = self._texto_bloque(bloque)
+                hasher.update(texto.encode())
+                total_tokens += estimar_tokens(texto)
+                if message.type == "human" and texto:
+                    ultimo_usuario = texto
+
+        return total_tokens, checkpoints, ultimo_usuario
+
+    def _simular_cache(self, checkpoints: List[Tuple[str, int]]) -> Tuple[int, int]:
+        """Devuelve (tokens leídos de caché, tokens escritos en caché) y actualiza la caché"""
+        if not modelo_soporta_cache(self.model_id):
+            return 0, 0
+
+        ahora = time.monotonic()
+        leidos = 0
+        escritos = 0
+        with self._lock:
+            for hash_prefijo, tokens_prefijo in checkpoints:
+                if tokens_prefijo < MIN_TOKENS_CHECKPOINT:
+                    continue
+                expiracion = self._cache_prefijos.get(hash_prefijo)
+                if expiracion is not None and expiracion > ahora:
+                    leidos = tokens_prefijo
+                else:
+                    escritos = tokens_prefijo - leidos
+                # Cada lectura renueva el TTL, igual que en Bedrock
+                self._cache_prefijos[hash_prefijo] = ahora + self.ttl_cache
+        return leidos, escritos
+
+    def _preparar_turno(self, messages: List[BaseMessage]) -> Tuple[str, Dict[str, Any], float]:
+        """Calcula respuesta, usage_metadata y latencia de prefill de un turno"""
+        if random.random() < self.probabilidad_throttling:
+            time.sleep(self.latencia_base)
+            raise StubThrottlingError()
+        total_tokens, checkpoints, ultimo_usuario = self._analizar_mensajes(messages)
+        leidos, escritos = self._simular_cache(checkpoints)
+        sin_cache = total_tokens - leidos
+
+        texto = self.respuesta or f"[{self.model_id}] Respuesta simulada a: {ultimo_usuario[:200]}"
+        output_tokens = estimar_tokens(texto)
+
+        # inputTokens de Converse excluye los tokens leídos o escritos en caché
+        usage_metadata = {
+            "input_tokens": total_tokens - leidos - escritos,
+            "output_tokens": output_tokens,
+            "total_tokens": total_tokens + output_tokens,
+            "input_token_details": {"cache_read": leidos, "cache_creation": escritos}
+        }
+        latencia_prefill = (
+            self.latencia_base
+            + sin_cache * self.segundos_por_token_entrada
+            + leidos * self.segundos_por_token_cacheado
+        )
+        if random.random() < self.probabilidad_lentitud:
+            latencia_prefill += self.latencia_lenta
+        return texto, usage_metadata, latencia_prefill
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs) -> ChatResult:
+        texto, usage_metadata, latencia_prefill = self._preparar_turno(messages)
+        time.sleep(latencia_prefill)
+
+        for pieza in re.findall(r"\S+\s*", texto):
+            time.sleep(estimar_tokens(pieza) * self.segundos_por_token_salida)
+            if run_manager:
+                run_manager.on_llm_new_token(pieza)
+
+        message = AIMessage(content=texto, usage_metadata=usage_metadata)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        texto, usage_metadata, latencia_prefill = self._preparar_turno(messages)
+        time.sleep(latencia_prefill)
+
+        for pieza in re.findall(r"\S+\s*", texto):
+            time.sleep(estimar_tokens(pieza) * self.segundos_por_token_salida)
+            if run_manager:
+                run_manager.on_llm_new_token(pieza)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=pieza))
+
+        # El uso de tokens llega en el último chunk, como en ConverseStream
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=usage_metadata))
@@ -0,0 +1,91 @@
+"""
+Calentamiento del proceso en segundo plano al arrancar
+
+Sin calentamiento, el primer usuario después de un despliegue paga dentro de su turno la lectura
+del CSV, la construcción de los índices, la creación del cliente de boto3 y el primer handshake
+TLS con Bedrock. WarmUp ejecuta esos pasos en un hilo al arrancar y expone si el proceso ya está
+listo, para que el health check no reciba tráfico del balanceador hasta entonces.
+"""
+import time
+import logging
+import threading
+from typing import List, Dict, Any, Optional, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class WarmUpStep:
+    """Un paso del calentamiento; si no es requerido, su error no impide quedar listo"""
+
+    def __init__(self, name: str, fn: Callable[[], Any], required: bool = True):
+        self.name = name
+        self.fn = fn
+        self.required = required
+        self.status = "pending"
+        self.seconds: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"name": self.name, "status": self.status, "seconds": self.seconds, "error": self.error}
+
+
+class WarmUp:
+    """Ejecuta los pasos en orden en un hilo de fondo y marca el proceso como listo al terminar"""
+
+    def __init__(self, steps: List[WarmUpStep]):
+        self.steps = steps
+        self.state = "pending"
+        self._ready = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._started_at: Optional[float] = None
+        self._finished_at: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def start(self):
+        """Inicia el calentamiento (solo la primera vez)"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True, name="warmup")
+        self._thread.start()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Espera a que el proceso esté listo; retorna si lo está"""
+        return self._ready.wait(timeout)
+
+    def _run(self):
+        self.state = "running"
+        self._started_at = time.perf_counter()
+        failed = False
+        for step in self.steps:
+            step.status = "running"
+            start = time.perf_counter()
+            try:
+                step.fn()
+                step.status = "ok"
+            except Exception as e:
+                step.status = "error"
+                step.error = str(e)
+                failed = failed or step.required
+                log = logger.error if step.required else logger.warning
+                log(f"Error en el calentamiento ({step.name}): {str(e)}")
+            step.seconds = round(time.perf_counter() - start, 3)
+            logger.info(f"Calentamiento: {step.name} en {step.seconds:.3f}s ({step.status})")
+
+        self._finished_at = time.perf_counter()
+        self.state = "failed" if failed else "ready"
+        if not failed:
+            self._ready.set()
+        logger.info(f"Calentamiento terminado en {self._finished_at - self._started_at:.3f}s: {self.state}")
+
+    def status(self) -> Dict[str, Any]:
+        """Estado del calentamiento para el health check"""
+        end = self._finished_at or time.perf_counter()
+        return {
+            "ready": self.ready,
+            "state": self.state,
+            "seconds": round(end - self._started_at, 3) if self._started_at else None,
+            "steps": [step.to_dict() for step in self.steps]
+        }